@@ -0,0 +1,71 @@
+#!/usr/bin/env python3
+import sys
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+import numpy as np
+
+from dataset.dmpcas_parser import read_dmpcas
+import dataset.dmpcas_parser_old
+
+def write_synthetic_dmpcas(dst:Path, num_times:int, num_scalars:int, num_vectors:int, num_tensors:int):
+    rng=random.Random(1)
+    with open(dst, "wt") as f:
+        for t in range(1,num_times+1):
+            f.write(f"Time = {t*100}\n")
+            for i in range(num_scalars):
+                f.write(f"Scalar {i}\n{rng.random()!r} {rng.random()!r}\n\n")
+            for i in range(num_vectors):
+                f.write(f"Vector {i}\n")
+                for c in range(4):
+                    f.write(f"{rng.random()!r} {rng.random()!r}\n")
+                f.write("\n")
+            for i in range(num_tensors):
+                f.write(f"Tensor {i}\n")
+                for r in range(3):
+                    f.write(" ".join( repr(rng.random()) for c in range(6) )+"\n")
+                f.write("\n")
+
+if __name__=="__main__":
+
+    parser=argparse.ArgumentParser(
+        "bench_dmpcas_parser.py",
+        description="Compare the speed of the dmpcas parser against the original line-by-line parser."
+    )
+    parser.add_argument("dmpcas_file", nargs="?", default=None, help="dmpcas file to parse. If not given a synthetic one is generated.")
+    parser.add_argument("--num-times", default=400, type=int, help="Number of time blocks in a synthetic file.")
+    parser.add_argument("--repeats", default=5, type=int, help="Number of times to parse the file with each parser.")
+    
+    args=parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        if args.dmpcas_file is None:
+            src=Path(tmp) / "dmpcas.synthetic"
+            write_synthetic_dmpcas(src, args.num_times, 40, 10, 2)
+        else:
+            src=Path(args.dmpcas_file)
+
+        # Check they agree before timing
+        ref=dataset.dmpcas_parser_old.parse_dmpcas(src)
+        (times,observables,data)=read_dmpcas(src)
+        assert list(ref.keys())==list(times)
+        for (ti,t) in enumerate(times):
+            assert list(ref[t].keys())==list(observables)
+            assert np.array_equal(np.array(list(ref[t].values())), data[ti,:])
+
+        results={}
+        for (name,fn) in [
+            ("old", lambda: dataset.dmpcas_parser_old.parse_dmpcas(src)),
+            ("new", lambda: read_dmpcas(src)),
+            ("new+components", lambda: read_dmpcas(src, keep_components=True))
+        ]:
+            best=1e10
+            for i in range(args.repeats):
+                start=time.perf_counter()
+                fn()
+                best=min(best, time.perf_counter()-start)
+            results[name]=best
+            print(f"{name:>15} : {best*1000:8.2f} ms (best of {args.repeats})")
+        print(f"Speedup : {results['old']/results['new']:.2f}x")
@@ -1,6 +1,6 @@
 from .dmpci_template import DMPCITemplate, DMPCIParameter
 from .results_bundle import ResultsMatrix, Dataset, command_line_dataset_open_helper
-from .dmpcas_parser import parse_dmpcas
+from .dmpcas_parser import parse_dmpcas, parse_dmpcas_text, parse_dmpcas_streams
 
 __all__=[
     "DMPCITemplate",
@@ -8,5 +8,7 @@ __all__=[
     "ResultsMatrix",
     "Dataset",
     "parse_dmpcas",
+    "parse_dmpcas_text",
+    "parse_dmpcas_streams",
     "command_line_dataset_open_helper"
 ]
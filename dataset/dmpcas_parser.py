@@ -1,84 +1,197 @@
-import re
+import zipfile
 from pathlib import Path
 from typing import *
-import sqlite3
+from dataclasses import dataclass
 import numpy as np
 
 from .results_bundle import ResultsMatrix
 from .dmpci_template import DMPCITemplate, parameter_regex
 
-def parse_dmpcas(template:DMPCITemplate, exp_id:str, src_dir:Path, tags:str="") -> ResultsMatrix:
-    
-    with open(src_dir / f"dmpci.{exp_id}", "r") as s:
-        dmpci=s.read()
-
-    configuration=np.zeros( shape=(len(template.parameters),), dtype=np.float64 )
-    for (i,p) in enumerate(template.parameters.values()):
-        pattern=f"BIND-PARAMETER\s+{p.name}\s+([^\s]+)"
-        m = re.search(pattern, dmpci)
-        assert m, f"Couldn't find pattern '{pattern}'"
-        configuration[i]= float(m.group(1))
-
-    with open(src_dir / f"dmpcas.{exp_id}", "r") as f:
-        lines=f.readlines()
-
-    res={} # type: Dict[int, Dict[str,float]]
-    time=None
-    time_dict=None
-    time_list=[]
-    i=0
+@dataclass
+class DMPCASObservable:
+    """
+    One observable within a time block of a dmpcas file. Each observable is a name line,
+    followed by value lines of "mean sdev" pairs, followed by a blank line:
+    - scalar : one value line.
+    - vector : four value lines, for the x, y, z components then the magnitude.
+    - tensor : three value lines of three "mean sdev" pairs, for the rows of a 3x3 tensor.
+    """
+    name : str
+    kind : str    # One of "scalar", "vector", "tensor"
+    offset : int  # Line offset of the name from the "Time = " line of the block
+
+_value_lines={ "scalar":1, "vector":4, "tensor":3 }
+_vector_components=["x","y","z"]
+_tensor_components=[ r+c for r in "xyz" for c in "xyz" ]
+
+def _learn_dmpcas_layout(lines:List[str], begin:int) -> Tuple[List[DMPCASObservable],int]:
+    """
+    Works out the observables in the time block starting at lines[begin], and the number
+    of lines from one "Time = " line to the next.
+    """
+    res=[] # type: List[DMPCASObservable]
+    i=begin+1
     while i<len(lines):
         key=lines[i].strip()
         if key=="":
-            continue
-        
-        m=re.match("Time = ([0-9]+)", key)
-        if m:
-            time=int(m.group(1))
-            time_dict={} # type: Dict[str,float]
-            res[time]=time_dict
-            time_list.append(time)
             i += 1
             continue
+        if key.startswith("Time = "):
+            break
 
-        vals1=lines[i+1].split(None)
+        vals1=lines[i+1].split()
         if len(vals1)==6:
-            # this is a tensor. skip for now
-            assert len(lines[i+2].split())==6
-            assert len(lines[i+3].split())==6
-            assert lines[i+4].strip()==""
-            i += 5
-            continue
+            kind="tensor"
+        elif i+2>=len(lines) or lines[i+2].strip()=="":
+            kind="scalar"
+        else:
+            kind="vector"
+        n=_value_lines[kind]
+        for j in range(i+1,i+1+n):
+            assert len(lines[j].split())==(6 if kind=="tensor" else 2), f"At line {j}, expected values of {kind} '{key}', line = {lines[j]}"
+        res.append(DMPCASObservable(key, kind, i-begin))
+        i += 1+n+1
+    return (res, i-begin)
 
-        if lines[i+2].strip()=="":
-            # This is a scalar. Ignore the standard deviation
-            time_dict[key]=float(vals1[0])
-            i+=3
-            continue
+# Observable layouts that can be stored in a ResultsMatrix, mapped to (keep_components,keep_sdev)
+observable_layouts={
+    "compact" : (False,False), # Means of scalars and vector magnitudes only
+    "extended" : (True,True)   # Means and standard deviations of everything, including vector components and tensors
+}
+
+def _dmpcas_columns(layout:List[DMPCASObservable], keep_components:bool, keep_sdev:bool=False) -> Tuple[List[str],List[Tuple[int,int]]]:
+    """
+    Returns the output observable names, and for each one the (line offset, token index) of its value.
+
+    By default only scalar means and vector magnitudes are kept. With keep_components
+    the vector components are kept as "name.x" etc. and the tensor as "name.xx" etc.
+    With keep_sdev each mean is followed by its standard deviation, named with a ".sd" suffix.
+    """
+    names=[]
+    sources=[]
+    def add(name:str, off:int, tok:int):
+        names.append(name)
+        sources.append( (off, tok) )
+        if keep_sdev:
+            names.append(f"{name}.sd")
+            sources.append( (off, tok+1) )
+
+    for o in layout:
+        if o.kind=="scalar":
+            add(o.name, o.offset+1, 0)
+        elif o.kind=="vector":
+            if keep_components:
+                for (ci,c) in enumerate(_vector_components):
+                    add(f"{o.name}.{c}", o.offset+1+ci, 0)
+            add(o.name, o.offset+4, 0) # The magnitude
+        elif keep_components:
+            for (ci,c) in enumerate(_tensor_components):
+                add(f"{o.name}.{c}", o.offset+1+ci//3, 2*(ci%3))
+    return (names,sources)
+
+def parse_dmpcas_lines(lines:List[str], keep_components:bool=False, keep_sdev:bool=False) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+    """
+    Parses the lines of a dmpcas file into (times, observables, data), where data is nTimes x nObservables.
+
+    The layout of observables is learnt from the first time block, and every later block is
+    required to have the same layout. The lines for each observable are then gathered from all
+    blocks at once using their known offsets, and converted straight into the data array.
+    """
+    begin=0
+    while begin<len(lines) and not lines[begin].startswith("Time = "):
+        assert lines[begin].strip()=="", f"Expected 'Time = ' at line {begin}, got {lines[begin]}"
+        begin += 1
+    assert begin<len(lines), "No time blocks in dmpcas"
+
+    (layout,block_len)=_learn_dmpcas_layout(lines, begin)
+    (names,sources)=_dmpcas_columns(layout, keep_components, keep_sdev)
+    last_offset=max( [o.offset+_value_lines[o.kind] for o in layout], default=0 )
+
+    nBlocks=0
+    while begin+nBlocks*block_len+last_offset<len(lines) and lines[begin+nBlocks*block_len].startswith("Time = "):
+        nBlocks += 1
+    rest=begin+nBlocks*block_len
+    assert all( l.strip()=="" for l in lines[rest:] ), f"At line {rest}, expected a complete time block, got '{lines[rest]}'. Time blocks don't have the same layout as the first block."
+
+    all_lines=np.array(lines, dtype=object)
+    starts=begin+block_len*np.arange(nBlocks)
+    times=np.array([ int(l[7:]) for l in all_lines[starts] ], dtype=np.int32)
 
-        # This is a vector 
-        assert len(lines[i+2].split())==2, f"At line {i}, line = {lines[i+2]}"
-        assert len(lines[i+3].split())==2
-        assert len(lines[i+4].split())==2
-        assert lines[i+5].strip()==""
-        # Just put the vector magnitude in
-        vals4=lines[i+4].split()
-        time_dict[key]=float(vals4[0])
-        i+= 6
+    key_offsets=np.array([ o.offset for o in layout ], dtype=np.int64)
+    expected=np.array([ lines[begin+o.offset] for o in layout ], dtype=object)
+    found=all_lines[starts[:,None]+key_offsets[None,:]]
+    for (bi,ki) in zip(*np.nonzero(found!=expected[None,:])):
+        assert found[bi,ki].strip()==layout[ki].name, f"At line {starts[bi]+key_offsets[ki]}, expected observable '{layout[ki].name}', got '{found[bi,ki].strip()}'"
+
+    data=np.zeros( shape=(nBlocks,len(names)), dtype=np.float64 )
+    for tok in sorted(set( tok for (_,tok) in sources )):
+        cols=[ k for (k,(_,t)) in enumerate(sources) if t==tok ]
+        offsets=np.array([ sources[k][0] for k in cols ], dtype=np.int64)
+        selected=all_lines[starts[:,None]+offsets[None,:]].ravel().tolist()
+        if tok==0:
+            values=[ l.split(None,1)[0] for l in selected ]
+        else:
+            values=[ l.split()[tok] for l in selected ]
+        data[:,cols]=np.array(values, dtype=np.float64).reshape( (nBlocks,len(cols)) )
+
+    return (times, np.array(names, dtype=object), data)
+
+def _read_text(f:IO) -> str:
+    data=f.read()
+    if isinstance(data,bytes):
+        data=data.decode()
+    return data
+
+def read_dmpcas(src:Union[Path,IO], keep_components:bool=False, keep_sdev:bool=False) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+    """
+    Reads a dmpcas from a path, or from an open text or binary file-like object (e.g. ZipFile.open).
+    """
+    if isinstance(src,(str,Path)):
+        with open(src, "r") as f:
+            lines=f.read().splitlines()
+    else:
+        lines=_read_text(src).splitlines()
+    return parse_dmpcas_lines(lines, keep_components, keep_sdev)
+
+def parse_dmpcas_text(template:DMPCITemplate, exp_id:str, dmpci:str, dmpcas:str, tags:str="", observable_layout:str="compact") -> ResultsMatrix:
+    """
+    Builds the results bundle for one sample from the text of its dmpci and dmpcas files.
+    """
+    assert observable_layout in observable_layouts, f"Unknown observable layout '{observable_layout}'"
+
+    configuration=template.parse_configuration(dmpci)
+
+    (keep_components,keep_sdev)=observable_layouts[observable_layout]
+    (times,observables,data)=parse_dmpcas_lines(dmpcas.splitlines(), keep_components, keep_sdev)
 
     run_id=template.run_id
-    times=np.array(time_list, dtype=np.int32)
     parameters=np.array(list(template.parameters.keys()), dtype=object)
-    observables=np.array(list(time_dict.keys()), dtype=object)
     
     bundle=ResultsMatrix(run_id, parameters, observables, times)
-
-    data=np.ndarray(shape=(len(times), len(observables)), dtype=np.float64 )
-    for tindex in range(0,times.shape[0]):
-        os=res[times[tindex]]
-        assert np.all( observables==np.array(list(os.keys()), dtype=object) ), f"ref={observables}, got={os.keys()}"
-        data[tindex,:]=np.array(list(os.values()))
-
     bundle.add_experiment(exp_id, configuration, data, tags)
 
     return bundle
+
+def parse_dmpcas_streams(template:DMPCITemplate, exp_id:str, dmpci:IO, dmpcas:IO, tags:str="", observable_layout:str="compact") -> ResultsMatrix:
+    """
+    As parse_dmpcas_text, but reads from open text or binary file-like objects.
+    """
+    return parse_dmpcas_text(template, exp_id, _read_text(dmpci), _read_text(dmpcas), tags, observable_layout)
+
+def parse_dmpcas(template:DMPCITemplate, exp_id:str, src:Union[Path,zipfile.ZipFile], tags:str="", observable_layout:str="compact",
+        dmpci_member:Optional[str]=None, dmpcas_member:Optional[str]=None) -> ResultsMatrix:
+    """
+    Parses the dmpci and dmpcas of one sample, from either a directory or an open sample zip.
+
+    For a zip the members default to the layout of sample zips ("{exp_id}/dmpci.{exp_id}"), and
+    are read straight out of the archive, so nothing is extracted to the filesystem.
+    """
+    if isinstance(src, zipfile.ZipFile):
+        dmpci_member = dmpci_member or f"{exp_id}/dmpci.{exp_id}"
+        dmpcas_member = dmpcas_member or f"{exp_id}/dmpcas.{exp_id}"
+        with src.open(dmpci_member) as dmpci, src.open(dmpcas_member) as dmpcas:
+            return parse_dmpcas_streams(template, exp_id, dmpci, dmpcas, tags, observable_layout)
+
+    src=Path(src)
+    with open(src / (dmpci_member or f"dmpci.{exp_id}"), "r") as dmpci, open(src / (dmpcas_member or f"dmpcas.{exp_id}"), "r") as dmpcas:
+        return parse_dmpcas_streams(template, exp_id, dmpci, dmpcas, tags, observable_layout)
@@ -4,6 +4,7 @@ import random
 import re
 from pathlib import Path
 from collections import OrderedDict
+import numpy as np
 
 parameter_regex="[a-zA-Z_][a-zA-Z0-9_]+"
 
@@ -66,6 +67,67 @@ class DMPCITemplate:
             res[p.name] = str(p.generate(rng))
         return res
     
+    def parameter_ranges(self) -> Tuple[np.ndarray,np.ndarray]:
+        """
+        Returns (lo,hi), the minval and maxval of each parameter in template order.
+        """
+        lo=np.array([p.minval for p in self.parameters.values()], dtype=np.float64)
+        hi=np.array([p.maxval for p in self.parameters.values()], dtype=np.float64)
+        return (lo,hi)
+
+    def normalise(self, configurations:np.ndarray) -> np.ndarray:
+        """
+        Maps parameter values (columns in template order) into the unit cube, with each
+        parameter's [minval,maxval] mapped to [0,1].
+        """
+        return DMPCITemplate.normalise_ranges(configurations, *self.parameter_ranges())
+
+    @staticmethod
+    def normalise_ranges(configurations:np.ndarray, lo:np.ndarray, hi:np.ndarray) -> np.ndarray:
+        """
+        As normalise, for ranges saved from a template. A parameter with minval==maxval is only
+        shifted, so it maps to 0.
+        """
+        return (np.asarray(configurations, dtype=np.float64)-lo) / np.where(hi>lo, hi-lo, 1)
+
+    def denormalise(self, unit:np.ndarray) -> np.ndarray:
+        """
+        Maps points in the unit cube [0,1) (columns in template order) to parameter values.
+        INTEGER parameters split [0,1) into equal strata for minval..maxval inclusive, as with create_parameters.
+        """
+        unit=np.asarray(unit, dtype=np.float64)
+        res=np.zeros_like(unit)
+        for (i,p) in enumerate(self.parameters.values()):
+            u=unit[...,i]
+            if p.type=="INTEGER":
+                n=int(p.maxval)-int(p.minval)+1
+                res[...,i]=int(p.minval) + np.clip(np.floor(u*n), 0, n-1)
+            else:
+                res[...,i]=p.minval + u*(p.maxval-p.minval)
+        return res
+
+    def parse_configuration(self, dmpci:str) -> np.ndarray:
+        """
+        Recovers the parameter values (in template order) from the text of a dmpci created by substitute_parameters.
+        """
+        configuration=np.zeros( shape=(len(self.parameters),), dtype=np.float64 )
+        for (i,p) in enumerate(self.parameters.values()):
+            pattern=f"BIND-PARAMETER\\s+{p.name}\\s+([^\\s]+)"
+            m = re.search(pattern, dmpci)
+            assert m, f"Couldn't find pattern '{pattern}'"
+            configuration[i]= float(m.group(1))
+        return configuration
+
+    def bindings_from_unit(self, unit:np.ndarray) -> Dict[str,str]:
+        """
+        Converts one point of the unit cube into bindings for substitute_parameters.
+        """
+        values=self.denormalise(unit)
+        res={}
+        for (i,p) in enumerate(self.parameters.values()):
+            res[p.name] = str(int(values[i])) if p.type=="INTEGER" else str(float(values[i]))
+        return res
+
     def substitute_parameters(self, bindings:Dict[str,str]) -> str:
         res=str(self.body)  
         
@@ -0,0 +1,33 @@
+from typing import *
+import re
+import subprocess
+from pathlib import Path
+
+default_width=800
+default_height=600
+
+def pov_snapshot_time(name:str) -> Optional[int]:
+    """
+    Returns the time of a dpd snapshot file named like "dmpccs.{ID}.con.{TIME}.pov" (optionally
+    with a compression suffix), or None if the name doesn't look like a snapshot.
+    """
+    m=re.search(r"\.con\.([0-9]+)\.pov(\.bz2)?$", name)
+    return int(m.group(1)) if m else None
+
+def render_pov(pov:Path, width:int=default_width, height:int=default_height, povray:str="povray") -> Path:
+    """
+    Renders pov with povray into a png next to it (same name with the extension replaced), logging
+    povray's output to pov.name+".povray.log". Returns the path of the png, which doesn't exist if
+    povray failed.
+    """
+    with open( pov.parent / (pov.name+".povray.log"), "wt") as log_dst:
+        subprocess.run(
+            [povray, f"{str(pov.name)}",
+                f"-W{width}", f"-H{height}",
+                "-D"  # Turn of display
+            ],
+            cwd=str(pov.parent),
+            stdout=log_dst,
+            stderr=subprocess.STDOUT
+        )
+    return pov.with_suffix(".png")
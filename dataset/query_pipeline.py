@@ -0,0 +1,164 @@
+from typing import *
+import sys
+import time
+import queue
+import threading
+import collections
+from dataclasses import dataclass
+import numpy as np
+
+class QueryCancelled(Exception):
+    """
+    Raised by a query function to abandon work for a target that has been superseded.
+    """
+    pass
+
+@dataclass
+class QueryFrame:
+    generation : int
+    target : Any
+    result : Any
+    error : Optional[BaseException]
+    first_posted : float # When the oldest of the targets coalesced into this one was posted
+    started : float
+    finished : float
+
+class QueryPipeline:
+    """
+    Runs queries for a stream of targets (e.g. slider positions) on a background thread, so that the UI
+    thread only ever posts targets and applies finished results.
+
+    - post() records the latest target. Targets posted in quick succession are coalesced, and only the
+      most recent is queried, once no new target has arrived for debounce seconds (or max_delay has passed
+      since the oldest waiting target, so that a continuous drag still updates).
+    - The query function gets the target and a cancelled() callable. It should check cancelled() between
+      expensive steps and raise QueryCancelled if it returns True, which happens once a newer target has
+      been posted. Work is never cancelled if nothing has been shown for max_delay, so a long drag still
+      shows intermediate results.
+    - poll() must be called regularly on the UI thread, and applies the newest finished result.
+
+    The latency from posting a target to its result being applied is recorded for every frame. If applying
+    a result only starts loading what it shows (e.g. images), the UI should also call displayed() once the
+    frame is fully visible, which records a second latency up to that point.
+    """
+    def __init__(self, query:Callable[[Any,Callable[[],bool]],Any], debounce:float=0.02, max_delay:float=0.25, name:str="query"):
+        self.query=query
+        self.debounce=debounce
+        self.max_delay=max_delay
+        self.name=name
+
+        self._cond=threading.Condition()
+        self._generation=0
+        self._pending=None # type: Optional[Tuple[int,Any]]
+        self._first_posted=0.0
+        self._last_posted=0.0
+        self._last_delivered=time.time()
+        self._closed=False
+        self._results=queue.Queue() # type: queue.Queue[QueryFrame]
+
+        self.frames=0
+        self.superseded=0 # Queries that were cancelled or whose results were never shown
+        self.latencies=collections.deque(maxlen=1000) # type: Deque[float]
+        self.query_times=collections.deque(maxlen=1000) # type: Deque[float]
+        self.display_latencies=collections.deque(maxlen=1000) # type: Deque[float]
+        self.applied=None # type: Optional[QueryFrame]
+
+        self._thread=threading.Thread(target=self._run, name=f"{name}-pipeline", daemon=True)
+        self._thread.start()
+
+    def post(self, target:Any):
+        now=time.time()
+        with self._cond:
+            self._generation+=1
+            if self._pending is None:
+                self._first_posted=now
+            self._pending=(self._generation, target)
+            self._last_posted=now
+            self._cond.notify()
+
+    def close(self):
+        with self._cond:
+            self._closed=True
+            self._cond.notify()
+        self._thread.join()
+
+    def _is_cancelled(self, generation:int) -> bool:
+        return self._generation!=generation and time.time()-self._last_delivered < self.max_delay
+
+    def _count_superseded(self):
+        # Counted from both the pipeline thread and the UI thread
+        with self._cond:
+            self.superseded+=1
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._pending is None and not self._closed:
+                    self._cond.wait()
+                while not self._closed:
+                    now=time.time()
+                    wait=min(self._last_posted+self.debounce, self._first_posted+self.max_delay)-now
+                    if wait<=0:
+                        break
+                    self._cond.wait(wait)
+                if self._closed:
+                    return
+                (generation,target)=self._pending
+                first_posted=self._first_posted
+                self._pending=None
+
+            started=time.time()
+            error=None
+            result=None
+            try:
+                result=self.query(target, lambda: self._is_cancelled(generation))
+            except QueryCancelled:
+                self._count_superseded()
+                continue
+            except Exception as e:
+                error=e
+            if self._is_cancelled(generation):
+                self._count_superseded()
+                continue
+            self._last_delivered=time.time()
+            self._results.put(QueryFrame(generation, target, result, error, first_posted, started, time.time()))
+
+    def poll(self, apply:Callable[[Any,Any],None]) -> Optional[QueryFrame]:
+        """
+        Applies the newest finished result with apply(target,result), on the calling (UI) thread.
+        Older finished results are skipped. Returns the frame that was applied, if any.
+        """
+        frame=None
+        while not self._results.empty():
+            if frame is not None:
+                self._count_superseded()
+            frame=self._results.get()
+        if frame is None:
+            return None
+        if frame.error is not None:
+            sys.stderr.write(f"{self.name} failed : {type(frame.error).__name__}: {frame.error}\n")
+        else:
+            self.applied=frame
+            apply(frame.target, frame.result)
+        self.frames+=1
+        self.latencies.append(time.time()-frame.first_posted)
+        self.query_times.append(frame.finished-frame.started)
+        return frame
+
+    def displayed(self):
+        """
+        Records that everything shown by the last applied frame is now visible. Can be called from within apply.
+        """
+        if self.applied is not None:
+            self.display_latencies.append(time.time()-self.applied.first_posted)
+
+    def summary(self) -> str:
+        if len(self.latencies)==0:
+            return f"{self.name}: no frames yet"
+        (p50,p95)=np.percentile(self.latencies, [50,95])*1000
+        query=np.median(self.query_times)*1000
+        res=f"{self.name}: latency p50 {p50:.0f}ms p95 {p95:.0f}ms max {max(self.latencies)*1000:.0f}ms, query {query:.0f}ms, {self.frames} frames, {self.superseded} superseded"
+        if len(self.display_latencies)>0:
+            (p50,p95)=np.percentile(self.display_latencies, [50,95])*1000
+            res+=f", shown p50 {p50:.0f}ms p95 {p95:.0f}ms max {max(self.display_latencies)*1000:.0f}ms"
+        return res
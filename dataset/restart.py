@@ -0,0 +1,75 @@
+"""
+Support for running one sample as a sequence of dpd runs ("segments"), each continuing from
+the latest restart state of the previous one, so a sample can span several job allocations.
+
+This assumes the osprey dpd conventions:
+- Restart states are written every RestartPeriod steps to files ending in ".{TIME}.rst" whose
+  name contains the run id of the run that wrote them, e.g. "dmpcrs.{RUNID}.con.{TIME}.rst".
+- A run continues from a restart state if its "State random" line is replaced with
+  "State restart", "RunId {RUNID}" and "StateId {TIME}".
+- A continued run writes dmpcas time blocks only for times after the restart time.
+"""
+from typing import *
+import re
+from pathlib import Path
+from dataclasses import dataclass
+
+_restart_time_regex=re.compile(r"\.(\d+)\.rst$")
+_state_regex=re.compile(r"^([ \t]*)State[ \t]+random[ \t]*$", re.MULTILINE)
+
+@dataclass
+class RestartState:
+    run_id : str
+    time : int
+    path : Path
+
+def find_latest_restart(dir:Path, run_ids:List[str]) -> Optional[RestartState]:
+    """
+    Finds the restart state with the latest time written by any of the given runs.
+    """
+    best=None # type: Optional[RestartState]
+    for f in dir.glob("*.rst"):
+        m=_restart_time_regex.search(f.name)
+        if not m:
+            continue
+        # Prefer the longest matching id, as later segment ids contain the first one
+        owners=[ r for r in run_ids if f".{r}." in f.name ]
+        if len(owners)==0:
+            continue
+        state=RestartState(max(owners, key=len), int(m.group(1)), f)
+        if best is None or state.time>best.time:
+            best=state
+    return best
+
+def make_restart_dmpci(dmpci:str, state:RestartState) -> str:
+    """
+    Converts the dmpci of a sample into one that continues from the given restart state.
+    """
+    (res,n)=_state_regex.subn(lambda m: f"{m.group(1)}State restart\n{m.group(1)}    RunId {state.run_id}\n{m.group(1)}    StateId {state.time}", dmpci)
+    assert n==1, f"Expected exactly one 'State random' line in dmpci to replace with a restart, found {n}"
+    return res
+
+def _split_dmpcas_blocks(text:str) -> List[Tuple[int,str]]:
+    res=[] # type: List[Tuple[int,str]]
+    for part in re.split(r"(?m)^(?=Time = )", text):
+        if part.startswith("Time = "):
+            res.append( (int(part[7:part.index("\n")] if "\n" in part else part[7:]), part) )
+    return res
+
+def join_dmpcas_segments(segments:List[str], restart_times:List[int]) -> str:
+    """
+    Joins the dmpcas text of consecutive segments, where segment i+1 continued from the
+    restart state at restart_times[i]. Blocks that segment i wrote after that time are
+    discarded, as they were re-done by the next segment. Joining is idempotent, so the
+    result can safely replace the text of the first segment.
+    """
+    assert len(restart_times)==len(segments)-1
+    res=[] # type: List[str]
+    for (i,text) in enumerate(segments):
+        limit=restart_times[i] if i<len(restart_times) else None
+        for (time,block) in _split_dmpcas_blocks(text):
+            if limit is None or time<=limit:
+                if not block.endswith("\n"):
+                    block += "\n"
+                res.append(block)
+    return "".join(res)
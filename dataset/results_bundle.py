@@ -12,13 +12,143 @@ import io
 import sys
 import tempfile
 import math
+import time
+import multiprocessing
+from dataclasses import dataclass
 
 from .dmpci_template import DMPCITemplate, DMPCIParameter
+from .spatial_index import SpatialIndex
 
 def _is_vector_of(x, dtype):
     return len(x.shape)==1 and x.dtype==dtype
 
 
+@dataclass
+class BundleRows:
+    """
+    The header and experiment rows of a results file as plain numpy arrays, without
+    any of the indices that ResultsMatrix builds. This is cheap to pickle, so is used
+    to return decoded bundles from worker processes.
+    """
+    run_id : str
+    parameters : np.ndarray
+    observables : np.ndarray
+    times : np.ndarray
+    experiments : np.ndarray
+    tags : np.ndarray
+    configurations : np.ndarray
+    data : np.ndarray
+
+    @staticmethod
+    def read(h5_path:Union[str,Path,io.BytesIO]) -> "BundleRows":
+        with h5py.File(h5_path, mode="r") as src:
+            # Files written before the append format have no commit marker, and all rows are valid
+            n=int(src.attrs.get("committed_experiments", src["experiments"].shape[0]))
+            return BundleRows(
+                src.attrs["run_id"],
+                np.array(src["parameters"].asstr(), dtype=object),
+                np.array(src["observables"].asstr(), dtype=object),
+                np.array(src["times"], dtype=np.int32),
+                np.array(src["experiments"].asstr()[0:n], dtype=object),
+                np.array(src["tags"].asstr()[0:n], dtype=object),
+                np.array(src["configurations"][0:n], dtype=np.float64),
+                np.array(src["data"][0:n], dtype=np.float64)
+            )
+
+    @staticmethod
+    def concatenate(blocks:List["BundleRows"]) -> "BundleRows":
+        assert len(blocks)>0
+        first=blocks[0]
+        for b in blocks[1:]:
+            assert b.run_id==first.run_id
+            assert np.all(b.parameters==first.parameters)
+            assert np.all(b.observables==first.observables)
+            assert np.all(b.times==first.times)
+        if len(blocks)==1:
+            return first
+        return BundleRows(
+            first.run_id, first.parameters, first.observables, first.times,
+            np.concatenate([b.experiments for b in blocks]),
+            np.concatenate([b.tags for b in blocks]),
+            np.concatenate([b.configurations for b in blocks]),
+            np.concatenate([b.data for b in blocks])
+        )
+
+
+def load_bundle_rows_from_zips(paths:List[Path]) -> BundleRows:
+    """
+    Reads the results embedded in a list of sample zips (sample_ID.zip containing sample_ID/sample_ID.hdf5)
+    into a single block of rows. This is the unit of work for parallel merging.
+    """
+    blocks=[]
+    for p in paths:
+        v = p.name[:-4]
+        with zipfile.ZipFile(p) as zsrc:
+            blocks.append( BundleRows.read( io.BytesIO(zsrc.read(f"{v}/{v}.hdf5")) ) )
+    return BundleRows.concatenate(blocks)
+
+
+class LazyRowArray:
+    """
+    Read-only array-like view of the first `n` rows of a dataset in a hdf5 file.
+
+    Indexing reads just the selected rows from the file, so that tools that only touch
+    a few experiments (or none) don't pull the whole data cube into memory. Converting
+    with np.asarray reads all n rows.
+
+    The file is only open while rows are being read, so that it doesn't stop dataset_merge.py
+    (or a flush in the same process) from appending to it. Appends never change the first n
+    rows, and neither does swapping in a rewritten file, so the view stays valid.
+    """
+    def __init__(self, path:Path, name:str, n:int, shape:Tuple[int,...], dtype:np.dtype):
+        self.path=path
+        self.name=name
+        self.shape=(n,)+tuple(shape[1:])
+        self.dtype=dtype
+        self.ndim=len(self.shape)
+
+    def _read(self, selection):
+        with h5py.File(self.path, mode="r") as src:
+            return src[self.name][selection]
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def __array__(self, dtype=None, copy=None):
+        return np.asarray(self._read(slice(0,self.shape[0])), dtype=dtype)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple):
+            key=(key,)
+        (rows,rest)=(key[0],key[1:])
+        n=self.shape[0]
+        if isinstance(rows, slice):
+            rows=slice(*rows.indices(n))
+            if rows.step!=1:
+                # h5py only supports contiguous slices
+                rows=np.arange(rows.start, rows.stop, rows.step)
+        elif isinstance(rows, (int,np.integer)):
+            rows=int(rows)
+            if rows<0:
+                rows+=n
+            if rows<0 or rows>=n:
+                raise IndexError(f"Row {key[0]} out of range for {n} rows")
+        if isinstance(rows, (slice,int)):
+            if all( isinstance(k,(slice,int,np.integer)) for k in rest ):
+                return self._read((rows,)+rest)
+            return self._read(rows)[(slice(None),)*(0 if isinstance(rows,int) else 1)+rest]
+        
+        # h5py needs point selections to be increasing and unique, so read the unique rows then expand
+        rows=np.asarray(rows)
+        if rows.dtype==bool:
+            rows=np.nonzero(rows[0:n])[0]
+        rows=np.where(rows<0, rows+n, rows)
+        if np.any(rows<0) or np.any(rows>=n):
+            raise IndexError(f"Rows out of range for {n} rows")
+        (unique,inverse)=np.unique(rows, return_inverse=True)
+        return self._read(unique)[(inverse,)+rest]
+
+
 class ResultsMatrix:
     """
     The result of one experiment is a 2d nTimes * nObservables matrix
@@ -26,6 +156,7 @@ class ResultsMatrix:
     """
 
     def _ensure_experiment_space(self, n:int):
+        assert not self.read_only, "Can't add experiments to a read-only matrix"
         if self.nExperiments+n > self.experiment_capacity:
             new_capacity=max( self.nExperiments+10, self.nExperiments+n, int(self.experiment_capacity*3/2) )
             self.experiments.resize( (new_capacity,) )
@@ -64,6 +195,39 @@ class ResultsMatrix:
         self.configurations=np.zeros( shape=(self.experiment_capacity, self.nParameters), dtype=np.float64 )
         self.data=np.zeros( shape=(self.experiment_capacity, self.nTimes, self.nObservables), dtype=np.float64 )
 
+        self.read_only=False
+
+    def _index_experiments(self, begin:int, end:int):
+        for i in range(begin,end):
+            self.experiments_index[self.experiments[i]]=i
+            for tag in self.tags[i].split(";"):
+                if tag !="" :
+                    self.tags_to_indices.setdefault(tag, []).append(i)
+
+    @staticmethod
+    def _from_rows(rows:BundleRows) -> "ResultsMatrix":
+        """
+        Takes ownership of the arrays in rows as the storage for a new matrix, rather than copying them.
+        """
+        n=rows.experiments.shape[0]
+        res=ResultsMatrix(rows.run_id, rows.parameters, rows.observables, rows.times, reserve_exp=0)
+        res.experiment_capacity=n
+        res.experiments=rows.experiments
+        res.tags=rows.tags
+        res.configurations=rows.configurations
+        res.data=rows.data
+        res._index_experiments(0, n)
+        res.nExperiments=n
+        return res
+
+    @property
+    def observable_layout(self) -> str:
+        """
+        "extended" if the observables include standard deviations and components (see
+        dmpcas_parser.observable_layouts), otherwise "compact".
+        """
+        return "extended" if any( str(o).endswith(".sd") for o in self.observables ) else "compact"
+
     def __contains__(self, experiment_name:str) -> bool:
         return experiment_name in self.experiments_index    
 
@@ -135,33 +299,127 @@ class ResultsMatrix:
 
         return self.add_experiments(other.experiments[0:other.nExperiments], other.configurations[0:other.nExperiments,:], other.data[0:other.nExperiments,:,:], other.tags[0:other.nExperiments])
 
+    # Datasets that grow along the experiment axis. They are always written chunked and
+    # with maxshape=None along axis 0, so that new experiments can be appended in place.
+    _experiment_axis_datasets=["experiments", "tags", "configurations", "data"]
+
+    def _experiment_axis_arrays(self, begin:int, end:int) -> Dict[str,np.ndarray]:
+        return {
+            "experiments":self.experiments[begin:end],
+            "tags":self.tags[begin:end],
+            "configurations":self.configurations[begin:end,:],
+            "data":self.data[begin:end,:,:]
+        }
+
+    def add_rows(self, rows:BundleRows) -> int:
+        assert np.all(self.parameters==rows.parameters)
+        assert np.all(self.times==rows.times)
+        assert self.observables.shape==rows.observables.shape and np.all(self.observables==rows.observables), f"Observables of {rows.experiments[0:1]} don't match the matrix. Was it parsed with a different observable layout? Matrix has {self.observables}, bundle has {rows.observables}"
+
+        return self.add_experiments(rows.experiments, rows.configurations, rows.data, rows.tags)
+
     def save(self, h5_path:Union[str,io.FileIO]):
+        """
+        Writes the whole matrix to a new file.
+
+        The experiment axis datasets are resizable, and the attribute "committed_experiments"
+        records how many rows are valid, so the file can later be extended with append_to.
+        """
         with h5py.File(h5_path, mode='w') as dst:
             dst.attrs["run_id"]=self.run_id
             dst["parameters"]=self.parameters
             dst["observables"]=self.observables
             dst["times"]=self.times
-            dst["experiments"]=self.experiments[0:self.nExperiments]
-            print(self.tags)
-            dst["tags"]=self.tags[0:self.nExperiments]
-            dst["configurations"]=self.configurations[0:self.nExperiments,:]
-            dst["data"]=self.data[0:self.nExperiments,:,:]
+            # Aim for chunks of ~512KB for the data cube, as recommended by h5py. Chunks don't depend on
+            # the current number of experiments, as they can't be changed when appending, and chunks
+            # can be bigger than the dataset as the experiment axis is resizable.
+            data_row_bytes=max(1, self.nTimes*self.nObservables*8)
+            data_chunk_rows=max(1, min(1024, (512*1024)//data_row_bytes))
+            for (name,values) in self._experiment_axis_arrays(0, self.nExperiments).items():
+                chunk_rows = data_chunk_rows if name=="data" else 1024
+                # The data cube can be large with the extended observable layout, and many observables
+                # (e.g. standard deviations) vary slowly, so it is worth compressing
+                compression = dict(compression="gzip", compression_opts=4, shuffle=True) if name=="data" else {}
+                dst.create_dataset(
+                    name,
+                    data=values,
+                    dtype=h5py.string_dtype() if values.dtype==object else values.dtype,
+                    maxshape=(None,)+values.shape[1:],
+                    chunks=(chunk_rows,)+values.shape[1:],
+                    **compression
+                )
+            dst.attrs["committed_experiments"]=self.nExperiments
 
     @staticmethod
-    def load(h5_path:str):
+    def can_append_to(h5_path:Path, committed:int) -> bool:
+        """
+        Checks whether h5_path was written by save in the resizable format, and currently has
+        exactly `committed` committed experiments.
+        """
+        if not Path(h5_path).is_file():
+            return False
         with h5py.File(h5_path, mode="r") as src:
-            run_id=src.attrs["run_id"]
-            parameters=np.array(src["parameters"].asstr(), dtype=object)
-            observables=np.array(src["observables"].asstr(), dtype=object)
-            times=np.array(src["times"], dtype=np.int32)
-            experiments=np.array(src["experiments"].asstr(), dtype=object)
-            tags=np.array(src["tags"].asstr(), dtype=object)
-            configurations=np.array(src["configurations"], dtype=np.float64)
-            data=np.array(src["data"], dtype=np.float64)
+            if int(src.attrs.get("committed_experiments",-1)) != committed:
+                return False
+            return all( src[name].maxshape[0] is None for name in ResultsMatrix._experiment_axis_datasets )
+
+    def append_to(self, h5_path:Path, begin:int) -> int:
+        """
+        Appends experiments [begin,nExperiments) to a file previously written by save or append_to,
+        which must contain exactly the first `begin` experiments of this matrix.
+
+        Rows are written first, and only then is "committed_experiments" updated. If the process dies
+        part way through then the rows past the old commit point are ignored by load, and are
+        overwritten by the next append.
+        """
+        assert begin <= self.nExperiments
+        with h5py.File(h5_path, mode="r+") as dst:
+            assert dst.attrs["run_id"]==self.run_id
+            assert np.all( np.array(dst["parameters"].asstr(), dtype=object)==self.parameters )
+            assert np.all( np.array(dst["observables"].asstr(), dtype=object)==self.observables )
+            assert np.all( np.array(dst["times"], dtype=np.int32)==self.times )
+            assert int(dst.attrs["committed_experiments"])==begin, f"File {h5_path} has {dst.attrs['committed_experiments']} committed experiments, expected {begin}"
+            
+            end=self.nExperiments
+            for (name,values) in self._experiment_axis_arrays(begin, end).items():
+                ds=dst[name]
+                ds.resize(end, axis=0)
+                ds[begin:end]=values
+            dst.flush()
             
-            res=ResultsMatrix(run_id, parameters, observables, times, reserve_exp=experiments.shape[0])
-            res.add_experiments(experiments, configurations, data, tags)
-            return res
+            dst.attrs["committed_experiments"]=end
+            dst.flush()
+        return end-begin
+
+    @staticmethod
+    def load(h5_path:str, lazy:bool=False):
+        """
+        Loads a matrix written by save.
+
+        If lazy is set the matrix is read-only: experiments, tags and configurations are read
+        immediately, but data is a LazyRowArray that reads slices from the file on demand.
+        """
+        if not lazy:
+            return ResultsMatrix._from_rows(BundleRows.read(h5_path))
+
+        with h5py.File(h5_path, mode="r") as src:
+            n=int(src.attrs.get("committed_experiments", src["experiments"].shape[0]))
+            res=ResultsMatrix(
+                src.attrs["run_id"],
+                np.array(src["parameters"].asstr(), dtype=object),
+                np.array(src["observables"].asstr(), dtype=object),
+                np.array(src["times"], dtype=np.int32),
+                reserve_exp=0
+            )
+            res.experiment_capacity=n
+            res.experiments=np.array(src["experiments"].asstr()[0:n], dtype=object)
+            res.tags=np.array(src["tags"].asstr()[0:n], dtype=object)
+            res.configurations=np.array(src["configurations"][0:n], dtype=np.float64)
+            res.data=LazyRowArray(Path(h5_path), "data", n, src["data"].shape, src["data"].dtype)
+        res._index_experiments(0, n)
+        res.nExperiments=n
+        res.read_only=True
+        return res
         
     def load_from_zip(src:Union[Path,zipfile.ZipFile], internal_path:str):
         if not isinstance(src,zipfile.ZipFile):
@@ -174,66 +432,260 @@ class ResultsMatrix:
         return ResultsMatrix.load( io.BytesIO(bytes) )
 
 
+@dataclass
+class SampleManifestEntry:
+    size : int
+    mtime_ns : int
+    merged : bool   # True if the sample is contained in the persisted {id}.hdf5
+
+
+class SampleManifest:
+    """
+    Records which sample zips in a dataset directory have already been merged, so that opening
+    a dataset doesn't need to look inside (or even stat) every sample zip.
+
+    Stored as a tab-separated text file "{id}.manifest" next to "{id}.hdf5". Sample zips are
+    written once and atomically renamed into the dataset, so a merged entry is never re-checked.
+    The directory mtime seen before the last scan is also recorded, so if nothing has been added
+    or removed since then the directory doesn't need to be listed at all.
+
+    The manifest is rewritten in place rather than swapped in, as creating a file would itself
+    change the directory mtime. A torn write is detected by the missing end marker, in which case
+    the manifest is ignored and the directory is scanned again.
+    """
+    _header="# dpd-exploration sample manifest v1"
+    _footer="# end"
+
+    def __init__(self, path:Path):
+        self.path=path
+        self.directory_mtime_ns=None # type: Optional[int]
+        self.entries={} # type: Dict[str,SampleManifestEntry]
+        self.dirty=False
+        if not path.is_file():
+            return
+        with open(path, "rt") as src:
+            lines=src.read().splitlines()
+        if len(lines)<3 or lines[0]!=SampleManifest._header or lines[-1]!=SampleManifest._footer:
+            sys.stderr.write(f"Ignoring manifest {path} with unknown format or incomplete write\n")
+            return
+        m=re.match("# directory_mtime_ns ([0-9]+)$", lines[1])
+        assert m, f"Couldn't parse line 2 of manifest {path}"
+        self.directory_mtime_ns=int(m.group(1))
+        for l in lines[2:-1]:
+            (name,size,mtime_ns,merged)=l.split("\t")
+            self.entries[name]=SampleManifestEntry(int(size), int(mtime_ns), merged=="1")
+
+    def all_merged(self) -> bool:
+        return all( e.merged for e in self.entries.values() )
+
+    def save(self):
+        lines=[SampleManifest._header, f"# directory_mtime_ns {self.directory_mtime_ns}"]
+        for (name,e) in self.entries.items():
+            lines.append(f"{name}\t{e.size}\t{e.mtime_ns}\t{1 if e.merged else 0}")
+        lines.append(SampleManifest._footer)
+        with open(self.path, "wt") as dst:
+            dst.write("\n".join(lines)+"\n")
+        self.dirty=False
+
+
 class Dataset:
-    def merge_run_bundles(self) -> int:
+    def merge_run_bundles(self, jobs:int=1) -> int:
+        """
+        Adds any sample zips in the dataset directory that are not yet in the matrix.
+
+        With jobs>1 the zips are decoded in a pool of worker processes, each returning
+        a block of rows which is added to the matrix in one batch.
+        """
+        assert not self.read_only, "Can't merge into a dataset opened read-only"
+
+        # Capture the directory mtime before listing, so anything arriving during the scan makes the manifest stale
+        directory_mtime_ns=self.dir.stat().st_mtime_ns
+        if directory_mtime_ns==self.manifest.directory_mtime_ns and self.manifest.all_merged():
+            return 0
+
+        todo=[] # type: List[Path]
+        seen=set()
+        with os.scandir(self.dir) as it:
+            for entry in it:
+                if not (entry.name.startswith("sample_") and entry.name.endswith(".zip")):
+                    continue
+                seen.add(entry.name)
+                known=self.manifest.entries.get(entry.name)
+                if known is not None and known.merged:
+                    continue
+
+                #v = p.name.removesuffix(".zip")
+                v = entry.name[:-4]
+                st=entry.stat()
+                self.manifest.entries[entry.name]=SampleManifestEntry(st.st_size, st.st_mtime_ns, False)
+                self.manifest.dirty=True
+                if self.matrix and v in self.matrix:
+                    continue
+                todo.append(Path(entry.path))
+
+        for name in list(self.manifest.entries.keys()):
+            if name not in seen:
+                del self.manifest.entries[name]
+                self.manifest.dirty=True
+        if self.manifest.directory_mtime_ns!=directory_mtime_ns:
+            self.manifest.directory_mtime_ns=directory_mtime_ns
+            self.manifest.dirty=True
+
+        if len(todo)==0:
+            return 0
+
+        start=time.time()
+        if self.matrix is not None:
+            self.matrix._ensure_experiment_space(len(todo))
+        # Enough blocks that workers stay busy, but big enough to amortise the pickling of each result
+        block_size=max(1, min(256, math.ceil(len(todo)/(4*jobs))))
+        blocks=[ todo[i:i+block_size] for i in range(0,len(todo),block_size) ]
         added=0
-        for p in self.dir.glob("sample_*.zip"):
-            #v = p.name.removesuffix(".zip")
-            v = p.name[:-4]
-            if self.matrix and v in self.matrix:
-                continue
-
-            vb = ResultsMatrix.load_from_zip(p, f"{v}/{v}.hdf5")
-            if self.matrix == None:
-                self.matrix = vb
-                self.matrix_dirty_count=vb.nExperiments
-            else:
-                done = self.matrix.add_bundle(vb)
-                self.matrix_dirty_count += done
-                added += done
+        if jobs>1 and len(blocks)>1:
+            with multiprocessing.Pool(processes=min(jobs,len(blocks))) as pool:
+                for rows in pool.imap_unordered(load_bundle_rows_from_zips, blocks):
+                    added += self._add_rows(rows, len(todo))
+        else:
+            for block in blocks:
+                added += self._add_rows(load_bundle_rows_from_zips(block), len(todo))
+        elapsed=max(1e-9, time.time()-start)
+        sys.stderr.write(f"Merged {added} new samples from {len(todo)} zips in {elapsed:.2f} secs ({len(todo)/elapsed:.1f} samples/sec, jobs={jobs})\n")
         return added
 
+    def _add_rows(self, rows:BundleRows, reserve_exp:int) -> int:
+        if self.matrix is None:
+            self.matrix=ResultsMatrix(rows.run_id, rows.parameters, rows.observables, rows.times, reserve_exp=reserve_exp)
+        done=self.matrix.add_rows(rows)
+        self.matrix_dirty_count += done
+        return done
+
+    def _save_manifest(self):
+        """
+        Marks every sample that is in the persisted matrix as merged, then writes the manifest.
+        Must only be called when all of the matrix is persisted.
+        """
+        assert self.matrix_dirty_count==0
+        for (name,e) in self.manifest.entries.items():
+            merged = self.matrix is not None and (name[:-4] in self.matrix)
+            if e.merged!=merged:
+                e.merged=merged
+                self.manifest.dirty=True
+        if self.manifest.dirty:
+            self.manifest.save()
+
     def flush(self):
+        """
+        Writes any merged experiments to {id}.hdf5.
+
+        If the file on disk already holds the first matrix_persisted_count experiments
+        in the resizable format then only the new experiments are appended. Otherwise
+        (first write, an old-format file, or a file that can't be opened for writing because
+        another process has it open) the whole matrix is rewritten and swapped in.
+        """
+        assert not self.read_only, "Can't flush a dataset opened read-only"
         if self.matrix_dirty_count>0:
-            ww=tempfile.NamedTemporaryFile(delete=False)
-            self.matrix.save(ww)
+            hdf5_path = self.dir / f"{self.id}.hdf5"
+            appended=False
             try:
-                os.replace( ww.name,  self.dir / f"{self.id}.hdf5" )
+                if self.matrix_persisted_count>0 and ResultsMatrix.can_append_to(hdf5_path, self.matrix_persisted_count):
+                    self.matrix.append_to(hdf5_path, self.matrix_persisted_count)
+                    appended=True
             except OSError as err:
-                if err.errno==18:
-                    shutil.copy(ww.name, self.dir / f"{self.id}.hdf5")
-                    Path(ww.name).unlink()
-                else:
-                    raise
+                # Usually another process has the file open, and hdf5 file locking stops it being opened for writing
+                sys.stderr.write(f"Couldn't append to {hdf5_path} ({err}), so rewriting it instead\n")
+            if not appended:
+                ww=tempfile.NamedTemporaryFile(delete=False)
+                self.matrix.save(ww)
+                ww.close()
+                try:
+                    os.replace( ww.name,  hdf5_path )
+                except OSError as err:
+                    if err.errno==18:
+                        shutil.copy(ww.name, hdf5_path)
+                        Path(ww.name).unlink()
+                    else:
+                        raise
+            self.matrix_persisted_count=self.matrix.nExperiments
             self.matrix_dirty_count=0
+        
+        self._save_manifest()
+
+    def spatial_index(self) -> SpatialIndex:
+        """
+        Returns a nearest neighbour index over the configurations in the matrix, in normalised parameter space.
+
+        The index is kept up to date as samples are merged. It is built when first asked for, which even for
+        large datasets takes much less time than loading the matrix.
+        """
+        assert self.matrix is not None, "Dataset is empty"
+        n=self.matrix.nExperiments
+        configurations=self.matrix.configurations[0:n]
+        if self._spatial_index is None:
+            self._spatial_index=SpatialIndex(self.template, configurations)
+        elif self._spatial_index.n<n:
+            self._spatial_index.extend(configurations[self._spatial_index.n:])
+        return self._spatial_index
+
+    @property
+    def sample_runtimes_path(self) -> Path:
+        return self.dir / "sample_runtimes.tsv"
+
+    def record_sample_runtime(self, id:str, wall_time:float, cpu_time:float):
+        """
+        Appends the run time of a completed sample to {DIR}/sample_runtimes.tsv, which is used
+        to predict how long future samples of the same template will take.
+        Each record is a single short append, so concurrent runners can share the file.
+        """
+        with open(self.sample_runtimes_path, "at") as dst:
+            dst.write(f"{id}\t{wall_time:.3f}\t{cpu_time:.3f}\n")
+
+    def sample_runtimes(self) -> np.ndarray:
+        """
+        Returns the wall times in seconds of all recorded samples, oldest first.
+        """
+        res=[]
+        if self.sample_runtimes_path.exists():
+            with open(self.sample_runtimes_path, "rt") as src:
+                for l in src:
+                    parts=l.split("\t")
+                    if len(parts)==3 and parts[2].endswith("\n"): # Skip any partially written last line
+                        res.append(float(parts[1]))
+        return np.array(res, dtype=np.float64)
 
     @staticmethod
-    def init_or_open_dataset_from_template( template:DMPCITemplate, dataset_directory:Path ) -> "Dataset":
+    def init_or_open_dataset_from_template( template:DMPCITemplate, dataset_directory:Path, read_only:bool=False, merge_jobs:int=1 ) -> "Dataset":
         """
         Opens a dataset directory, initialising from a dmpci template if needed.
+        If read_only is set then the dataset must already exist.
         """
 
-        os.makedirs(dataset_directory, exist_ok=True)
+        if not read_only:
+            os.makedirs(dataset_directory, exist_ok=True)
         
         dir = dataset_directory
         name_file = dir / "dataset_id.txt"
         template_file = dir / f"dmpci.{template.run_id}.template"
         
-        if name_file.exists() or template_file.exists():
+        if name_file.exists() or template_file.exists() or read_only:
             assert name_file.read_text().strip() == template.run_id, f"File '{name_file}' contains '{name_file.read_text().strip()}', but expected '{template.run_id}'. Given template doesn't match dataset."
             assert template_file.read_text() == template.body, f"File '{template_file}' does not match the template given to init_or_open_dataset_from_template"
         else:
             name_file.write_text(template.run_id)
             template_file.write_text(template.body)
 
-        return Dataset(dataset_directory)
+        return Dataset(dataset_directory, read_only=read_only, merge_jobs=merge_jobs)
 
 
-    def __init__(self,  dataset_directory:Path):
+    def __init__(self,  dataset_directory:Path, read_only:bool=False, merge_jobs:int=1):
         """
         Opens an existing data-set directory.
+
+        Unless read_only is set, any sample zips that are not yet in the matrix are merged into
+        it (but not written back until flush is called) using merge_jobs processes. A read-only
+        dataset only sees the samples that have already been flushed to {id}.hdf5, and can't be flushed.
         """
         self.dir=dataset_directory
+        self.read_only=read_only
         assert self.dir.exists(), f"Path {self.dir} does not exist"
         assert self.dir.is_dir(), f"Path {self.dir} is not a directory"
         
@@ -253,13 +705,26 @@ class Dataset:
 
         self.matrix = None # type: Optional[ResultsMatrix]
         self.matrix_dirty_count=0
+        self.matrix_persisted_count=0 # Number of leading experiments in matrix that are already in {id}.hdf5
+        self._spatial_index=None # type: Optional[SpatialIndex]
         
         hdf5_path = self.dir / f"{self.id}.hdf5"
         if hdf5_path.is_file():
-            self.matrix = ResultsMatrix.load(hdf5_path)
+            # A read-only dataset never adds to the matrix, so it can leave the data cube on disk
+            self.matrix = ResultsMatrix.load(hdf5_path, lazy=read_only)
             assert self.matrix.run_id==self.id
+            self.matrix_persisted_count=self.matrix.nExperiments
         
-        self.merge_run_bundles()
+        if not read_only:
+            self.manifest=SampleManifest(self.dir / f"{self.id}.manifest")
+            # Don't trust merged flags for samples that aren't actually in the matrix (e.g. {id}.hdf5 was deleted)
+            for (name,e) in self.manifest.entries.items():
+                if e.merged and not (self.matrix is not None and name[:-4] in self.matrix):
+                    e.merged=False
+
+            self.merge_run_bundles(jobs=merge_jobs)
+            if self.matrix_dirty_count==0 and self.manifest.dirty:
+                self._save_manifest()
 
     def get_parameter(self, name_or_index:Union[str,int] ) -> DMPCIParameter:
         if isinstance(name_or_index,str):
@@ -267,48 +732,177 @@ class Dataset:
         else:
             return self.get_parameter(self.parameter_names[name_or_index])
 
-    def export_pivot_csv(self, dst):
+    def parameter_quantiles(self) -> Tuple[Optional[np.ndarray],int]:
+        """
+        Returns (quantiles,num_quantiles), where quantiles[ei,pi] is the index of the quantile bucket
+        of parameter pi for experiment ei, using ceil(sqrt(nExperiments)) buckets. If there are fewer
+        than 10 experiments then quantiles is None.
+        """
+        matrix=self.matrix
+        if matrix.nExperiments<10:
+            return (None,0)
+        num_quantiles=math.ceil(math.sqrt(matrix.nExperiments))
+        parameter_quantiles=np.zeros(shape=(matrix.nExperiments,matrix.nParameters))
+        boundaries=np.linspace(0,1,num_quantiles,endpoint=True)
+        for i in range(matrix.nParameters):
+            vv=matrix.configurations[0:matrix.nExperiments,i]
+            qboundaries=np.quantile(vv, boundaries)
+            parameter_quantiles[:,i]=np.digitize(vv, qboundaries)
+        return (parameter_quantiles,num_quantiles)
+
+    def select_exports(self, tags:Optional[List[str]]=None, observables:Optional[List[str]]=None, time_min:Optional[int]=None, time_max:Optional[int]=None) -> Tuple[np.ndarray,np.ndarray,np.ndarray]:
+        """
+        Works out which (experiments,times,observables) indices an export should contain. Experiments are
+        those with any of the given tags (or all if tags is None), and times are in the inclusive range [time_min,time_max].
+        """
+        matrix=self.matrix
+        if tags is None:
+            experiment_indices=np.arange(matrix.nExperiments)
+        else:
+            selected=set()
+            for tag in tags:
+                selected.update(matrix.tags_to_indices.get(tag, []))
+            experiment_indices=np.array(sorted(selected), dtype=np.int64)
+
+        time_mask=np.ones(shape=(matrix.nTimes,), dtype=bool)
+        if time_min is not None:
+            time_mask &= matrix.times >= time_min
+        if time_max is not None:
+            time_mask &= matrix.times <= time_max
+        time_indices=np.nonzero(time_mask)[0]
+
+        if observables is None:
+            observable_indices=np.arange(matrix.nObservables)
+        else:
+            for o in observables:
+                assert o in matrix.observables_to_index, f"Unknown observable '{o}'. Known observables are {list(matrix.observables)}"
+            observable_indices=np.array([ matrix.observables_to_index[o] for o in observables ], dtype=np.int64)
+
+        return (experiment_indices,time_indices,observable_indices)
+
+    def iter_export_blocks(self, experiment_indices:np.ndarray, time_indices:np.ndarray, observable_indices:np.ndarray, block_size:int=256):
+        """
+        Yields (experiment_indices,data) for blocks of at most block_size experiments, where
+        data has shape len(block) x len(time_indices) x len(observable_indices). Only one
+        block of the data cube is in memory at a time.
+        """
         matrix=self.matrix
+        for begin in range(0, experiment_indices.shape[0], block_size):
+            block=experiment_indices[begin:begin+block_size]
+            if block.shape[0]>0 and block[-1]-block[0]+1==block.shape[0]:
+                data=matrix.data[block[0]:block[-1]+1] # Contiguous, so read as a slice
+            else:
+                data=matrix.data[block]
+            yield (block, np.asarray(data)[:,time_indices,:][:,:,observable_indices])
 
+    def export_pivot_csv(self, dst, tags:Optional[List[str]]=None, observables:Optional[List[str]]=None, time_min:Optional[int]=None, time_max:Optional[int]=None, float_format:str="%r", block_size:int=256):
+        """
+        Writes one row per (experiment,time,observable) to the text stream dst.
 
-        parameter_quantiles=None
-        if matrix.nExperiments>=10:
-            num_quantiles=math.ceil(math.sqrt(matrix.nExperiments))
-            parameter_quantiles=np.zeros(shape=(matrix.nExperiments,matrix.nParameters))
-            boundaries=np.linspace(0,1,num_quantiles,endpoint=True)
-            print(f"{boundaries}", file=sys.stderr)
-            for (i,param) in enumerate(self.template.parameters.values()):
-                #print(f"{param.name}", file=sys.stderr)
-                vv=matrix.configurations[0:matrix.nExperiments,i]
-                vv=np.sort(vv)
-                #print(f"{vv}", file=sys.stderr)
-                qboundaries=np.quantile(vv, boundaries)
-                #print(f"{qboundaries}", file=sys.stderr)
-                parameter_quantiles[:,i]=np.digitize(matrix.configurations[0:matrix.nExperiments,i], qboundaries)
-                #print(f"{parameter_quantiles[:,i]}", file=sys.stderr)
+        Rows are formatted and written a block of experiments at a time, so memory use is bounded
+        by block_size regardless of the size of the dataset. Each experiment is formatted with a
+        single %-format over all of its values. The default float_format of "%r" gives exact round-trip
+        values; something like "%.8g" is substantially faster to format.
+        """
+        matrix=self.matrix
+
+        (parameter_quantiles,num_quantiles)=self.parameter_quantiles()
         
-        print(f"Sample", file=dst, end="")
+        header="Sample"
         for i in range(matrix.nParameters):
             name=str(matrix.parameters[i])
-            print(f",{name}", file=dst, end="")
+            header+=f",{name}"
             if parameter_quantiles is not None:
-                print(f",{name}-Q{num_quantiles}Index", file=dst, end="")
-                #print(f",{name}-Q{num_quantiles}Centre", file=dst, end="")
-        print(",Time,Observable,Value", file=dst)
-
-        for ei in range(matrix.nExperiments):
-            prefix=str(matrix.experiments[ei])
-            for i in range(matrix.nParameters):
-                v=float(matrix.configurations[ei,i])
-                prefix+=","+str(v)
-                if parameter_quantiles is not None:
-                    prefix+=","+str(parameter_quantiles[ei,i])
-            for (tindex,tval) in np.ndenumerate(matrix.times):
-                for (oi,oname) in np.ndenumerate(matrix.observables):
-                    print(f"{prefix}, {tval}, {oname}, {float(matrix.data[ei,tindex,oi])}", file=dst )
+                header+=f",{name}-Q{num_quantiles}Index"
+        dst.write(header+",Time,Observable,Value\n")
+
+        (experiment_indices,time_indices,observable_indices)=self.select_exports(tags, observables, time_min, time_max)
+        if time_indices.shape[0]==0 or observable_indices.shape[0]==0:
+            return
+
+        # The ", time, observable, value" end of each line has the same format for every experiment
+        suffixes=[ f", {matrix.times[ti]}, {matrix.observables[oi]}, ".replace("%","%%")+float_format for ti in time_indices for oi in observable_indices ]
+        configurations=matrix.configurations[0:matrix.nExperiments,:].tolist()
+        quantiles=parameter_quantiles.tolist() if parameter_quantiles is not None else None
+
+        for (block,data) in self.iter_export_blocks(experiment_indices, time_indices, observable_indices, block_size):
+            values=data.reshape(data.shape[0], -1).tolist()
+            chunks=[]
+            for (bi,ei) in enumerate(block.tolist()):
+                prefix=str(matrix.experiments[ei])
+                for i in range(matrix.nParameters):
+                    prefix+=","+str(configurations[ei][i])
+                    if quantiles is not None:
+                        prefix+=","+str(quantiles[ei][i])
+                prefix=prefix.replace("%","%%")
+                chunks.append( (prefix+("\n"+prefix).join(suffixes)+"\n") % tuple(values[bi]) )
+            dst.write("".join(chunks))
         
 
-def command_line_dataset_open_helper(dataset_dir_or_dmpci_template:str, default_dataset_root:str) -> Tuple[Dataset,Path]:
+    def export_parquet(self, dst_path:Path, layout:str="long", tags:Optional[List[str]]=None, observables:Optional[List[str]]=None, time_min:Optional[int]=None, time_max:Optional[int]=None, compression:str="zstd", block_size:int=256):
+        """
+        Writes the results to a columnar parquet file. Needs pyarrow to be installed.
+
+        layout="long" has the same rows as export_pivot_csv, with one row per (experiment,time,observable) and
+        Observable/Value columns. layout="wide" has one row per (experiment,time), with one column per observable.
+        Parameter and parameter quantile columns are the same as the csv, and Sample/Observable are dictionary encoded.
+
+        Each block of block_size experiments is written as one row group, so only one block is ever held in
+        memory, and readers can skip row groups using their statistics.
+        """
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+
+        assert layout in ("long","wide"), f"Unknown parquet layout '{layout}'"
+        matrix=self.matrix
+
+        (parameter_quantiles,num_quantiles)=self.parameter_quantiles()
+        (experiment_indices,time_indices,observable_indices)=self.select_exports(tags, observables, time_min, time_max)
+        times=matrix.times[time_indices]
+        observable_names=[ str(o) for o in matrix.observables[observable_indices] ]
+        (nT,nO)=(times.shape[0],len(observable_names))
+
+        fields=[ pa.field("Sample", pa.dictionary(pa.int32(), pa.string())) ]
+        for i in range(matrix.nParameters):
+            name=str(matrix.parameters[i])
+            fields.append(pa.field(name, pa.float64()))
+            if parameter_quantiles is not None:
+                fields.append(pa.field(f"{name}-Q{num_quantiles}Index", pa.int32()))
+        fields.append(pa.field("Time", pa.int32()))
+        if layout=="long":
+            fields.append(pa.field("Observable", pa.dictionary(pa.int32(), pa.string())))
+            fields.append(pa.field("Value", pa.float64()))
+        else:
+            fields.extend( pa.field(o, pa.float64()) for o in observable_names )
+        schema=pa.schema(fields)
+
+        rows_per_experiment = nT*nO if layout=="long" else nT
+        observable_dictionary=pa.array(observable_names, pa.string())
+
+        with pq.ParquetWriter(dst_path, schema, compression=compression) as writer:
+            for (block,data) in self.iter_export_blocks(experiment_indices, time_indices, observable_indices, block_size):
+                nB=block.shape[0]
+                columns=[
+                    pa.DictionaryArray.from_arrays(
+                        np.repeat(np.arange(nB, dtype=np.int32), rows_per_experiment),
+                        pa.array([ str(e) for e in matrix.experiments[block] ], pa.string())
+                    )
+                ]
+                for i in range(matrix.nParameters):
+                    columns.append(pa.array(np.repeat(matrix.configurations[block,i], rows_per_experiment)))
+                    if parameter_quantiles is not None:
+                        columns.append(pa.array(np.repeat(parameter_quantiles[block,i].astype(np.int32), rows_per_experiment)))
+                if layout=="long":
+                    columns.append(pa.array(np.tile(np.repeat(times, nO), nB)))
+                    columns.append(pa.DictionaryArray.from_arrays(np.tile(np.arange(nO, dtype=np.int32), nB*nT), observable_dictionary))
+                    columns.append(pa.array(data.reshape(-1)))
+                else:
+                    columns.append(pa.array(np.tile(times, nB)))
+                    columns.extend( pa.array(data[:,:,oi].reshape(-1)) for oi in range(nO) )
+                writer.write_table(pa.Table.from_arrays(columns, schema=schema))
+
+
+def command_line_dataset_open_helper(dataset_dir_or_dmpci_template:str, default_dataset_root:str, read_only:bool=False, merge_jobs:int=1) -> Tuple[Dataset,Path]:
     dataset_dir_or_dmpci_template = Path(dataset_dir_or_dmpci_template)
     if dataset_dir_or_dmpci_template.is_file():
         default_dataset_root=Path(default_dataset_root)
@@ -316,11 +910,11 @@ def command_line_dataset_open_helper(dataset_dir_or_dmpci_template:str, default_
         template=DMPCITemplate(dataset_dir_or_dmpci_template)
         dataset_dir=default_dataset_root / template.run_id
         sys.stderr.write(f"Template run is called {template.run_id}, initing or loading at dataset directory {dataset_dir}\n")
-        dataset=Dataset.init_or_open_dataset_from_template(template, dataset_dir)
+        dataset=Dataset.init_or_open_dataset_from_template(template, dataset_dir, read_only=read_only, merge_jobs=merge_jobs)
     else:
         sys.stderr.write(f"Input {dataset_dir_or_dmpci_template} is a directory, treating as a dataset.\n")
         dataset_dir=dataset_dir_or_dmpci_template
-        dataset=Dataset(dataset_dir)    
+        dataset=Dataset(dataset_dir, read_only=read_only, merge_jobs=merge_jobs)
     return (dataset,dataset_dir)
 
 
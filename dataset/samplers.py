@@ -0,0 +1,173 @@
+from typing import *
+import os
+import fcntl
+import math
+from pathlib import Path
+import numpy as np
+import scipy.stats.qmc
+import scipy.spatial
+
+class Sampler:
+    """
+    Maps a sample index to a point in the unit cube [0,1)^dims. The same (seed,index) always gives the
+    same point, so any process can compute sample i of a design without coordinating with the others.
+    Points are turned into parameter values with DMPCITemplate.denormalise.
+    """
+    name="" # type: str
+
+    def __init__(self, dims:int, seed:int, size:Optional[int]=None):
+        self.dims=dims
+        self.seed=seed
+        self.size=size   # Number of points in the design, or None if it can be extended indefinitely
+
+    def point(self, index:int) -> np.ndarray:
+        raise NotImplementedError()
+
+class _PrefixSampler(Sampler):
+    """
+    A sampler where point i is row i of a design that is generated once and then cached.
+    """
+    def __init__(self, dims:int, seed:int, size:Optional[int]=None):
+        super().__init__(dims, seed, size)
+        self._points=np.zeros( shape=(0,dims), dtype=np.float64 )
+
+    def _generate(self, n:int) -> np.ndarray:
+        """
+        Returns at least the first n points of the design.
+        """
+        raise NotImplementedError()
+
+    def point(self, index:int) -> np.ndarray:
+        assert index>=0
+        assert self.size is None or index<self.size, f"Index {index} is past the end of the {self.name} design of {self.size} points"
+        if index>=self._points.shape[0]:
+            self._points=self._generate(index+1)
+        return self._points[index]
+
+class SobolSampler(_PrefixSampler):
+    """
+    Scrambled Sobol sequence. Points are generated in powers of two, as the balance properties
+    of Sobol sequences only hold for those prefix lengths.
+    """
+    name="sobol"
+
+    def _generate(self, n:int) -> np.ndarray:
+        m=max(0, math.ceil(math.log2(n)))
+        return scipy.stats.qmc.Sobol(self.dims, scramble=True, seed=self.seed).random_base2(m)
+
+class HaltonSampler(_PrefixSampler):
+    """
+    Scrambled Halton sequence.
+    """
+    name="halton"
+
+    def _generate(self, n:int) -> np.ndarray:
+        n=max(n, 2*self._points.shape[0]) # Grow geometrically, so generating one at a time stays cheap
+        return scipy.stats.qmc.Halton(self.dims, scramble=True, seed=self.seed).random(n)
+
+class LatinHypercubeSampler(_PrefixSampler):
+    """
+    Latin hypercube of a fixed size, so each parameter's range is split into size strata with one point in each.
+    """
+    name="lhs"
+
+    def __init__(self, dims:int, seed:int, size:Optional[int]=None):
+        assert size is not None and size>0, "A latin hypercube design needs a size"
+        super().__init__(dims, seed, size)
+
+    def _generate(self, n:int) -> np.ndarray:
+        return scipy.stats.qmc.LatinHypercube(self.dims, seed=self.seed).random(self.size)
+
+class MaximinSampler(LatinHypercubeSampler):
+    """
+    The latin hypercube with the largest minimum distance between points, out of a number of random candidates.
+    """
+    name="maximin"
+
+    def __init__(self, dims:int, seed:int, size:Optional[int]=None, candidates:int=64):
+        super().__init__(dims, seed, size)
+        self.candidates=candidates
+
+    def _generate(self, n:int) -> np.ndarray:
+        rng=np.random.default_rng(self.seed)
+        best=None
+        best_min=-1.0
+        for i in range(self.candidates):
+            design=scipy.stats.qmc.LatinHypercube(self.dims, seed=rng).random(self.size)
+            if self.size<2:
+                return design
+            (d,_)=scipy.spatial.cKDTree(design).query(design, k=2)
+            if d[:,1].min()>best_min:
+                (best,best_min)=(design,d[:,1].min())
+        return best
+
+samplers={ s.name:s for s in [SobolSampler, HaltonSampler, LatinHypercubeSampler, MaximinSampler] } # type: Dict[str,Type[Sampler]]
+
+def create_sampler(name:str, dims:int, seed:int, size:Optional[int]=None) -> Sampler:
+    assert name in samplers, f"Unknown sampler '{name}', expected one of {list(samplers.keys())}"
+    return samplers[name](dims, seed, size)
+
+class IndexAllocator:
+    """
+    Hands out consecutive sample indices from a counter file, so that separate jobs sharing a
+    dataset take different points of the same design. The file is locked while it is updated.
+    """
+    def __init__(self, path:Path):
+        self.path=path
+
+    def allocate(self, n:int=1) -> range:
+        fd=os.open(self.path, os.O_RDWR|os.O_CREAT, 0o644)
+        try:
+            fcntl.lockf(fd, fcntl.LOCK_EX)
+            text=os.read(fd, 64).decode().strip()
+            begin=int(text) if text else 0
+            os.lseek(fd, 0, os.SEEK_SET)
+            os.ftruncate(fd, 0)
+            os.write(fd, f"{begin+n}\n".encode())
+            os.fsync(fd)
+        finally:
+            os.close(fd) # Also releases the lock
+        return range(begin, begin+n)
+
+class AdaptiveSampler:
+    """
+    Chooses each new point in the unit cube to improve on the samples that already exist, by scoring
+    a batch of random candidate points and taking the best:
+    - "distance" : the candidate furthest from any existing or pending sample (greedy maximin).
+    - "variance" : the candidate where a surrogate model is least certain about an observable, multiplied
+      by the distance to the nearest existing or pending sample, so that regions where the observable
+      changes quickly get refined without piling samples on top of each other.
+    Pending samples are ones that have been started (by any job) but are not yet in the dataset.
+    """
+    modes=["distance","variance"]
+
+    def __init__(self, dims:int, seed:int, mode:str="distance", candidates:int=4096):
+        assert mode in self.modes, f"Unknown adaptive mode '{mode}'"
+        self.dims=dims
+        self.rng=np.random.default_rng(seed)
+        self.mode=mode
+        self.candidates=candidates
+
+    def choose(self, existing:np.ndarray, pending:np.ndarray, uncertainty:Optional[Callable[[np.ndarray],np.ndarray]]=None,
+            snap:Optional[Callable[[np.ndarray],np.ndarray]]=None) -> np.ndarray:
+        """
+        existing and pending are nPoints x dims arrays of unit cube points. uncertainty maps a batch of
+        unit cube points to the predicted standard deviation of the observable at each (e.g. from a
+        Surrogate), and is only used for "variance". snap maps candidates to points that can actually
+        be sampled (e.g. rounding integer parameters).
+        """
+        candidates=scipy.stats.qmc.Sobol(self.dims, scramble=True, seed=self.rng).random_base2(math.ceil(math.log2(self.candidates)))
+        if snap is not None:
+            candidates=snap(candidates)
+
+        occupied=np.concatenate([existing.reshape(-1,self.dims), pending.reshape(-1,self.dims)])
+        if occupied.shape[0]==0:
+            return candidates[0]
+        (nearest,_)=scipy.spatial.cKDTree(occupied).query(candidates, k=1)
+
+        score=nearest
+        if self.mode=="variance" and uncertainty is not None:
+            spread=np.nan_to_num(uncertainty(candidates))
+            if spread.max()>0: # Otherwise there's nothing to go on, so just fill space
+                score=spread*nearest
+        return candidates[np.argmax(score)]
@@ -0,0 +1,117 @@
+from typing import *
+import re
+import os
+import time
+import socket
+import hashlib
+import multiprocessing
+from pathlib import Path
+import numpy as np
+
+def parse_slurm_time(s:str) -> float:
+    """
+    Converts a SLURM style time limit to seconds. Accepted forms are "MM", "MM:SS", "HH:MM:SS",
+    "DD-HH", "DD-HH:MM" and "DD-HH:MM:SS".
+    """
+    m=re.fullmatch(r"\s*(?:(\d+)-)?(\d+)(?::(\d+))?(?::(\d+))?\s*", s)
+    assert m, f"Couldn't parse time '{s}', expected something like dd-HH:MM:SS"
+    (days,a,b,c)=m.groups()
+    if days is not None:
+        # After a day count the fields are hours, minutes, seconds
+        (hours,minutes,seconds)=(int(a), int(b or 0), int(c or 0))
+        return ((int(days)*24+hours)*60+minutes)*60+seconds
+    if c is not None:
+        return (int(a)*60+int(b))*60+int(c)
+    # Without a day count SLURM treats "a" as minutes and "a:b" as minutes:seconds
+    return int(a)*60+int(b or 0)
+
+class RuntimeEstimator:
+    """
+    Predicts the wall time of the next sample as a high quantile of the most recent sample times,
+    so that a sample is only started when it is very likely to finish in the remaining time.
+    """
+    def __init__(self, history:np.ndarray, quantile:float=0.9, window:int=500, default:Optional[float]=None):
+        assert 0 < quantile <= 1
+        self.quantile=quantile
+        self.window=window
+        self.default=default
+        self.times=list(history[-window:])
+
+    def add(self, wall_time:float):
+        self.times.append(wall_time)
+        if len(self.times)>2*self.window:
+            del self.times[:-self.window]
+
+    def estimate(self) -> Optional[float]:
+        """
+        Returns the predicted wall time in seconds, or the default (possibly None) if nothing is known.
+        """
+        if len(self.times)==0:
+            return self.default
+        return float(np.quantile(self.times[-self.window:], self.quantile))
+
+# Touched regularly by whoever is working on a sample's working directory
+heartbeat_name="heartbeat"
+
+def touch_heartbeat(sample_dir:Path):
+    (sample_dir / heartbeat_name).touch()
+
+def release_heartbeat(sample_dir:Path):
+    """
+    Marks a sample working directory as abandoned straight away, rather than waiting for it to go stale.
+    """
+    path=sample_dir / heartbeat_name
+    if path.exists():
+        os.utime(path, (0,0))
+
+def find_abandoned_samples(working_dir:Path, stale_after:float) -> List[Path]:
+    """
+    Returns sample working directories whose heartbeat hasn't been touched for stale_after seconds,
+    oldest first. These were left by a runner that was killed or interrupted.
+    """
+    res=[] # type: List[Tuple[float,Path]]
+    now=time.time()
+    for p in working_dir.glob("sample_*"):
+        if "." in p.name: # zips, or directories part way through being claimed
+            continue
+        hb=p / heartbeat_name
+        if not (p.is_dir() and hb.exists()):
+            continue
+        mtime=hb.stat().st_mtime
+        if now-mtime > stale_after:
+            res.append( (mtime,p) )
+    return [ p for (_,p) in sorted(res) ]
+
+def claim_sample_dir(sample_dir:Path, stale_after:float) -> bool:
+    """
+    Tries to take ownership of an abandoned sample working directory. The directory is renamed
+    away while the heartbeat is checked and refreshed, so if several runners try to claim it at
+    once only the one whose rename succeeds first gets it.
+    """
+    claimed=sample_dir.with_name(f"{sample_dir.name}.claim-{socket.gethostname()}-{os.getpid()}")
+    try:
+        os.rename(sample_dir, claimed)
+    except FileNotFoundError:
+        return False
+    # Someone else may have claimed it between our listing and the rename
+    still_stale = time.time()-(claimed / heartbeat_name).stat().st_mtime > stale_after
+    if still_stale:
+        touch_heartbeat(claimed)
+    os.rename(claimed, sample_dir)
+    return still_stale
+
+def derive_seed(stream:str, index:int) -> int:
+    """
+    Deterministically maps (stream,index) to a non-zero 64-bit sample seed, so that a job can be
+    given its own reproducible sequence of samples (e.g. one stream per SLURM array task).
+    """
+    h=hashlib.blake2b(f"{stream}:{index}".encode(), digest_size=8)
+    return int.from_bytes(h.digest(), "little") or 1
+
+def bind_to_core(cores:"multiprocessing.Queue"):
+    """
+    Pins the calling process (and so any dpd it starts) to the next core from the queue.
+    Intended for a pool initializer, with the queue holding one entry per worker.
+    """
+    core=cores.get()
+    os.sched_setaffinity(0, {core})
@@ -0,0 +1,111 @@
+from typing import *
+import os
+import sys
+import bz2
+import hashlib
+import zipfile
+import tempfile
+import threading
+import concurrent.futures
+from pathlib import Path
+
+from .povray import render_pov, default_width, default_height
+
+class SnapshotCache:
+    """
+    Provides the png snapshot of a sample at a given time, rendering it on demand if needed.
+
+    If the sample zip contains a rendered dmpccs.{ID}.con.{TIME}.png then that is used. Otherwise the
+    compressed dmpccs.{ID}.con.{TIME}.pov.bz2 (from dataset_run_samples.py --keep-pov) is rendered with
+    povray at the requested size, and the image is kept in a cache directory shared by all tools. Cache
+    entries are named by a hash of the pov contents and the size, so they never go stale and any
+    number of processes can share the cache. Renders run in a pool of threads (each waiting on a povray
+    process), and a snapshot that is already being rendered is not rendered again.
+    """
+    def __init__(self, dataset_dir:Path, cache_dir:Optional[Path]=None, width:int=default_width, height:int=default_height,
+            povray:str="povray", jobs:Optional[int]=None):
+        self.dataset_dir=dataset_dir
+        self.cache_dir=cache_dir if cache_dir is not None else dataset_dir / "snapshot_cache"
+        self.width=width
+        self.height=height
+        self.povray=povray
+        self._pool=concurrent.futures.ThreadPoolExecutor(max_workers=jobs or os.cpu_count())
+        self._lock=threading.Lock()
+        self._rendering={} # type: Dict[str,concurrent.futures.Future]
+        self._warned_read_only=False
+
+    def close(self):
+        self._pool.shutdown(wait=True)
+
+    def __enter__(self) -> "SnapshotCache":
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _cache_path(self, key:str) -> Path:
+        return self.cache_dir / key[0:2] / f"{key}.png"
+
+    def _render(self, key:str, name:str, pov_bz2:bytes) -> bytes:
+        try:
+            with tempfile.TemporaryDirectory() as tmp:
+                pov=Path(tmp) / name
+                pov.write_bytes(bz2.decompress(pov_bz2))
+                png=render_pov(pov, self.width, self.height, self.povray)
+                if not png.exists():
+                    raise RuntimeError(f"povray didn't produce {png.name}:\n{(pov.parent / (pov.name+'.povray.log')).read_text()}")
+                data=png.read_bytes()
+            path=self._cache_path(key)
+            try:
+                path.parent.mkdir(parents=True, exist_ok=True)
+                with tempfile.NamedTemporaryFile(dir=path.parent, suffix=".tmp", delete=False) as dst:
+                    dst.write(data)
+                os.replace(dst.name, path)
+            except OSError as e:
+                if not self._warned_read_only:
+                    sys.stderr.write(f"Couldn't write to snapshot cache {self.cache_dir}, images will be rendered again next time : {e}\n")
+                    self._warned_read_only=True
+            return data
+        finally:
+            with self._lock:
+                del self._rendering[key]
+
+    def submit(self, eid:str, time:int) -> concurrent.futures.Future:
+        """
+        Returns a future for the png bytes of the snapshot of eid at time. Images that are already
+        rendered are returned as completed futures without involving the pool.
+        """
+        name=f"dmpccs.{eid}.con.{time}"
+        with zipfile.ZipFile( self.dataset_dir / f"{eid}.zip" ) as zip:
+            try:
+                return _completed(zip.read(f"{eid}/{name}.png"))
+            except KeyError:
+                pass
+            try:
+                pov_bz2=zip.read(f"{eid}/{name}.pov.bz2")
+            except KeyError:
+                raise KeyError(f"Sample {eid} has neither a rendered snapshot nor a pov file for time {time}") from None
+
+        key=hashlib.blake2b(pov_bz2+f":{self.width}x{self.height}".encode(), digest_size=20).hexdigest()
+        try:
+            return _completed(self._cache_path(key).read_bytes())
+        except FileNotFoundError:
+            pass
+        with self._lock:
+            if key not in self._rendering:
+                self._rendering[key]=self._pool.submit(self._render, key, f"{name}.pov", pov_bz2)
+            return self._rendering[key]
+
+    def get(self, eid:str, time:int) -> bytes:
+        return self.submit(eid, time).result()
+
+    def get_many(self, eids:Iterable[str], time:int) -> List[bytes]:
+        """
+        Returns the png bytes for each sample at time, rendering any missing ones in parallel.
+        """
+        return [ f.result() for f in [ self.submit(eid, time) for eid in eids ] ]
+
+def _completed(value) -> concurrent.futures.Future:
+    f=concurrent.futures.Future()
+    f.set_result(value)
+    return f
@@ -0,0 +1,113 @@
+from typing import *
+import numpy as np
+import scipy.spatial
+
+from .dmpci_template import DMPCITemplate
+
+class SpatialIndex:
+    """
+    Nearest neighbour index over the configurations of a dataset, in normalised parameter space
+    (each parameter's [minval,maxval] mapped to [0,1]), so that every parameter counts equally
+    whatever its units. Queries take configurations in the original units and return indices
+    into the matrix.
+
+    The bulk of the points are in one kd-tree, and points added later go into a small second tree
+    which is queried as well. Once the second tree gets too big everything is rebuilt into one tree.
+    Use Dataset.spatial_index rather than creating this directly, as that keeps it up to date as samples are merged.
+    """
+    def __init__(self, template:DMPCITemplate, configurations:np.ndarray):
+        self.template=template
+        self.configurations=np.array(configurations, dtype=np.float64)
+        self.points=self.template.normalise(self.configurations)
+        self._rebuild()
+
+    @property
+    def n(self) -> int:
+        return self.points.shape[0]
+
+    def _rebuild(self):
+        self._tree=scipy.spatial.cKDTree(self.points)
+        self._tree_n=self.n
+        self._tail=None # type: Optional[scipy.spatial.cKDTree]
+
+    def extend(self, configurations:np.ndarray):
+        """
+        Adds rows to the end of the index, which must match the rows added to the matrix.
+        """
+        if len(configurations)==0:
+            return
+        configurations=np.asarray(configurations, dtype=np.float64)
+        self.configurations=np.concatenate([self.configurations, configurations])
+        self.points=np.concatenate([self.points, self.template.normalise(configurations)])
+        if self.n-self._tree_n > max(1024, self._tree_n//4):
+            self._rebuild()
+        else:
+            self._tail=scipy.spatial.cKDTree(self.points[self._tree_n:])
+
+    def query(self, configurations:np.ndarray, k:int=1, scale:Optional[np.ndarray]=None) -> Tuple[np.ndarray,np.ndarray]:
+        """
+        Finds the k nearest samples to each configuration, like cKDTree.query, with distances measured in
+        normalised units. A batch of configurations (nQueries x nParameters) is answered in one call.
+        scale optionally multiplies each normalised parameter, to weight some parameters more than others.
+        Scaled queries use the same trees, so any number of different scales can be used without rebuilding.
+        If there are fewer than k samples the missing neighbours have distance inf and index n.
+        """
+        u=self.template.normalise(configurations)
+        if scale is not None:
+            return self._weighted_query(u, k, np.asarray(scale, dtype=np.float64))
+        return self._query(u, k)
+
+    def _query(self, u:np.ndarray, k:int) -> Tuple[np.ndarray,np.ndarray]:
+        if self._tail is None:
+            return self._tree.query(u, k=k)
+
+        (d0,i0)=self._tree.query(u, k=k)
+        (d1,i1)=self._tail.query(u, k=k)
+        # Tail indices are relative to the tail, and "missing" is reported as the size of each tree
+        i0=np.where(i0==self._tree_n, self.n, i0)
+        i1=np.where(i1==self.n-self._tree_n, self.n, i1+self._tree_n)
+        if k==1:
+            closer=d1<d0
+            return (np.where(closer,d1,d0), np.where(closer,i1,i0))
+        d=np.concatenate([d0,d1], axis=-1)
+        i=np.concatenate([i0,i1], axis=-1)
+        order=np.argsort(d, axis=-1, kind="stable")[...,:k]
+        return (np.take_along_axis(d, order, axis=-1), np.take_along_axis(i, order, axis=-1))
+
+    def _weighted_query(self, u:np.ndarray, k:int, scale:np.ndarray) -> Tuple[np.ndarray,np.ndarray]:
+        """
+        Exact k nearest neighbours under the scaled metric, using the unscaled trees. The scaled distance
+        is at least min(scale) times the unscaled distance, so once the k-th best scaled distance among the
+        c nearest unscaled candidates is within min(scale) times the distance of the c-th candidate, no
+        other point can be closer. Queries that don't satisfy that are repeated with twice as many candidates.
+        """
+        single=(u.ndim==1)
+        u=np.atleast_2d(u)
+        min_scale=float(scale.min())
+        assert min_scale>0
+        res_d=np.full( shape=(u.shape[0],k), fill_value=np.inf )
+        res_i=np.full( shape=(u.shape[0],k), fill_value=self.n, dtype=np.int64 )
+        todo=np.arange(u.shape[0])
+        c=max(2*k, 16)
+        while len(todo)>0:
+            c=min(c, self.n)
+            (d,i)=self._query(u[todo], c)
+            (d,i)=(d.reshape(len(todo),-1), i.reshape(len(todo),-1))
+            valid=i<self.n
+            diff=(self.points[np.where(valid, i, 0)]-u[todo,None,:])*scale
+            dw=np.where(valid, np.sqrt(np.sum(diff**2, axis=-1)), np.inf)
+            order=np.argsort(dw, axis=-1, kind="stable")[:,:k]
+            (best_d,best_i)=(np.take_along_axis(dw, order, axis=-1), np.take_along_axis(i, order, axis=-1))
+            kk=best_d.shape[1]
+            res_d[todo,:kk]=best_d
+            res_i[todo,:kk]=best_i
+            if c>=self.n:
+                break
+            done=best_d[:,-1] <= min_scale*d[:,-1]
+            todo=todo[~done]
+            c*=2
+        if k==1:
+            (res_d,res_i)=(res_d[:,0],res_i[:,0])
+        if single:
+            (res_d,res_i)=(res_d[0],res_i[0])
+        return (res_d,res_i)
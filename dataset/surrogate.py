@@ -0,0 +1,139 @@
+from typing import *
+from pathlib import Path
+import numpy as np
+import scipy.spatial
+import scipy.interpolate
+
+from .dmpci_template import DMPCITemplate
+from .results_bundle import ResultsMatrix
+
+class Surrogate:
+    """
+    A cheap regression model from parameter configurations to observables, trained on the samples
+    of a dataset, used to predict observables between samples without running dpd.
+
+    Configurations are normalised to the unit cube using the template parameter ranges. The target is
+    data[:, times, observables] for a chosen subset of times and observables. Two models are supported:
+    - "knn" : inverse distance weighted mean of the k nearest samples.
+    - "rbf" : thin plate spline radial basis function interpolation over the k nearest samples (scipy
+              RBFInterpolator), which is smoother but slower.
+
+    Both give an uncertainty for each prediction, based on the leave-one-out error of the knn model at
+    the nearby samples, scaled up with the distance to the nearest sample (relative to the typical
+    spacing of samples), so predictions far from any sample are never confident. For the rbf model
+    this is usually pessimistic.
+
+    Samples with the same configuration (e.g. repeats with different seeds) are averaged into one
+    training point, as leave-one-out and the interpolation both need distinct points.
+    """
+    models=["knn","rbf"]
+
+    def __init__(self, parameters:List[str], lo:np.ndarray, hi:np.ndarray, times:np.ndarray, observables:List[str],
+            x:np.ndarray, y:np.ndarray, model:str="knn", k:int=8, smoothing:float=0.0):
+        assert model in self.models, f"Unknown surrogate model '{model}'"
+        assert x.shape[0]==y.shape[0] and y.shape[1:]==(len(times),len(observables))
+        (x,inverse,counts)=np.unique(x, axis=0, return_inverse=True, return_counts=True)
+        if x.shape[0]<y.shape[0]:
+            sums=np.zeros((x.shape[0],)+y.shape[1:], dtype=np.float64)
+            np.add.at(sums, inverse.reshape(-1), y)
+            y=sums / counts.reshape((-1,)+(1,)*(y.ndim-1))
+        assert x.shape[0]>=2, "Need at least two distinct configurations to train a surrogate"
+        self.parameters=list(parameters)
+        self.lo=np.asarray(lo, dtype=np.float64)
+        self.hi=np.asarray(hi, dtype=np.float64)
+        self.times=np.asarray(times)
+        self.observables=list(observables)
+        self.x=x
+        self.y=y
+        self.model=model
+        self.k=min(k, x.shape[0])
+        self.smoothing=smoothing
+
+        self._flat_y=y.reshape(y.shape[0], -1)
+        self._kd=scipy.spatial.cKDTree(x)
+        # Leave-one-out errors of the knn model at each sample, which give the local error scale
+        (d,idx)=self._kd.query(x, k=min(self.k+1, x.shape[0]))
+        self._spacing=max(float(np.median(d[:,1])), 1e-12)
+        loo=self._weighted_mean(d[:,1:], self._flat_y[idx[:,1:]])
+        self._loo_sq=(loo-self._flat_y)**2
+        self._rbf=None
+        if model=="rbf":
+            self._rbf=scipy.interpolate.RBFInterpolator(x, self._flat_y, neighbors=max(self.k, 2*x.shape[1]+2) if x.shape[0]>64 else None,
+                kernel="thin_plate_spline", smoothing=smoothing, degree=1)
+
+    @staticmethod
+    def training_data(matrix:ResultsMatrix, template:DMPCITemplate, observables:List[str], times:List[int],
+            rows:Optional[np.ndarray]=None) -> Tuple[np.ndarray,np.ndarray]:
+        """
+        Returns (x,y) for the given rows of the matrix (default all), where x holds the normalised
+        configurations and y is nRows x nTimes x nObservables. Rows where any target is not finite are skipped.
+        """
+        oi=[ matrix.observables_to_index[o] for o in observables ]
+        ti=[ matrix.times_to_index[int(t)] for t in times ]
+        rows=np.asarray(rows) if rows is not None else np.arange(matrix.nExperiments)
+        y=np.asarray(matrix.data[rows])[:,ti,:][:,:,oi]
+        keep=np.all(np.isfinite(y.reshape(y.shape[0],-1)), axis=1)
+        x=template.normalise(np.asarray(matrix.configurations[rows]))
+        return (x[keep],y[keep])
+
+    @staticmethod
+    def train(matrix:ResultsMatrix, template:DMPCITemplate, observables:Optional[List[str]]=None, times:Optional[List[int]]=None,
+            rows:Optional[np.ndarray]=None, model:str="knn", k:int=8, smoothing:float=0.0) -> "Surrogate":
+        """
+        Trains on the given rows of the matrix (default all), for the given observables and times (default all).
+        """
+        observables=observables if observables is not None else [str(o) for o in matrix.observables]
+        times=np.array(times if times is not None else matrix.times)
+        (x,y)=Surrogate.training_data(matrix, template, observables, times, rows)
+        (lo,hi)=template.parameter_ranges()
+        return Surrogate(list(template.parameters.keys()), lo, hi, times, observables, x, y, model, k, smoothing)
+
+    def normalise(self, configurations:np.ndarray) -> np.ndarray:
+        return DMPCITemplate.normalise_ranges(configurations, self.lo, self.hi)
+
+    @staticmethod
+    def _weighted_mean(d:np.ndarray, v:np.ndarray) -> np.ndarray:
+        """
+        Inverse distance squared weighted mean over axis 1 of v, with d the matching distances.
+        """
+        w=1.0/np.maximum(d, 1e-12)**2
+        w/=w.sum(axis=1, keepdims=True)
+        return np.einsum("qk,qkt->qt", w, v)
+
+    def predict_unit(self, u:np.ndarray) -> Tuple[np.ndarray,np.ndarray]:
+        """
+        As predict, but for points already normalised to the unit cube.
+        """
+        u=np.atleast_2d(u)
+        (d,idx)=self._kd.query(u, k=self.k)
+        if self.k==1:
+            (d,idx)=(d[:,None],idx[:,None])
+        if self._rbf is not None:
+            mean=self._rbf(u)
+        else:
+            mean=self._weighted_mean(d, self._flat_y[idx])
+        # Local error scale, growing as the query moves away from the nearest sample
+        local=np.sqrt(self._weighted_mean(d, self._loo_sq[idx]))
+        std=local * (1 + d[:,0]/self._spacing)[:,None]
+        shape=(u.shape[0], len(self.times), len(self.observables))
+        return (mean.reshape(shape), std.reshape(shape))
+
+    def predict(self, configurations:np.ndarray) -> Tuple[np.ndarray,np.ndarray]:
+        """
+        Predicts (mean, std) for a batch of configurations (nQueries x nParameters, in template order).
+        Both results are nQueries x nTimes x nObservables.
+        """
+        return self.predict_unit(self.normalise(configurations))
+
+    def save(self, path:Path):
+        np.savez_compressed(path,
+            parameters=np.array(self.parameters, dtype=str), lo=self.lo, hi=self.hi,
+            times=self.times, observables=np.array(self.observables, dtype=str),
+            x=self.x, y=self.y, model=np.array(self.model), k=np.array(self.k), smoothing=np.array(self.smoothing)
+        )
+
+    @staticmethod
+    def load(path:Path) -> "Surrogate":
+        with np.load(path, allow_pickle=False) as f:
+            return Surrogate([str(p) for p in f["parameters"]], f["lo"], f["hi"], f["times"], [str(o) for o in f["observables"]],
+                f["x"], f["y"], str(f["model"]), int(f["k"]), float(f["smoothing"]))
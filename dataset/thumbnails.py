@@ -0,0 +1,178 @@
+from typing import *
+import io
+import os
+import sys
+import shutil
+import threading
+from pathlib import Path
+import h5py
+import numpy as np
+from PIL import Image
+
+class ThumbnailAtlas:
+    """
+    Pre-cropped snapshot thumbnails for a dataset, packed into one hdf5 file "{DIR}/{id}.thumbnails.hdf5"
+    written by dataset_build_thumbnails.py, so that tools showing many small images don't need to open
+    a zip and decode a full size png for each one.
+
+    The file holds one group per (time, size), named "t{time}_s{size}", each containing:
+    - experiments : sample ids.
+    - offsets : nExperiments+1 byte offsets, so sample i is blob[offsets[i]:offsets[i+1]].
+    - blob : the png encoded thumbnails (cropped, then shrunk to fit in size x size) back to back.
+    Reading a thumbnail only reads its own bytes from the file.
+    """
+    def __init__(self, path:Path):
+        self.path=path
+        self._file=h5py.File(path, mode="r")
+        self._lock=threading.Lock() # h5py handles are not safe to use from several threads at once
+        self._groups={} # type: Dict[Tuple[int,int],Tuple[h5py.Group,np.ndarray,Dict[str,int]]]
+        for (name,group) in self._file.items():
+            key=(int(group.attrs["time"]), int(group.attrs["size"]))
+            experiments=np.array(group["experiments"].asstr()[:], dtype=object)
+            self._groups[key]=(group, np.array(group["offsets"][:], dtype=np.int64), { e:i for (i,e) in enumerate(experiments) })
+
+    @staticmethod
+    def path_for(dataset_dir:Path, dataset_id:str) -> Path:
+        return dataset_dir / f"{dataset_id}.thumbnails.hdf5"
+
+    @staticmethod
+    def open_for(dataset_dir:Path, dataset_id:str) -> Optional["ThumbnailAtlas"]:
+        """
+        Opens the atlas of a dataset, or returns None if it hasn't been built.
+        """
+        path=ThumbnailAtlas.path_for(dataset_dir, dataset_id)
+        return ThumbnailAtlas(path) if path.is_file() else None
+
+    def close(self):
+        self._file.close()
+
+    def sizes(self, time:int) -> List[int]:
+        return sorted( s for (t,s) in self._groups.keys() if t==time )
+
+    def best_size(self, time:int, size:int) -> Optional[int]:
+        """
+        Returns the smallest size in the atlas for time that is at least size, or None if there isn't one.
+        """
+        larger=[ s for s in self.sizes(time) if s>=size ]
+        return larger[0] if len(larger)>0 else None
+
+    def experiments(self, time:int, size:int) -> Set[str]:
+        return set(self._groups[(time,size)][2].keys()) if (time,size) in self._groups else set()
+
+    def get_bytes(self, eid:str, time:int, size:int) -> Optional[bytes]:
+        """
+        Returns the png bytes of the thumbnail, or None if it isn't in the atlas.
+        """
+        if (time,size) not in self._groups:
+            return None
+        (group,offsets,index)=self._groups[(time,size)]
+        i=index.get(eid)
+        if i is None:
+            return None
+        with self._lock:
+            return group["blob"][offsets[i]:offsets[i+1]].tobytes()
+
+    def get(self, eid:str, time:int, size:int) -> Optional[Image.Image]:
+        data=self.get_bytes(eid, time, size)
+        return None if data is None else Image.open(io.BytesIO(data), formats=("png",))
+
+class ThumbnailAtlasWriter:
+    """
+    Adds thumbnails to the atlas at path. Additions are made to a copy "{path}.tmp", which is swapped in by
+    close(), so tools that have the atlas open carry on seeing the old one. The copy is only made by the first
+    add() that has something new, so an atlas that is already up to date is left alone. The copy is flushed
+    after every add(). If a run is killed then the copy is left behind, and the next writer carries on from
+    it rather than starting again.
+    """
+    def __init__(self, path:Path):
+        self.path=path
+        self.tmp_path=path.with_name(path.name+".tmp")
+        self._file=None # type: Optional[h5py.File]
+        if self.tmp_path.exists():
+            try:
+                self._file=h5py.File(self.tmp_path, mode="a")
+                sys.stderr.write(f"Continuing from unfinished atlas {self.tmp_path}\n")
+            except Exception as e:
+                sys.stderr.write(f"Discarding unreadable unfinished atlas {self.tmp_path} : {e}\n")
+                self.tmp_path.unlink()
+        self._known={} # type: Dict[Tuple[int,int],Set[str]]
+
+    def __enter__(self) -> "ThumbnailAtlasWriter":
+        return self
+
+    def __exit__(self, type, value, traceback):
+        if type is None:
+            self.close()
+        elif self._file is not None:
+            self._file.close() # Leave the copy to be continued next time
+
+    @property
+    def modified(self) -> bool:
+        """
+        Whether there is a copy with additions (from this writer or a killed one), which close() swaps in.
+        """
+        return self._file is not None
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            os.replace(self.tmp_path, self.path)
+
+    def _open_copy(self) -> h5py.File:
+        if self._file is None:
+            if self.path.exists():
+                shutil.copyfile(self.path, self.tmp_path)
+            self._file=h5py.File(self.tmp_path, mode="a")
+        return self._file
+
+    def _group(self, time:int, size:int) -> h5py.Group:
+        name=f"t{time}_s{size}"
+        if name not in self._file:
+            group=self._file.create_group(name)
+            group.attrs["time"]=time
+            group.attrs["size"]=size
+            group.create_dataset("experiments", shape=(0,), maxshape=(None,), dtype=h5py.string_dtype(), chunks=(1024,))
+            group.create_dataset("offsets", data=np.zeros( shape=(1,), dtype=np.int64), maxshape=(None,), chunks=(1024,))
+            group.create_dataset("blob", shape=(0,), maxshape=(None,), dtype=np.uint8, chunks=(1<<16,))
+        return self._file[name]
+
+    def experiments(self, time:int, size:int) -> Set[str]:
+        """
+        Samples that already have a thumbnail of this time and size, including ones added by this writer.
+        """
+        if (time,size) not in self._known:
+            if self._file is not None:
+                self._known[(time,size)]=self._read_experiments(self._file, time, size)
+            elif self.path.exists():
+                with h5py.File(self.path, mode="r") as src:
+                    self._known[(time,size)]=self._read_experiments(src, time, size)
+            else:
+                self._known[(time,size)]=set()
+        return self._known[(time,size)]
+
+    @staticmethod
+    def _read_experiments(file:h5py.File, time:int, size:int) -> Set[str]:
+        name=f"t{time}_s{size}"
+        return set(file[name]["experiments"].asstr()[:]) if name in file else set()
+
+    def add(self, time:int, size:int, thumbnails:Iterable[Tuple[str,bytes]]):
+        """
+        Appends thumbnails to the (time,size) group, creating it if needed. Samples already in the group are skipped.
+        """
+        known=self.experiments(time, size)
+        todo=[ (eid,data) for (eid,data) in thumbnails if eid not in known ]
+        if len(todo)==0:
+            return
+        self._open_copy()
+        group=self._group(time, size)
+        n=group["experiments"].shape[0]
+        end=int(group["offsets"][n])
+        lengths=np.array([ len(data) for (_,data) in todo ], dtype=np.int64)
+        group["experiments"].resize(n+len(todo), axis=0)
+        group["experiments"][n:]=[ eid for (eid,_) in todo ]
+        group["offsets"].resize(n+len(todo)+1, axis=0)
+        group["offsets"][n+1:]=end+np.cumsum(lengths)
+        group["blob"].resize(end+int(lengths.sum()), axis=0)
+        group["blob"][end:]=np.frombuffer(b"".join( data for (_,data) in todo ), dtype=np.uint8)
+        known.update( eid for (eid,_) in todo )
+        self._file.flush()
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+import sys
+import argparse
+from pathlib import Path
+import multiprocessing
+import os
+import io
+import time
+from dataclasses import dataclass
+from typing import *
+from PIL import Image
+
+from dataset import command_line_dataset_open_helper
+from dataset.snapshots import SnapshotCache
+from dataset.thumbnails import ThumbnailAtlas, ThumbnailAtlasWriter
+from dataset_extract_snapshot_slice import crop_image_whitespace
+
+@dataclass
+class ThumbnailConfig:
+    dataset_dir:Path
+    time:int
+    sizes:List[int]
+
+# Set once per worker process by init_worker
+_config=None # type: Optional[ThumbnailConfig]
+_snapshots=None # type: Optional[SnapshotCache]
+
+def init_worker(config:ThumbnailConfig):
+    global _config, _snapshots
+    _config=config
+    _snapshots=SnapshotCache(config.dataset_dir, jobs=1) # Each worker process renders at most one snapshot at a time
+
+def make_thumbnails(eid:str) -> Tuple[str,Dict[int,bytes],Optional[str]]:
+    """
+    Decodes and crops the snapshot of one sample once, and returns png thumbnails at each size.
+    """
+    config=_config
+    try:
+        image=Image.open( io.BytesIO(_snapshots.get(eid, config.time)), formats=("jpeg", "png"))
+        image=crop_image_whitespace(image.convert("RGB"))
+        res={}
+        for size in sorted(config.sizes, reverse=True):
+            image.thumbnail((size,size)) # Shrinking the previous size is as good as shrinking the original
+            dst=io.BytesIO()
+            image.save(dst, format="png", optimize=True)
+            res[size]=dst.getvalue()
+        return (eid, res, None)
+    except Exception as e:
+        return (eid, {}, f"{type(e).__name__}: {e}")
+
+
+if __name__=="__main__":
+
+    parser=argparse.ArgumentParser(
+        "dataset_build_thumbnails.py",
+        description=
+"""
+Build cropped thumbnails of every sample's snapshot at a few sizes, and pack them into
+a single file {DIR}/{DATASET_ID}.thumbnails.hdf5, which the mosaic and display tools
+read instead of decoding the full size images in the sample zips. Running it again
+only adds samples (or sizes or times) that aren't in the file yet, and continues from
+where a killed run got to.
+"""
+    )
+    parser.add_argument("dataset_dir_or_dmpci_template")
+    parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
+    parser.add_argument("--read-only", default=False, action='store_true', help="Only use samples already merged by dataset_merge.py, rather than scanning for new sample zips.")
+    parser.add_argument("--time", default=None, type=int, help="Time of the snapshots. Default is the last time.")
+    parser.add_argument("--size", default=[], action="append", type=int, help="Thumbnail size in pixels (images are shrunk to fit a square of this size). Can be given multiple times. Default is 64, 128 and 256.")
+    parser.add_argument("--jobs", default="max", type=str, help="Either integer number of processes, or 'max' for number of CPUs.")
+
+    args=parser.parse_args()
+
+    if args.jobs=="max":
+        jobs=os.cpu_count()
+    else:
+        jobs=int(args.jobs)
+    jobs=max(1, jobs)
+
+    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, read_only=args.read_only)
+
+    if dataset.matrix==None:
+        sys.stderr.write("Dataset is empty.\n")
+        sys.exit(1)
+
+    snapshot_time=args.time if args.time is not None else int(dataset.matrix.times[-1])
+    sizes=sorted(set(args.size or [64,128,256]))
+    path=ThumbnailAtlas.path_for(dataset.dir, dataset.id)
+
+    eids=[ str(e) for e in dataset.matrix.experiments[0:dataset.matrix.nExperiments] ]
+    config=ThumbnailConfig(dataset.dir, snapshot_time, sizes)
+    failed=[] # type: List[Tuple[str,str]]
+    # Thumbnails are written every batch_size samples, so memory use is bounded and a killed run can be continued
+    batch_size=256
+    with ThumbnailAtlasWriter(path) as atlas:
+        eids=[ e for e in eids if any( e not in atlas.experiments(snapshot_time, size) for size in sizes ) ]
+        sys.stderr.write(f"Making thumbnails of {len(eids)} samples at time {snapshot_time}, sizes {sizes}, using {jobs} processes\n")
+
+        batch={ size:[] for size in sizes } # type: Dict[int,List[Tuple[str,bytes]]]
+        start=time.time()
+        if len(eids)>0:
+            with multiprocessing.Pool(processes=jobs, initializer=init_worker, initargs=(config,)) as pool:
+                for (done,(eid,thumbnails,error)) in enumerate(pool.imap_unordered(make_thumbnails, eids, chunksize=8), start=1):
+                    if error is not None:
+                        failed.append( (eid,error) )
+                        sys.stderr.write(f"Failed {eid} : {error}\n")
+                    for (size,data) in thumbnails.items():
+                        batch[size].append( (eid,data) )
+                    if (done%batch_size)==0 or done==len(eids):
+                        for size in sizes:
+                            atlas.add(snapshot_time, size, batch[size])
+                            batch[size]=[]
+                    if (done%500)==0 or done==len(eids):
+                        elapsed=max(1e-9, time.time()-start)
+                        sys.stderr.write(f"Done {done} of {len(eids)}, {done/elapsed*60:.0f} samples/min\n")
+    if atlas.modified:
+        sys.stderr.write(f"Wrote {path}\n")
+    elif len(eids)==0:
+        sys.stderr.write(f"{path} is already up to date\n")
+
+    if len(failed)>0:
+        sys.stderr.write(f"{len(failed)} samples failed\n")
+        sys.exit(1)
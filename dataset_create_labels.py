@@ -16,17 +16,16 @@ import datetime
 import io
 import random
 import math
-import zipfile
 import tempfile
 from typing import *
 import numpy as np
-import scipy.spatial
 from contextlib import ExitStack
 from tkinter import *
 from tkinter import ttk
 from PIL import Image, ImageTk
 
 from dataset import command_line_dataset_open_helper, DMPCIParameter, Dataset
+from dataset.snapshots import SnapshotCache
 from dataset_extract_snapshot_slice import crop_image_whitespace
 
 @dataclass
@@ -44,20 +43,20 @@ class ImagePoint:
 
 class ImageGrid(ttk.Frame):
     def _load_image(self, eid:str) -> Image:
-        with zipfile.ZipFile( dataset.dir / f"{eid}.zip" ) as zip:
-            fn = f"dmpccs.{eid}.con.{time}.png"
-            image_bytes=zip.read(f"{eid}/{fn}")
-            assert len(image_bytes)>0
+        image_bytes=self.snapshots.get(eid, self.time) # Rendered on demand if the zip only has the pov
+        assert len(image_bytes)>0
 
-            image= Image.open( io.BytesIO(image_bytes), formats=("jpeg", "png"))
-            image=crop_image_whitespace(image)
-            return image
+        image= Image.open( io.BytesIO(image_bytes), formats=("jpeg", "png"))
+        image=crop_image_whitespace(image)
+        return image
 
-    def __init__(self, parent:ttk.Widget, width:int, height:int, time:int, dataset:Dataset, init:List[str]):
+    def __init__(self, parent:ttk.Widget, width:int, height:int, time:int, dataset:Dataset, init:List[str], snapshots:SnapshotCache):
         super().__init__(parent)
         self.width=width
         self.height=height
+        self.time=time
         self.dataset=dataset
+        self.snapshots=snapshots
 
         init=list(init)
 
@@ -134,7 +133,7 @@ if __name__=="__main__":
 
     (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root)
 
-    kd=scipy.spatial.KDTree(dataset.matrix.configurations)
+    index=dataset.spatial_index()
 
     ncols=3
     nrows=3
@@ -143,7 +142,7 @@ if __name__=="__main__":
 
     def select_closest(p : np.ndarray) -> List[str]:
         print(p)
-        (_,indices) = kd.query(p, k=ncols*nrows)
+        (_,indices) = index.query(p, k=ncols*nrows)
         print(indices)
         eid=list(dataset.matrix.experiments[indices])
         return eid
@@ -165,7 +164,7 @@ if __name__=="__main__":
     time=dataset.matrix.times[-1]
     point=np.array([ (p.minval+p.maxval)/2 for p in dataset.template.parameters.values() ])
     
-    pictures=ImageGrid(mainframe, ncols, nrows, time, dataset, select_closest(point))
+    pictures=ImageGrid(mainframe, ncols, nrows, time, dataset, select_closest(point), SnapshotCache(dataset.dir))
     pictures.grid(column=1, row=0, sticky="NSEW")
 
     def update_point():
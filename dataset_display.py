@@ -14,17 +14,20 @@ import datetime
 import io
 import random
 import math
-import zipfile
 import tempfile
+import concurrent.futures
 from typing import *
 import numpy as np
-import scipy.spatial
 from contextlib import ExitStack
 from tkinter import *
 from tkinter import ttk
 from PIL import Image, ImageTk
 
 from dataset import command_line_dataset_open_helper, DMPCIParameter, Dataset
+from dataset.snapshots import SnapshotCache
+from dataset.thumbnails import ThumbnailAtlas
+from dataset.query_pipeline import QueryPipeline, QueryCancelled
+from dataset_extract_snapshot_slice import crop_image_whitespace
 
 @dataclass
 class ImagePoint:
@@ -44,12 +47,13 @@ if __name__=="__main__":
     )
     parser.add_argument("dataset_dir_or_dmpci_template")
     parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
+    parser.add_argument("--read-only", default=False, action='store_true', help="Only use samples already merged by dataset_merge.py, rather than scanning for new sample zips.")
     
     args=parser.parse_args()
 
-    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root)
+    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, read_only=args.read_only)
 
-    kd=scipy.spatial.KDTree(dataset.matrix.configurations)
+    index=dataset.spatial_index()
 
     ncols=5
     nrows=5
@@ -58,7 +62,7 @@ if __name__=="__main__":
 
     def select_closest(p : np.ndarray) -> List[str]:
         print(p)
-        (_,indices) = kd.query(p, k=ncols*nrows)
+        (_,indices) = index.query(p, k=ncols*nrows)
         print(indices)
         eid=list(dataset.matrix.experiments[indices])
         return eid
@@ -98,29 +102,77 @@ if __name__=="__main__":
     
     time=dataset.matrix.times[-1]
 
-    def update_point():
-        items = select_closest(point)
+    snapshots=SnapshotCache(dataset.dir)
+    thumbnails=ThumbnailAtlas.open_for(dataset.dir, dataset.id)
+    thumbnail_size=thumbnails.best_size(time, max(pwidth,pheight)) if thumbnails is not None else None
+
+    def fit_to_cell(image : Image.Image) -> Image.Image:
+        """
+        Shrinks a cropped image to fit in a cell, keeping its aspect ratio, and centres it on a white background.
+        """
+        image=image.convert("RGB")
+        image.thumbnail((pwidth,pheight))
+        cell=Image.new("RGB", (pwidth,pheight), (255,255,255))
+        cell.paste(image, ((pwidth-image.width)//2, (pheight-image.height)//2))
+        return cell
+
+    def run_query(p : np.ndarray, cancelled : Callable[[],bool]) -> List[Image.Image]:
+        """
+        Runs on the query pipeline's thread: finds the closest samples and loads their images, giving
+        up as soon as a newer point has been posted.
+        """
+        items = select_closest(p)
+        found={} # type: Dict[str,Image.Image]
+        if thumbnail_size is not None:
+            for eid in items:
+                image=thumbnails.get(eid, time, thumbnail_size)
+                if image is not None:
+                    found[eid]=image
+        # Ask for every missing snapshot before waiting on any, so that any renders run in parallel
+        pending={ eid:snapshots.submit(eid, time) for eid in items if eid not in found }
+        images=[]
+        for eid in items:
+            if cancelled():
+                raise QueryCancelled() # Renders already started carry on, and end up in the snapshot cache
+            sys.stderr.write(f"{eid}\n")
+            image=found.get(eid)
+            if image is None:
+                # Wait in short steps, so a render of a point that has been left behind doesn't hold up the next one
+                while not concurrent.futures.wait([pending[eid]], timeout=0.05).done:
+                    if cancelled():
+                        raise QueryCancelled()
+                image_bytes=pending[eid].result()
+                assert len(image_bytes)>0
+                image=Image.open( io.BytesIO(image_bytes), formats=("jpeg", "png"))
+                image=crop_image_whitespace(image) # Thumbnails in the atlas are already cropped
+            images.append(fit_to_cell(image))
+        return images
+
+    def apply_query(p : np.ndarray, images : List[Image.Image]):
         for y in range(nrows):
             for x in range(ncols):
                 linear=y*ncols+x
-                eid = items[linear]
-
-                sys.stderr.write(f"{eid}\n")
-
-                with zipfile.ZipFile( dataset.dir / f"{eid}.zip" ) as zip:
-                    fn = f"dmpccs.{eid}.con.{time}.png"
-                    image_bytes=zip.read(f"{eid}/{fn}")
-                    assert len(image_bytes)>0
-
-                    image=Image.open( io.BytesIO(image_bytes), formats=("jpeg", "png"))
-
-                image=image.resize((pwidth,pheight))
-
-                tkimage=ImageTk.PhotoImage(image)
+                tkimage=ImageTk.PhotoImage(images[linear])
                 tt=xy_to_labels[(x,y)]
                 tt.configure(image=tkimage)
                 # Need to ensure the image is not garbage collected. Hack to keep a reference.
                 tt.dbt_ref=tkimage
+
+    status=StringVar()
+    ttk.Label(mainframe, textvariable=status).grid(column=0, row=1, columnspan=2, sticky="W")
+
+    # Slider callbacks fire many times per drag, so they just post the new point, and the
+    # pipeline queries and loads images for the latest one in the background
+    pipeline=QueryPipeline(run_query, name="slider query")
+
+    def poll_pipeline():
+        if pipeline.poll(apply_query) is not None:
+            status.set(pipeline.summary())
+        root.after(10, poll_pipeline)
+    poll_pipeline()
+
+    def update_point():
+        pipeline.post(point.copy())
                     
     
     def on_slider_changed(value, sv:StringVar, slider:ttk.Scale, param:DMPCIParameter):
@@ -142,3 +194,5 @@ if __name__=="__main__":
         s.configure(command=lambda value, sv=sv, s=s, p=p, : on_slider_changed(value, sv, s, p))
 
     root.mainloop()
+    pipeline.close()
+    sys.stderr.write(pipeline.summary()+"\n")
@@ -14,22 +14,28 @@ import datetime
 import io
 import random
 import math
-import zipfile
 import tempfile
 from typing import *
+import collections
+import queue
+import threading
+import concurrent.futures
 import numpy as np
-import scipy.spatial
 from contextlib import ExitStack
 from tkinter import *
 from tkinter import ttk
 from PIL import Image, ImageTk
 
 from dataset import command_line_dataset_open_helper, DMPCIParameter, Dataset
+from dataset.snapshots import SnapshotCache
+from dataset.thumbnails import ThumbnailAtlas
+from dataset.query_pipeline import QueryPipeline, QueryCancelled
 from dataset_extract_snapshot_slice import crop_image_whitespace
 
 @dataclass
 class ImagePoint:
     eid_current : str # The experiment currently being displayed
+    eid_shown : Optional[str] # The experiment whose image is in the label, which lags eid_current while it loads
     pt_current : np.ndarray # Location of the point being displayed
 
     time_set : datetime.datetime # When the target was last changed
@@ -39,22 +45,122 @@ class ImagePoint:
     textlabel : StringVar
 
 
-class ImageGrid(ttk.Frame):
-    def _load_image(self, eid:str) -> Image:
-        with zipfile.ZipFile( dataset.dir / f"{eid}.zip" ) as zip:
-            fn = f"dmpccs.{eid}.con.{time}.png"
-            image_bytes=zip.read(f"{eid}/{fn}")
-            assert len(image_bytes)>0
-
-            image= Image.open( io.BytesIO(image_bytes), formats=("jpeg", "png"))
-            image=crop_image_whitespace(image)
+class DecodedImageCache:
+    """
+    Bounded LRU cache of snapshots that have been decoded, cropped and shrunk to fit a cell, keyed
+    by (eid, time, size). Images are loaded by a pool of threads, so the Tk thread never waits on a
+    zip, a png decode or a povray render. Images are PIL images, as ImageTk images can only be
+    created on the Tk thread. If a thumbnail atlas is given then images are taken from the smallest
+    thumbnails that are big enough, rather than from the full size snapshots.
+
+    Prefetches run on a separate single thread, so they never queue ahead of images that are being
+    shown, and at most one of them is waiting on a povray render at a time. Prefetches that haven't
+    started are dropped by cancel_prefetch, or moved to the main pool if the image is then requested.
+    """
+    def __init__(self, snapshots:SnapshotCache, capacity:int=512, threads:int=4, thumbnails:Optional[ThumbnailAtlas]=None):
+        self.snapshots=snapshots
+        self.thumbnails=thumbnails
+        self.capacity=capacity
+        self.max_prefetch_backlog=4*threads
+        self._prefetching={} # type: Dict[Tuple[str,int,Tuple[int,int]],concurrent.futures.Future]
+        self._images=collections.OrderedDict() # type: collections.OrderedDict[Tuple[str,int,Tuple[int,int]],Image.Image]
+        self._loading={} # type: Dict[Tuple[str,int,Tuple[int,int]],concurrent.futures.Future]
+        self._lock=threading.Lock()
+        self._pool=concurrent.futures.ThreadPoolExecutor(max_workers=threads)
+        self._prefetch_pool=concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    def _load(self, key:Tuple[str,int,Tuple[int,int]]) -> Image.Image:
+        (eid,time,size)=key
+        try:
+            image=None
+            if self.thumbnails is not None:
+                thumbnail_size=self.thumbnails.best_size(time, max(size))
+                if thumbnail_size is not None:
+                    image=self.thumbnails.get(eid, time, thumbnail_size)
+            if image is None:
+                image_bytes=self.snapshots.get(eid, time) # Rendered on demand if the zip only has the pov
+                assert len(image_bytes)>0
+                image=Image.open( io.BytesIO(image_bytes), formats=("jpeg", "png"))
+                image=crop_image_whitespace(image)
+            image.thumbnail(size)
+            with self._lock:
+                self._images[key]=image
+                while len(self._images)>self.capacity:
+                    self._images.popitem(last=False)
             return image
+        finally:
+            with self._lock:
+                del self._loading[key]
+                self._prefetching.pop(key, None)
+
+    def get_cached(self, eid:str, time:int, size:Tuple[int,int]) -> Optional[Image.Image]:
+        key=(eid,time,size)
+        with self._lock:
+            image=self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+            return image
+
+    def request(self, eid:str, time:int, size:Tuple[int,int]) -> concurrent.futures.Future:
+        """
+        Returns a future for the image, which is already complete if the image is cached.
+        """
+        key=(eid,time,size)
+        with self._lock:
+            image=self._images.get(key)
+            if image is not None:
+                self._images.move_to_end(key)
+                f=concurrent.futures.Future()
+                f.set_result(image)
+                return f
+            prefetch=self._prefetching.pop(key, None)
+            if prefetch is not None and prefetch.cancel():
+                del self._loading[key] # Not started yet, so load it now rather than after the other prefetches
+            if key not in self._loading:
+                self._loading[key]=self._pool.submit(self._load, key)
+            return self._loading[key]
 
-    def __init__(self, parent:ttk.Widget, width:int, height:int, time:int, dataset:Dataset, init:List[str]):
+    def prefetch(self, eids:Iterable[str], time:int, size:Tuple[int,int]):
+        """
+        Starts loading images that may be wanted soon, in the background. Stops early if many
+        prefetches are already queued.
+        """
+        with self._lock:
+            for eid in eids:
+                key=(eid,time,size)
+                if len(self._prefetching)>=self.max_prefetch_backlog:
+                    break
+                if key in self._images or key in self._loading:
+                    continue
+                self._loading[key]=self._prefetching[key]=self._prefetch_pool.submit(self._load, key)
+
+    def cancel_prefetch(self):
+        """
+        Drops prefetches that haven't started, e.g. because the point being shown has moved on.
+        """
+        with self._lock:
+            for (key,f) in list(self._prefetching.items()):
+                if f.cancel():
+                    del self._prefetching[key]
+                    del self._loading[key]
+
+
+class ImageGrid(ttk.Frame):
+    """
+    Grid of snapshot images. Images are loaded in the background through a DecodedImageCache, and each
+    cell is updated on the Tk thread when its image arrives, as long as the cell still wants that sample.
+    """
+    def __init__(self, parent:ttk.Widget, width:int, height:int, time:int, dataset:Dataset, init:List[str], images:DecodedImageCache, size:Tuple[int,int]):
         super().__init__(parent)
         self.width=width
         self.height=height
+        self.time=time
         self.dataset=dataset
+        self.images=images
+        self.size=size
+        self._arrived=queue.Queue() # type: queue.Queue[Tuple[ImagePoint,str,concurrent.futures.Future]]
+        self._blank=ImageTk.PhotoImage(Image.new("RGB", size, (255,255,255)))
+        self._on_shown=None # type: Optional[Callable[[],None]]
 
         init=list(init)
 
@@ -66,39 +172,76 @@ class ImageGrid(ttk.Frame):
                 eid = init.pop( random.randrange(len(init)) )
                 eindex = dataset.matrix.experiments_index[eid]
                 pt = dataset.matrix.configurations[eindex]
-                image = self._load_image(eid)
-                image_tk = ImageTk.PhotoImage(image)
 
-                label = ttk.Label(self, image=image_tk)
+                label = ttk.Label(self, image=self._blank)
                 label.grid(row=2*y, column=x, sticky="NSEW")
                 textlabel=StringVar(self, np.array2string(pt,precision=3,floatmode='fixed'))
                 text = ttk.Label(self, textvariable=textlabel)
                 text.grid(row=2*y+1, column=x)
                 image_point=ImagePoint(
-                    eid, pt, datetime.datetime.now(),
-                    image_tk, label, textlabel
+                    eid, None, pt, datetime.datetime.now(),
+                    self._blank, label, textlabel
                 )
                 self.points.append(image_point)
                 self.xy_to_point[(x,y)]=image_point
                 self.eid_to_point[eid]=image_point
+                self._show_image(image_point, eid)
 
         for c in range(ncols):
             self.columnconfigure(c, weight=1)
         for r in range(nrows):
             self.rowconfigure(2*r, weight=1)
 
+        self._poll_arrived()
+
+    def _show_image(self, target:ImagePoint, eid:str):
+        image=self.images.get_cached(eid, self.time, self.size)
+        if image is not None:
+            target.image=ImageTk.PhotoImage(image)
+            target.widget.configure(image=target.image)
+            target.eid_shown=eid
+            return
+        # Keep the old image until the new one arrives, rather than flashing blank
+        f=self.images.request(eid, self.time, self.size)
+        f.add_done_callback(lambda f: self._arrived.put( (target,eid,f) ))
+
+    def _poll_arrived(self):
+        """
+        Applies images that have finished loading. Runs on the Tk thread, as Tk can't be used from the loader threads.
+        """
+        while not self._arrived.empty():
+            (target,eid,f)=self._arrived.get()
+            if target.eid_current!=eid:
+                continue # The cell has moved on to another sample since this was requested
+            target.eid_shown=eid # Failures count as shown, as nothing more is coming
+            if f.exception() is not None:
+                sys.stderr.write(f"Couldn't load image for {eid} : {f.exception()}\n")
+                continue
+            target.image=ImageTk.PhotoImage(f.result())
+            target.widget.configure(image=target.image)
+        self._check_shown()
+        self.after(20, self._poll_arrived)
+
+    def _check_shown(self):
+        if self._on_shown is not None and all( p.eid_shown==p.eid_current for p in self.points ):
+            (on_shown,self._on_shown)=(self._on_shown,None)
+            on_shown()
+
     def set_point(self, target:ImagePoint, eid:str):
         eindex=dataset.matrix.experiments_index[eid]
         del self.eid_to_point[target.eid_current]
         target.pt_current = dataset.matrix.configurations[eindex]
         target.eid_current=eid
         target.time_set=datetime.datetime.now()
-        target.image=ImageTk.PhotoImage(self._load_image(eid))
-        target.widget.configure(image=target.image)
+        self._show_image(target, eid)
         target.textlabel.set(np.array2string(target.pt_current,precision=3,floatmode='fixed'))
         self.eid_to_point[eid]=target
 
-    def set_images(self, vals:List[str]):
+    def set_images(self, vals:List[str], on_shown:Optional[Callable[[],None]]=None):
+        """
+        Shows the given samples, moving as few cells as possible. on_shown is called (on the Tk thread)
+        once every cell has its image, unless set_images is called again first.
+        """
         assert len(vals) == len(self.points)
         print(f"vals={sorted(vals)}")
         print(f"new = { set(vals) - set(self.eid_to_point.keys())}")
@@ -118,6 +261,9 @@ class ImageGrid(ttk.Frame):
             for j in range(i+1,len(self.points)):
                 assert(self.points[i].eid_current != self.points[j].eid_current)
 
+        self._on_shown=on_shown
+        self._check_shown()
+
 
 if __name__=="__main__":
 
@@ -126,25 +272,53 @@ if __name__=="__main__":
     )
     parser.add_argument("dataset_dir_or_dmpci_template")
     parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
+    parser.add_argument("--read-only", default=False, action='store_true', help="Only use samples already merged by dataset_merge.py, rather than scanning for new sample zips.")
+    parser.add_argument("--image-size", default=256, type=int, help="Images are shrunk to fit in a square of this many pixels.")
+    parser.add_argument("--cache-images", default=512, type=int, help="Number of decoded images to keep in memory.")
     
     args=parser.parse_args()
 
-    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root)
+    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, read_only=args.read_only)
 
-    kd=scipy.spatial.KDTree(dataset.matrix.configurations)
+    index=dataset.spatial_index()
 
     ncols=3
     nrows=3
-    pwidth=128
-    pheight=128
+    pwidth=args.image_size
+    pheight=args.image_size
 
     def select_closest(p : np.ndarray) -> List[str]:
         print(p)
-        (_,indices) = kd.query(p, k=ncols*nrows)
+        (_,indices) = index.query(p, k=ncols*nrows)
         print(indices)
         eid=list(dataset.matrix.experiments[indices])
         return eid
 
+    def find_prefetch(p : np.ndarray) -> List[str]:
+        """
+        Returns the samples whose images are likely to be wanted next: the next closest samples to p,
+        and the closest samples after a small step of each slider in either direction.
+        """
+        targets=[p]
+        for (i,param) in enumerate(dataset.template.parameters.values()):
+            for step in (-0.05, 0.05):
+                q=p.copy()
+                q[i]=min(param.maxval, max(param.minval, q[i]+step*(param.maxval-param.minval)))
+                targets.append(q)
+        k=min(2*ncols*nrows, dataset.matrix.nExperiments)
+        (_,indices) = index.query(np.array(targets), k=k)
+        wanted=dict.fromkeys( int(i) for i in indices.ravel() ) # Unique, in order of closeness to p
+        return [ dataset.matrix.experiments[i] for i in wanted ]
+
+    def run_query(p : np.ndarray, cancelled : Callable[[],bool]) -> Tuple[List[str],List[str]]:
+        """
+        Runs on the query pipeline's thread, so the kd-tree searches don't hold up the UI.
+        """
+        items = select_closest(p)
+        if cancelled():
+            raise QueryCancelled()
+        return (items, find_prefetch(p))
+
 
     root = Tk()
     root.title(f"DPD Exploration - {dataset.id}")
@@ -162,12 +336,37 @@ if __name__=="__main__":
     time=dataset.matrix.times[-1]
     point=np.array([ (p.minval+p.maxval)/2 for p in dataset.template.parameters.values() ])
     
-    pictures=ImageGrid(mainframe, ncols, nrows, time, dataset, select_closest(point))
+    images=DecodedImageCache(SnapshotCache(dataset.dir), capacity=args.cache_images, thumbnails=ThumbnailAtlas.open_for(dataset.dir, dataset.id))
+    pictures=ImageGrid(mainframe, ncols, nrows, time, dataset, select_closest(point), images, (pwidth,pheight))
     pictures.grid(column=1, row=0, sticky="NSEW")
+    images.prefetch(find_prefetch(point), time, (pwidth,pheight))
+
+    status=StringVar()
+    ttk.Label(mainframe, textvariable=status).grid(column=0, row=1, columnspan=2, sticky="W")
+
+    def apply_query(p : np.ndarray, result : Tuple[List[str],List[str]]):
+        (items,prefetch)=result
+        images.cancel_prefetch()
+        pictures.set_images(items, on_shown=on_shown)
+        images.prefetch(prefetch, time, (pwidth,pheight))
+
+    # Applying a result only requests the images, so the frame counts as shown once they have all arrived
+    def on_shown():
+        pipeline.displayed()
+        status.set(pipeline.summary())
+
+    # Slider callbacks fire many times per drag, so they just post the new point, and the
+    # pipeline queries for the latest one in the background
+    pipeline=QueryPipeline(run_query, name="slider query")
+
+    def poll_pipeline():
+        if pipeline.poll(apply_query) is not None:
+            status.set(pipeline.summary())
+        root.after(10, poll_pipeline)
+    poll_pipeline()
 
     def update_point():
-        items = select_closest(point)
-        pictures.set_images(items)                    
+        pipeline.post(point.copy())
     
     def on_slider_changed(value, sv:StringVar, slider:ttk.Scale, param:DMPCIParameter):
         sv.set(f"{float(value):.2f}")
@@ -188,3 +387,5 @@ if __name__=="__main__":
         s.configure(command=lambda value, sv=sv, s=s, p=p, : on_slider_changed(value, sv, s, p))
 
     root.mainloop()
+    pipeline.close()
+    sys.stderr.write(pipeline.summary()+"\n")
@@ -14,9 +14,12 @@ import zipfile
 import tempfile
 import getpass
 import datetime
+import shlex
 from contextlib import ExitStack
 
 from dataset import DMPCITemplate, Dataset, parse_dmpcas, command_line_dataset_open_helper
+from dataset.scheduling import parse_slurm_time
+from dataset.samplers import samplers
 
 
 
@@ -30,14 +33,23 @@ if __name__=="__main__":
     parser.add_argument("num_tasks", nargs="?", default=1, help="Number of tasks to enqueue.")
     parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
     parser.add_argument("--dpd-path", default="dpd", type=str, help="Give the path to the osprey dpd executable, or the name of a comand that is accessible on PATH.")
-    parser.add_argument("--tags", default="random", type=str, help='List of comma separated tags to assigned to samples.')
-    parser.add_argument("--repeats-per-cpu", default=1, type=int, help='Number of random simulation runs to perform per core.')
+    parser.add_argument("--tags", default=None, type=str, help='List of comma separated tags to assigned to samples. Default is the name of the sampler.')
+    parser.add_argument("--sampler", default="random", choices=["random"]+list(samplers.keys()), help="How to choose parameters (see dataset_run_samples.py). With a design sampler all tasks share one design.")
+    parser.add_argument("--design-size", default=None, type=int, help="Number of points in an 'lhs' or 'maximin' design.")
+    parser.add_argument("--repeats-per-cpu", default=None, type=int, help='Maximum number of random simulation runs to perform per core. Default is to keep starting samples while they are predicted to finish before the job time runs out.')
+    parser.add_argument("--time-margin", default="5:00", type=str, help="Time (MM:SS or HH:MM:SS) held back from the job run time for start-up and finishing off, when deciding whether a sample can finish in time.")
     parser.add_argument("--render-povray", default=False, action='store_true', help="Render the pov files using povray and then add into the output zip.")
     parser.add_argument("--keep-pov", default=False, action='store_true', help='Store compressed pov files into zip')
     parser.add_argument("--keep-rst", default=False, action='store_true', help='Store compressed rst files into zip')
     parser.add_argument("--keep-dat", default=False, action='store_true', help='Store compressed dat files into zip')
     parser.add_argument("--preserve-working", default=False, action='store_true', help='Dont delete the working directory when the run finishes.')
-    parser.add_argument("--working-dir", default=None, help="Directory to create temporary directories in, and aso  If nothing is specified then '/scratch/{USER}/dpd_explore_temp/{RUN_ID}/{DATE}' is used")
+    parser.add_argument("--observable-layout", default=None, choices=["compact","extended"], help="Which observables to keep from dmpcas (see dataset_run_samples.py). Default is to match the samples already in the dataset.")
+    parser.add_argument("--separate-jobs", default=False, action='store_true', help="Submit num_tasks separate jobs, rather than one array job with num_tasks elements.")
+    parser.add_argument("--array-throttle", default=None, type=int, help="Maximum number of array tasks to run at once.")
+    parser.add_argument("--cpus-per-task", default=None, type=int, help="Run each task on this many cores, allowing tasks to share nodes, with each dpd bound to its own core. Default is to take a whole node per task.")
+    parser.add_argument("--mem-per-cpu", default=2000, type=int, help="Memory in MB to request per core, when using --cpus-per-task.")
+    parser.add_argument("--sbatch-command", default="sbatch", type=str, help="Command used to submit the job script, e.g. the path of fake_sbatch.py for testing.")
+    parser.add_argument("--working-dir", default=None, help="Directory to create temporary directories in, and aso  If nothing is specified then '/scratch/{USER}/dpd_explore_temp/{RUN_ID}' is used")
 
     args=parser.parse_args()
 
@@ -60,16 +72,49 @@ if __name__=="__main__":
     today=datetime.datetime.today()
     today_str=today.strftime("%Y-%m-%d--%H-%M-%S")
     if args.working_dir is None:
-        working_dir = Path(f"/scratch/{getpass.getuser()}/dpd_explore_temp/{dataset.id}/{today_str}")
-        working_dir.mkdir(exist_ok=False,parents=True)
+        # Not specific to this submission, so later jobs can resume samples that earlier jobs didn't finish
+        working_dir = Path(f"/scratch/{getpass.getuser()}/dpd_explore_temp/{dataset.id}")
+        working_dir.mkdir(exist_ok=True,parents=True)
     else:
         working_dir = Path(args.working_dir)
         working_dir.mkdir(exist_ok=True,parents=True)
 
     job_run_time=args.job_run_time
+    time_budget=parse_slurm_time(job_run_time)-parse_slurm_time(args.time_margin)
+    if time_budget<=0:
+        sys.stderr.write(f"Time margin of {args.time_margin} leaves no time to run samples in {job_run_time}\n")
+        sys.exit(1)
 
     dpd_exploration_dir=os.path.abspath( os.path.dirname(sys.argv[0]) )
 
+    num_tasks=int(args.num_tasks)
+    if args.cpus_per_task is None:
+        resources_script="""\
+#SBATCH --exclusive     # Request all cores on the node, without specifying exactly (AMD and Intel nodes have different core count)
+#SBATCH --mem=32000      # Can't imagine it taking more than 32GB even with 64 cores (famous last words...)"""
+    else:
+        resources_script=f"""\
+#SBATCH --cpus-per-task={args.cpus_per_task}
+#SBATCH --mem-per-cpu={args.mem_per_cpu}"""
+    if not args.separate_jobs:
+        throttle=f"%{args.array_throttle}" if args.array_throttle else ""
+        resources_script += f"\n#SBATCH --array=0-{num_tasks-1}{throttle}"
+
+    # Without a limit on repeats, dataset_run_samples.py keeps going until the time budget runs out
+    repeats_script=""
+    if args.repeats_per_cpu is not None:
+        repeats_script=f'REPEATS=$(( PROCESSES * {args.repeats_per_cpu} ))\n>&2 echo "Requesting at most $REPEATS samples in total"\n'
+
+    # Each array task gets its own deterministic stream of seeds, so a requeued task won't redo samples.
+    # Design samplers instead share out the points of the design between tasks.
+    if args.sampler=="random":
+        seed_stream=f"{dataset.id}-{today_str}-{random.randint(0,2**32-1):08x}-${{SLURM_ARRAY_TASK_ID:-$SLURM_JOB_ID}}"
+        sampler_options=f'--seed-stream="{seed_stream}"'
+    else:
+        sampler_options=f'--sampler={args.sampler}' + (f' --design-size={args.design_size}' if args.design_size is not None else '')
+    if args.tags is not None:
+        sampler_options += f' --tags="{args.tags}"'
+
     jobfile=working_dir / f"job-{dataset.id}-{today_str}.sh"
     with open(jobfile,"wt") as dst:
         dst.write(
@@ -77,25 +122,30 @@ f'''\
 #!/bin/bash
 #SBATCH --nodes=1
 #SBATCH --ntasks=1
-#SBATCH --exclusive     # Request all cores on the node, without specifying exactly (AMD and Intel nodes have different core count)
-#SBATCH --mem=32000      # Can't imagine it taking more than 32GB even with 64 cores (famous last words...)
+{resources_script}
 #SBATCH --time={job_run_time}
 
->&2 echo "SLURM_CPUS_ON_NODE=$SLURM_CPUS_ON_NODE"
-
-REPEATS=$(( SLURM_CPUS_ON_NODE * {args.repeats_per_cpu} ))
->&2 echo "Requesting $REPEATS samples in total"
+>&2 echo "SLURM_CPUS_ON_NODE=$SLURM_CPUS_ON_NODE SLURM_CPUS_PER_TASK=$SLURM_CPUS_PER_TASK SLURM_ARRAY_TASK_ID=$SLURM_ARRAY_TASK_ID"
+PROCESSES=${{SLURM_CPUS_PER_TASK:-$SLURM_CPUS_ON_NODE}}
 
+{repeats_script}
 cd {dpd_exploration_dir}
-python3 dataset_run_samples.py "{dataset_dir}" --dpd-path="{dpd_path}" --tags="{args.tags}" --repeats="$REPEATS" --num-processes="$SLURM_CPUS_ON_NODE" --working-dir="{working_dir}" \
+python3 dataset_run_samples.py "{dataset_dir}" --dpd-path="{dpd_path}" --time-budget={time_budget:.0f} --num-processes="$PROCESSES" --working-dir="{working_dir}" \
+    {sampler_options} {"--bind-cores" if args.cpus_per_task is not None else "" } \
+    {'--repeats="$REPEATS"' if args.repeats_per_cpu is not None else "" } \
     {"--render-povray" if args.render_povray else "" } \
     {"--keep-pov" if args.keep_pov else "" } \
     {"--keep-rst" if args.keep_rst else "" } \
     {"--keep-dat" if args.keep_dat else "" } \
     {"--preserve-working" if args.preserve_working else "" } \
+    {f"--observable-layout={args.observable_layout}" if args.observable_layout else "" } \
 
 '''
         )
 
-    for i in range(int(args.num_tasks)):
-        os.system(f"sbatch {jobfile}")
\ No newline at end of file
+    sbatch=shlex.split(args.sbatch_command)
+    for i in range(num_tasks if args.separate_jobs else 1):
+        res=subprocess.run(sbatch+[str(jobfile)])
+        if res.returncode!=0:
+            sys.stderr.write(f"Submission of {jobfile} failed with code {res.returncode}\n")
+            sys.exit(1)
\ No newline at end of file
@@ -12,6 +12,8 @@ from pathlib import Path
 from dataset import command_line_dataset_open_helper
 from dataset import DMPCIParameter, Dataset
 
+from dataset.snapshots import SnapshotCache
+from dataset.thumbnails import ThumbnailAtlas
 from dataset_extract_snapshot_slice import create_2d_mosaic_from_slice_ids, find_2d_parameter_slice_ids
 
 if __name__=="__main__":
@@ -30,10 +32,13 @@ Files will be of the form:
     parser.add_argument("width", nargs="?", default=None, help="Number of images along x. Default is max(3, min(10, ceil(pow(nSamples,1.3/d))))")
     parser.add_argument("height", nargs="?", default=None, help="Number of images along y. Default is max(3, min(10, ceil(pow(nSamples,1.3/d))))")
     parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
+    parser.add_argument("--read-only", default=False, action='store_true', help="Only use samples already merged by dataset_merge.py, rather than scanning for new sample zips.")
+    parser.add_argument("--unique", default=False, action='store_true', help="Don't use the same sample for more than one cell of a slice.")
+    parser.add_argument("--thumbnail-size", default=None, type=int, help="Shrink each image to fit in this many pixels, using the thumbnails from dataset_build_thumbnails.py where possible. Default is full size images.")
     
     args=parser.parse_args()
 
-    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root)
+    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, read_only=args.read_only)
 
     if dataset.matrix==None:
         sys.stderr.write("Dataset is empty.\n")
@@ -60,23 +65,31 @@ Files will be of the form:
     sys.stderr.write(f"Scaling up x and y parameters by {sel_scale} for distance search\n")
 
 
-    for i1 in range(0,d-1):
-        x_param = dataset.get_parameter(i1)
-        for i2 in range(i1+1,d):
-            y_param = dataset.get_parameter(i2)
+    thumbnails=None
+    if args.thumbnail_size is not None:
+        thumbnails=ThumbnailAtlas.open_for(dataset.dir, dataset.id)
+        if thumbnails is None:
+            sys.stderr.write("No thumbnails have been built, so shrinking full size images. Use dataset_build_thumbnails.py to make this faster.\n")
 
-            #################################################################
-            ## Work out samples closest to the target point
+    # One cache for all the slices, so each snapshot is rendered at most once
+    with SnapshotCache(dataset.dir) as snapshots:
+        for i1 in range(0,d-1):
+            x_param = dataset.get_parameter(i1)
+            for i2 in range(i1+1,d):
+                y_param = dataset.get_parameter(i2)
 
-            xy_map_to_eid = find_2d_parameter_slice_ids(dataset, sel_scale, x_param, y_param, width, height)
+                #################################################################
+                ## Work out samples closest to the target point
 
+                xy_map_to_eid = find_2d_parameter_slice_ids(dataset, sel_scale, x_param, y_param, width, height, unique=args.unique)
 
-            ################################################################
-            ## Extract all the images for the samples and crop them
 
-            res = create_2d_mosaic_from_slice_ids(dataset, time, xy_map_to_eid)
+                ################################################################
+                ## Extract all the images for the samples and crop them
 
-            ###############################################################
-            ## Now write it out
+                res = create_2d_mosaic_from_slice_ids(dataset, time, xy_map_to_eid, snapshots=snapshots, thumbnails=thumbnails, thumbnail_size=args.thumbnail_size)
+
+                ###############################################################
+                ## Now write it out
                 
-            res.save( f"{output_prefix}__{x_param.name}__{y_param.name}.png" )
+                res.save( f"{output_prefix}__{x_param.name}__{y_param.name}.png" )
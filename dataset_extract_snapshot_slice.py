@@ -2,15 +2,15 @@
 import sys
 import argparse
 import numpy as np
-import zipfile
 import math
 import io
-import scipy.spatial
 from typing import Dict, List, Tuple, Optional
 from PIL import Image, ImageOps
 from pathlib import Path
 from dataset import command_line_dataset_open_helper
 from dataset import DMPCIParameter, Dataset
+from dataset.snapshots import SnapshotCache
+from dataset.thumbnails import ThumbnailAtlas
 
 def crop_image_whitespace(img):
     neg=ImageOps.invert(img)
@@ -18,45 +18,66 @@ def crop_image_whitespace(img):
     assert(bbox is not None)
     return img.crop(bbox)
 
-def find_2d_parameter_slice_ids(dataset:Dataset, sel_scale:float, x_param:DMPCIParameter, y_param:DMPCIParameter, width:int, height:int):
+def find_2d_parameter_slice_ids(dataset:Dataset, sel_scale:float, x_param:DMPCIParameter, y_param:DMPCIParameter, width:int, height:int, unique:bool=False):
     """
     sel_scale is a factor that increases the weight of the selected parameters when finding the closest point.
     With many dimensions the closest point can often be somewhere else that is a long way from the
     desired point, so we want to increase the importance of being close to the selected parameters rather
-    than the mid-point of the unselected ranges.
-    """
-    adjusted = dataset.matrix.configurations.copy()
-    adjusted[ :, x_param.index ] *= sel_scale
-    adjusted[ :, y_param.index ] *= sel_scale
-
-    kd=scipy.spatial.KDTree(adjusted)
-
-    target = np.array( [ (p.minval+p.maxval)/2 for p in dataset.template.parameters.values()  ] , dtype=np.float64)
-
-    x0 = x_param.minval
-    dx = (x_param.maxval - x_param.minval) / (width-1)
-
-    y0 = y_param.minval
-    dy = (y_param.maxval - y_param.minval) / (height-1)
+    than the mid-point of the unselected ranges. Distances are measured with each parameter normalised to [0,1].
 
+    If unique is set then each sample is used for at most one cell (as long as there are enough samples),
+    with the cells that have the closest matches choosing first.
+    """
+    index=dataset.spatial_index()
+    scale=np.ones( shape=(len(dataset.template.parameters),), dtype=np.float64 )
+    scale[x_param.index] = sel_scale
+    scale[y_param.index] = sel_scale
+
+    centre = np.array( [ (p.minval+p.maxval)/2 for p in dataset.template.parameters.values()  ] , dtype=np.float64)
+
+    # All width*height targets at once, with cell (xi,yi) in row xi*height+yi
+    (xs,ys)=np.meshgrid(np.linspace(x_param.minval, x_param.maxval, width), np.linspace(y_param.minval, y_param.maxval, height), indexing="ij")
+    targets=np.tile(centre, (width*height,1))
+    targets[:,x_param.index]=xs.ravel()
+    targets[:,y_param.index]=ys.ravel()
+
+    if unique and index.n<width*height:
+        sys.stderr.write(f"Warning: only {index.n} samples for {width*height} cells, so ignoring --unique and cells may repeat samples\n")
+    if not unique or index.n<width*height:
+        (dist,idx)=index.query(targets, scale=scale)
+    else:
+        # Any cell has at most width*height-1 of its candidates taken by other cells
+        (cand_d,cand_i)=index.query(targets, k=width*height, scale=scale)
+        cand_i=cand_i.reshape(width*height,-1)
+        cand_d=cand_d.reshape(width*height,-1)
+        dist=np.zeros( shape=(width*height,) )
+        idx=np.zeros( shape=(width*height,), dtype=np.int64 )
+        used=set()
+        for cell in np.argsort(cand_d[:,0], kind="stable"):
+            for (d,i) in zip(cand_d[cell],cand_i[cell]):
+                if i not in used:
+                    used.add(i)
+                    (dist[cell],idx[cell])=(d,i)
+                    break
+
+    eids=dataset.matrix.experiments[idx]
+    sys.stderr.write(f"Slice {x_param.name} x {y_param.name} : {len(set(idx))} distinct samples for {width*height} cells, max distance {np.max(dist):.3g}\n")
     xy_map_to_eid = {} # type: Dict[Tuple[int,int],str]
     for xi in range(0,width):
-        target[x_param.index] = ( x0 + dx * xi ) * sel_scale
         for yi in range(0,height):
-            target[y_param.index] = ( y0 + dy * yi ) * sel_scale
-            (_,idx)=kd.query(target)
-            pt=dataset.matrix.configurations[idx,:]
-            eid=dataset.matrix.experiments[idx]
-
-            real_target=target.copy()
-            real_target[x_param.index] /= sel_scale
-            real_target[y_param.index] /= sel_scale
-            sys.stderr.write(f"({xi},{yi}) -> {real_target} -> {pt} -> {eid}\n")
-
-            xy_map_to_eid[(xi,yi)] = eid
+            xy_map_to_eid[(xi,yi)] = eids[xi*height+yi]
     return xy_map_to_eid
 
-def create_2d_mosaic_from_slice_ids(dataset, time, xy_map_to_eid:Dict[Tuple[int,int],str], width:Optional[int]=None, height:Optional[int]=None):
+def create_2d_mosaic_from_slice_ids(dataset, time, xy_map_to_eid:Dict[Tuple[int,int],str], width:Optional[int]=None, height:Optional[int]=None, snapshots:Optional[SnapshotCache]=None,
+        thumbnails:Optional[ThumbnailAtlas]=None, thumbnail_size:Optional[int]=None):
+    """
+    Snapshots are taken from the given cache, which renders any that are missing. By default a cache
+    with the default settings for the dataset is used.
+
+    If thumbnail_size is given then each image is shrunk to fit in thumbnail_size x thumbnail_size, and
+    images are read from the thumbnail atlas if given, falling back to the snapshots for samples that
+    aren't in it.
+    """
     if width is None or height is None:
         max_x = -1
         max_y = -1
@@ -70,30 +91,52 @@ def create_2d_mosaic_from_slice_ids(dataset, time, xy_map_to_eid:Dict[Tuple[int,
 
     max_image_width=0
     max_image_height=0
-    xy_map_to_image={} # type: Dict[Tuple[int,int],Image.Image]
-    for xi in range(0,width):
-        for yi in range(0,height):
-            eid = xy_map_to_eid[(xi,yi)]
+    cells=[ (xi,yi) for xi in range(0,width) for yi in range(0,height) ]
 
-            with zipfile.ZipFile( dataset.dir / f"{eid}.zip" ) as zip:
-                fn = f"dmpccs.{eid}.con.{time}.png"
-                image_bytes=zip.read(f"{eid}/{fn}")
-                assert len(image_bytes)>0
+    xy_map_to_image={} # type: Dict[Tuple[int,int],Image.Image]
+    atlas_size=None
+    if thumbnails is not None and thumbnail_size is not None:
+        atlas_size=thumbnails.best_size(int(time), thumbnail_size)
+    if atlas_size is not None:
+        for c in cells:
+            image=thumbnails.get(xy_map_to_eid[c], int(time), atlas_size)
+            if image is not None:
+                xy_map_to_image[c]=image
+
+    missing=[ c for c in cells if c not in xy_map_to_image ]
+    if len(missing)>0:
+        if snapshots is None:
+            with SnapshotCache(dataset.dir) as snapshots:
+                all_bytes=snapshots.get_many([ xy_map_to_eid[c] for c in missing ], time)
+        else:
+            all_bytes=snapshots.get_many([ xy_map_to_eid[c] for c in missing ], time)
+        for (c,image_bytes) in zip(missing,all_bytes):
+            assert len(image_bytes)>0
 
             image=Image.open( io.BytesIO(image_bytes), formats=("jpeg", "png"))
-            image=crop_image_whitespace(image)
+            xy_map_to_image[c]=crop_image_whitespace(image.convert("RGB")) # As dataset_build_thumbnails.py does
+
+    for c in cells:
+        image=xy_map_to_image[c].convert("RGB")
+        if thumbnail_size is not None:
+            # Atlas thumbnails may be a larger size, so shrink them the same way as the full size images
+            image.thumbnail( (thumbnail_size,thumbnail_size) )
+        xy_map_to_image[c]=image
 
-            max_image_height=max(max_image_height, image.height)
-            max_image_width=max(max_image_width, image.width)
+        max_image_height=max(max_image_height, image.height)
+        max_image_width=max(max_image_width, image.width)
 
-            xy_map_to_image[(xi,yi)] = image
+    if thumbnail_size is not None:
+        # Every cell is the same size whichever images are in the slice, as for the display tools
+        (max_image_width,max_image_height)=(thumbnail_size,thumbnail_size)
 
     allw=max_image_width*width
     allh=max_image_height*height
     res=Image.new("RGB", (allw, allh), (255,255,255))
 
+    # Each image is centred in its cell, so images with different aspect ratios line up
     for ((x,y),img) in xy_map_to_image.items():
-        res.paste(img, (x*max_image_width, y*max_image_height))
+        res.paste(img, (x*max_image_width+(max_image_width-img.width)//2, y*max_image_height+(max_image_height-img.height)//2))
     return res
 
 if __name__=="__main__":
@@ -114,10 +157,13 @@ other parameterss.
     parser.add_argument("width", nargs="?", default=None, help="Number of images along x. Default is max(3, min(10, ceil(pow(nSamples,1.3/d))))")
     parser.add_argument("height", nargs="?", default=None, help="Number of images along y. Default is max(3, min(10, ceil(pow(nSamples,1.3/d))))")
     parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
+    parser.add_argument("--read-only", default=False, action='store_true', help="Only use samples already merged by dataset_merge.py, rather than scanning for new sample zips.")
+    parser.add_argument("--unique", default=False, action='store_true', help="Don't use the same sample for more than one cell.")
+    parser.add_argument("--thumbnail-size", default=None, type=int, help="Shrink each image to fit in this many pixels, using the thumbnails from dataset_build_thumbnails.py where possible. Default is full size images.")
     
     args=parser.parse_args()
 
-    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root)
+    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, read_only=args.read_only)
 
     if dataset.matrix==None:
         sys.stderr.write("Dataset is empty.\n")
@@ -162,13 +208,18 @@ other parameterss.
 
     sel_scale=d
     sys.stderr.write(f"Scaling up x and y parameters by {sel_scale} for distance search\n")
-    xy_map_to_eid = find_2d_parameter_slice_ids(dataset, sel_scale, x_param, y_param, width, height)
+    xy_map_to_eid = find_2d_parameter_slice_ids(dataset, sel_scale, x_param, y_param, width, height, unique=args.unique)
 
 
     ################################################################
     ## Extract all the images for the samples and crop them
 
-    res = create_2d_mosaic_from_slice_ids(dataset, time, xy_map_to_eid)
+    thumbnails=None
+    if args.thumbnail_size is not None:
+        thumbnails=ThumbnailAtlas.open_for(dataset.dir, dataset.id)
+        if thumbnails is None:
+            sys.stderr.write("No thumbnails have been built, so shrinking full size images. Use dataset_build_thumbnails.py to make this faster.\n")
+    res = create_2d_mosaic_from_slice_ids(dataset, time, xy_map_to_eid, thumbnails=thumbnails, thumbnail_size=args.thumbnail_size)
 
     ###############################################################
     ## Now write it out
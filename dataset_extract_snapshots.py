@@ -2,9 +2,9 @@
 import sys
 import argparse
 import numpy as np
-import zipfile
 from pathlib import Path
 from dataset import command_line_dataset_open_helper
+from dataset.snapshots import SnapshotCache
 
 if __name__=="__main__":
 
@@ -14,10 +14,11 @@ if __name__=="__main__":
     parser.add_argument("dataset_dir_or_dmpci_template")
     parser.add_argument("output_dir", help="Where to put all the images")
     parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
+    parser.add_argument("--read-only", default=False, action='store_true', help="Only use samples already merged by dataset_merge.py, rather than scanning for new sample zips.")
     
     args=parser.parse_args()
 
-    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root)
+    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, read_only=args.read_only)
 
     if dataset.matrix==None:
         sys.stderr.write("Dataset is empty.\n")
@@ -29,8 +30,11 @@ if __name__=="__main__":
 
     time=dataset.matrix.times[-1]
 
-    for ei in np.nditer(dataset.matrix.experiments[0:dataset.matrix.nExperiments], flags=("refs_ok",)):
-        with zipfile.ZipFile( dataset.dir / f"{ei}.zip" ) as zip:
-            fn = f"dmpccs.{ei}.con.{time}.png"
-            bytes=zip.read(f"{ei}/{fn}")
-            ( output_dir / fn ).write_bytes(bytes)
+    # Missing snapshots are rendered, so fetch them in batches to keep all the cores busy
+    eids=[ str(e) for e in dataset.matrix.experiments[0:dataset.matrix.nExperiments] ]
+    with SnapshotCache(dataset.dir) as snapshots:
+        for begin in range(0, len(eids), 64):
+            batch=eids[begin:begin+64]
+            for (ei,bytes) in zip(batch, snapshots.get_many(batch, time)):
+                fn = f"dmpccs.{ei}.con.{time}.png"
+                ( output_dir / fn ).write_bytes(bytes)
@@ -23,10 +23,17 @@ if __name__=="__main__":
     )
     parser.add_argument("dataset_dir_or_dmpci_template")
     parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
+    parser.add_argument("--jobs", default="1", type=str, help="Number of processes used to decode new sample zips. Either integer number, or 'max' for number of CPUs.")
     
     args=parser.parse_args()
 
-    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root)
+    if args.jobs=="max":
+        jobs=os.cpu_count()
+    else:
+        jobs=int(args.jobs)
+    jobs=max(1, jobs)
+
+    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, merge_jobs=jobs)
 
     if dataset.matrix_dirty_count==0:
         sys.stderr.write("Dataset is already merged\n")    
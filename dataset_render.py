@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+import sys
+import argparse
+from pathlib import Path
+import multiprocessing
+import os
+import bz2
+import time
+import shutil
+import zipfile
+import tempfile
+from dataclasses import dataclass
+from typing import *
+
+from dataset import command_line_dataset_open_helper
+from dataset.povray import render_pov, pov_snapshot_time, default_width, default_height
+
+@dataclass
+class RenderConfig:
+    times:Optional[Set[int]] # None means every snapshot
+    width:int = default_width
+    height:int = default_height
+    povray:str = "povray"
+    force:bool = False
+
+# Set once per worker process by init_worker
+_config=None # type: Optional[RenderConfig]
+
+def init_worker(config:RenderConfig):
+    global _config
+    _config=config
+
+def render_sample(path:Path) -> Tuple[str,int,Optional[str]]:
+    """
+    Renders the compressed pov snapshots inside one sample zip, and adds the pngs to the zip.
+    A snapshot that fails to render doesn't stop the others, and the ones that succeeded are still added.
+    Returns (id, number rendered, errors or None).
+    """
+    config=_config
+    id=path.name[:-4]
+    try:
+        with zipfile.ZipFile(path) as src:
+            names=set(src.namelist())
+            todo=[]
+            for name in sorted(names):
+                if not name.endswith(".pov.bz2"):
+                    continue
+                t=pov_snapshot_time(name)
+                if t is None or (config.times is not None and t not in config.times):
+                    continue
+                png_name=name[:-len(".pov.bz2")]+".png"
+                if png_name in names and not config.force:
+                    continue
+                todo.append( (name,png_name,src.read(name)) )
+        if len(todo)==0:
+            return (id, 0, None)
+
+        rendered=[] # type: List[Tuple[str,bytes]]
+        errors=[] # type: List[str]
+        with tempfile.TemporaryDirectory() as tmp:
+            for (name,png_name,data) in todo:
+                pov=Path(tmp) / Path(name[:-len(".bz2")]).name
+                pov.write_bytes(bz2.decompress(data))
+                png=render_pov(pov, config.width, config.height, config.povray)
+                if not png.exists():
+                    errors.append(f"povray didn't produce {png.name}, see log below:\n{(pov.parent / (pov.name+'.povray.log')).read_text()}")
+                    continue
+                rendered.append( (png_name,png.read_bytes()) )
+            error="\n".join(errors) if len(errors)>0 else None
+            if len(rendered)==0:
+                return (id, 0, error)
+
+            # Write the new zip alongside then swap it in, so the sample is never left partial.
+            # The temporary name doesn't match sample_*.zip, so is never seen as a sample.
+            tmp_path=path.with_name(path.name+".tmp")
+            replaced={ png_name for (png_name,_) in rendered if png_name in names }
+            if len(replaced)==0:
+                shutil.copyfile(path, tmp_path)
+            else:
+                # Zips can't replace members in place, so copy everything except the old images
+                with zipfile.ZipFile(path) as src, zipfile.ZipFile(tmp_path, "w") as dst:
+                    for info in src.infolist():
+                        if info.filename not in replaced:
+                            dst.writestr(info, src.read(info))
+            with zipfile.ZipFile(tmp_path, "a") as dst:
+                for (png_name,data) in rendered:
+                    # pngs are already compressed
+                    dst.writestr(png_name, data, compress_type=zipfile.ZIP_STORED)
+            os.replace(tmp_path, path)
+        return (id, len(rendered), error)
+    except Exception as e:
+        return (id, 0, f"{type(e).__name__}: {e}")
+
+
+if __name__=="__main__":
+
+    parser=argparse.ArgumentParser(
+        "dataset_render.py",
+        description=
+"""
+Render the povray snapshots stored in sample zips (from dataset_run_samples.py --keep-pov)
+into png images, and add the images to the zips. This moves rendering off the critical
+path of the simulations, uses all the cores, and only renders the snapshot times that are
+needed. By default only the last time is rendered, as that is what the display tools show.
+"""
+    )
+    parser.add_argument("dataset_dir_or_dmpci_template")
+    parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
+    parser.add_argument("--time", default=[], action="append", type=int, help="Render snapshots at this time. Can be given multiple times. Default is the last time in the dataset.")
+    parser.add_argument("--all-times", default=False, action='store_true', help="Render snapshots at every time.")
+    parser.add_argument("--force", default=False, action='store_true', help="Render snapshots that already have an image.")
+    parser.add_argument("--width", default=default_width, type=int, help="Image width in pixels.")
+    parser.add_argument("--height", default=default_height, type=int, help="Image height in pixels.")
+    parser.add_argument("--povray", default="povray", help="Path to the povray executable, or the name of a command on PATH.")
+    parser.add_argument("--jobs", default="max", type=str, help="Either integer number of processes, or 'max' for number of CPUs.")
+
+    args=parser.parse_args()
+
+    if args.jobs=="max":
+        jobs=os.cpu_count()
+    else:
+        jobs=int(args.jobs)
+    jobs=max(1, jobs)
+
+    if shutil.which(args.povray) is None:
+        sys.stderr.write(f"Couldn't find povray executable '{args.povray}'\n")
+        sys.exit(1)
+
+    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, read_only=True)
+
+    if args.all_times:
+        times=None
+    elif len(args.time)>0:
+        times=set(args.time)
+    else:
+        if dataset.matrix is None:
+            sys.stderr.write("No samples have been merged, so the times aren't known. Use --time or --all-times.\n")
+            sys.exit(1)
+        times={ int(dataset.matrix.times[-1]) }
+
+    with os.scandir(dataset.dir) as it:
+        paths=sorted( Path(e.path) for e in it if e.name.startswith("sample_") and e.name.endswith(".zip") )
+    sys.stderr.write(f"Rendering times {'all' if times is None else sorted(times)} for {len(paths)} samples using {jobs} processes\n")
+
+    config=RenderConfig(times, args.width, args.height, args.povray, args.force)
+
+    failed=[] # type: List[Tuple[str,str]]
+    total=0
+    start=time.time()
+    with multiprocessing.Pool(processes=jobs, initializer=init_worker, initargs=(config,)) as pool:
+        for (done,(id,rendered,error)) in enumerate(pool.imap_unordered(render_sample, paths), start=1):
+            if error is not None:
+                failed.append( (id,error) )
+                sys.stderr.write(f"Failed {id} : {error}\n")
+            total += rendered
+            if (done%100)==0 or done==len(paths):
+                elapsed=max(1e-9, time.time()-start)
+                sys.stderr.write(f"Done {done} of {len(paths)} samples, rendered {total} images, {total/elapsed*60:.0f} images/min\n")
+
+    if len(failed)>0:
+        sys.stderr.write(f"{len(failed)} samples failed to render\n")
+        sys.exit(1)
@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+import sys
+import argparse
+from pathlib import Path
+import multiprocessing
+import os
+import io
+import time
+import zipfile
+from dataclasses import dataclass
+from typing import *
+
+from dataset import command_line_dataset_open_helper, DMPCITemplate, ResultsMatrix, parse_dmpcas
+from dataset.results_bundle import BundleRows
+
+@dataclass
+class ReparseConfig:
+    template:DMPCITemplate
+    observable_layout:Optional[str] = None # None means keep the layout each sample was parsed with
+    rewrite_zips:bool = False
+    return_rows:bool = False
+
+# Set once per worker process by init_worker, so the template isn't pickled for every sample
+_config=None # type: Optional[ReparseConfig]
+
+def init_worker(config:ReparseConfig):
+    global _config
+    _config=config
+
+def reparse_sample(path:Path) -> Tuple[str,Optional[BundleRows],Optional[str]]:
+    """
+    Re-parses the dmpcas inside one sample zip, without extracting anything to disk.
+    Returns (id, rows, error), where rows is only given if config.return_rows is set.
+    """
+    config=_config
+    id=path.name[:-4]
+    try:
+        with zipfile.ZipFile(path) as src:
+            old=ResultsMatrix.load(io.BytesIO(src.read(f"{id}/{id}.hdf5")))
+            tags=str(old.tags[0])
+            observable_layout=config.observable_layout or old.observable_layout
+            bundle=parse_dmpcas(config.template, id, src, tags, observable_layout)
+
+        if config.rewrite_zips:
+            hdf5_bytes=io.BytesIO()
+            bundle.save(hdf5_bytes)
+            # Write the new zip alongside then swap it in, so the sample is never missing or partial.
+            # The temporary name doesn't match sample_*.zip, so is never seen as a sample.
+            tmp_path=path.with_name(path.name+".tmp")
+            with zipfile.ZipFile(path) as src, zipfile.ZipFile(tmp_path, "w", compression=zipfile.ZIP_DEFLATED) as dst:
+                for info in src.infolist():
+                    if info.filename==f"{id}/{id}.hdf5":
+                        dst.writestr(info, hdf5_bytes.getvalue())
+                    else:
+                        dst.writestr(info, src.read(info))
+            os.replace(tmp_path, path)
+
+        rows=None
+        if config.return_rows:
+            n=bundle.nExperiments
+            rows=BundleRows(bundle.run_id, bundle.parameters, bundle.observables, bundle.times,
+                bundle.experiments[0:n], bundle.tags[0:n], bundle.configurations[0:n], bundle.data[0:n])
+        return (id, rows, None)
+    except Exception as e:
+        return (id, None, f"{type(e).__name__}: {e}")
+
+
+if __name__=="__main__":
+
+    parser=argparse.ArgumentParser(
+        "dataset_reparse.py",
+        description=
+"""
+Re-parse the dmpcas files archived in every sample zip of a dataset, without re-running dpd
+or extracting files. Use this after changing the parser or observable layout. Either rewrite
+the results embedded in each zip, or write all the re-parsed samples into a new merged results file.
+"""
+    )
+    parser.add_argument("dataset_dir_or_dmpci_template")
+    parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
+    parser.add_argument("--observable-layout", default=None, choices=["compact","extended"], help="Observable layout to parse with. Default is to keep the layout each sample was originally parsed with.")
+    parser.add_argument("--rewrite-zips", default=False, action='store_true', help="Replace the hdf5 file embedded in each sample zip.")
+    parser.add_argument("--output", default=None, help="Write all re-parsed samples into a new merged results file with this name. To make it the dataset's results, replace {DATASET_ID}.hdf5 with it.")
+    parser.add_argument("--jobs", default="max", type=str, help="Either integer number of processes, or 'max' for number of CPUs.")
+    
+    args=parser.parse_args()
+
+    if not args.rewrite_zips and args.output is None:
+        sys.stderr.write("Nothing to do: specify --rewrite-zips and/or --output\n")
+        sys.exit(1)
+
+    if args.jobs=="max":
+        jobs=os.cpu_count()
+    else:
+        jobs=int(args.jobs)
+    jobs=max(1, jobs)
+
+    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, read_only=True)
+
+    with os.scandir(dataset.dir) as it:
+        paths=sorted( Path(e.path) for e in it if e.name.startswith("sample_") and e.name.endswith(".zip") )
+    sys.stderr.write(f"Re-parsing {len(paths)} samples using {jobs} processes\n")
+
+    config=ReparseConfig(dataset.template, args.observable_layout, args.rewrite_zips, args.output is not None)
+
+    matrix=None # type: Optional[ResultsMatrix]
+    failed=[] # type: List[Tuple[str,str]]
+    start=time.time()
+    with multiprocessing.Pool(processes=jobs, initializer=init_worker, initargs=(config,)) as pool:
+        for (done,(id,rows,error)) in enumerate(pool.imap(reparse_sample, paths, chunksize=16), start=1):
+            if error is not None:
+                failed.append( (id,error) )
+                sys.stderr.write(f"Failed {id} : {error}\n")
+            elif rows is not None:
+                if matrix is None:
+                    matrix=ResultsMatrix(rows.run_id, rows.parameters, rows.observables, rows.times, reserve_exp=len(paths))
+                matrix.add_rows(rows)
+            if (done%500)==0 or done==len(paths):
+                elapsed=max(1e-9, time.time()-start)
+                sys.stderr.write(f"Done {done} of {len(paths)}, {done/elapsed*60:.0f} samples/min\n")
+
+    if args.output is not None:
+        if matrix is None:
+            sys.stderr.write("No samples were re-parsed, so not writing output\n")
+        else:
+            matrix.save(Path(args.output))
+            sys.stderr.write(f"Wrote {matrix.nExperiments} samples to {args.output}\n")
+
+    if len(failed)>0:
+        sys.stderr.write(f"{len(failed)} samples failed to re-parse\n")
+        sys.exit(1)
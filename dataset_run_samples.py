@@ -12,9 +12,21 @@ import os
 import bz2
 import zipfile
 import tempfile
+import time
+import resource
+import traceback
+import signal
+import concurrent.futures
 from contextlib import ExitStack
+from typing import *
+import numpy as np
 
 from dataset import DMPCITemplate, Dataset, parse_dmpcas, command_line_dataset_open_helper
+from dataset.scheduling import RuntimeEstimator, parse_slurm_time, touch_heartbeat, release_heartbeat, find_abandoned_samples, claim_sample_dir, heartbeat_name, derive_seed, bind_to_core
+from dataset.samplers import Sampler, IndexAllocator, samplers, create_sampler, AdaptiveSampler
+from dataset.surrogate import Surrogate
+from dataset.povray import render_pov
+from dataset.restart import find_latest_restart, make_restart_dmpci, join_dmpcas_segments
 
 @dataclass
 class RunConfig:
@@ -28,6 +40,156 @@ class RunConfig:
     keep_dat:bool = False
     preserve_working:bool = False
     tags:str = ""
+    observable_layout:str = "compact"
+    max_retries:int = 1
+    quarantine_dir:Optional[Path] = None
+    resume:bool = False          # Resume samples abandoned in working_dir by earlier runs
+    stale_after:float = 1800     # Seconds without a heartbeat before a sample is considered abandoned
+    heartbeat_period:float = 60
+    bind_cores:bool = False      # Pin each worker, and the dpd it runs, to its own core
+
+@dataclass
+class SampleResult:
+    id:str
+    seed:int
+    attempt:int
+    bindings:Optional[Dict[str,str]]
+    wall_time:float
+    cpu_time:float              # User+system time of dpd and povray, which run as child processes
+    error:Optional[str] = None  # None if the sample was added to the dataset
+    quarantined:Optional[Path] = None
+    resumed:bool = False        # Continued from a previous run, so times only cover the last part
+    interrupted:bool = False    # Stopped by SIGTERM, and left in the working dir to be resumed
+
+class SampleSource:
+    """
+    Chooses new samples for run_samples. next() gives the seed of the next sample and optionally
+    its parameter bindings (otherwise they are drawn from the seed), or None if there are no more.
+    """
+    def next(self) -> Optional[Tuple[int,Optional[Dict[str,str]]]]:
+        return (random.randint(1, 2**64-1), None)
+
+class SeedStreamSource(SampleSource):
+    """
+    Seed of sample i is derive_seed(stream,i), so the same stream always gives the same samples.
+    """
+    def __init__(self, stream:str):
+        self.stream=stream
+        self.index=0
+
+    def next(self) -> Optional[Tuple[int,Optional[Dict[str,str]]]]:
+        self.index+=1
+        return (derive_seed(self.stream, self.index-1), None)
+
+class DesignSource(SampleSource):
+    """
+    Takes points of a space-filling design in index order. Indices come from a counter shared
+    by every job running the design, so jobs take different points, and the seed of each point
+    is derived from the design key and index.
+    """
+    def __init__(self, template:DMPCITemplate, sampler:Sampler, allocator:IndexAllocator, key:str):
+        self.template=template
+        self.sampler=sampler
+        self.allocator=allocator
+        self.key=key
+
+    def next(self) -> Optional[Tuple[int,Optional[Dict[str,str]]]]:
+        index=self.allocator.allocate(1)[0]
+        if self.sampler.size is not None and index>=self.sampler.size:
+            return None
+        return (derive_seed(self.key, index), self.template.bindings_from_unit(self.sampler.point(index)))
+
+class AdaptiveSource(SampleSource):
+    """
+    Chooses each new sample with an AdaptiveSampler, based on the samples in the dataset plus the
+    pending samples: those started by this process, and any in the working directory (which may
+    belong to other jobs sharing it). The dataset is re-scanned now and then to pick up finished samples.
+    """
+    def __init__(self, dataset:Dataset, working_dir:Path, sampler:AdaptiveSampler, observable:Optional[str]=None, observable_time:Optional[int]=None, refresh_period:float=60):
+        self.dataset=dataset
+        self.template=dataset.template
+        self.working_dir=working_dir
+        self.sampler=sampler
+        self.observable=observable
+        self.observable_time=observable_time
+        self.refresh_period=refresh_period
+        self.last_refresh=time.time()
+        self.started={} # type: Dict[str,np.ndarray]
+        self.in_working_dir={} # type: Dict[str,np.ndarray]
+        self.surrogate=None # type: Optional[Surrogate]
+        self.surrogate_rows=0
+
+    def _pending(self) -> np.ndarray:
+        in_dataset=self.dataset.matrix if self.dataset.matrix is not None else {}
+        current=set()
+        for d in self.working_dir.glob("sample_*"):
+            if "." in d.name or d.name in self.started:
+                continue
+            current.add(d.name)
+            if d.name not in self.in_working_dir:
+                try:
+                    with open(d / f"dmpci.{d.name}", "rt") as src:
+                        self.in_working_dir[d.name]=self.template.normalise(self.template.parse_configuration(src.read()))
+                except (FileNotFoundError, AssertionError):
+                    pass # Still being created
+        for name in list(self.in_working_dir.keys()):
+            if name not in current:
+                del self.in_working_dir[name]
+        points=[ p for (id,p) in list(self.started.items())+list(self.in_working_dir.items()) if id not in in_dataset ]
+        return np.array(points).reshape(-1, len(self.template.parameters))
+
+    def next(self) -> Optional[Tuple[int,Optional[Dict[str,str]]]]:
+        if time.time()-self.last_refresh > self.refresh_period:
+            self.dataset.merge_run_bundles()
+            self.last_refresh=time.time()
+
+        m=self.dataset.matrix
+        n=m.nExperiments if m is not None else 0
+        existing=self.template.normalise(m.configurations[0:n]) if n>0 else np.zeros( (0,len(self.template.parameters)) )
+        uncertainty=None
+        if self.observable is not None and n>=2:
+            if self.surrogate is None or self.surrogate_rows!=n:
+                t=int(m.times[m.times_to_index[self.observable_time]] if self.observable_time is not None else m.times[-1])
+                self.surrogate=Surrogate.train(m, self.template, [self.observable], [t], rows=np.arange(n))
+                self.surrogate_rows=n
+            uncertainty=lambda u: self.surrogate.predict_unit(u)[1][:,0,0]
+
+        snap=lambda u: self.template.normalise(self.template.denormalise(u))
+        point=self.sampler.choose(existing, self._pending(), uncertainty, snap)
+        seed=random.randint(1, 2**64-1)
+        self.started[f"sample_{seed:016x}"]=point
+        return (seed, self.template.bindings_from_unit(point))
+
+class SampleInterrupted(Exception):
+    pass
+
+# Set once per worker process by init_worker, so the template is shipped to each worker
+# once rather than being pickled again for every sample
+_config=None # type: Optional[RunConfig]
+
+# SIGTERM only interrupts a sample while run_one_inner is running it. If it arrives at any
+# other point (e.g. while a result is being handled) it is just recorded, and no more samples
+# are started by this process.
+_in_sample=False
+_terminated=False
+
+def _on_sigterm(signum, frame):
+    global _terminated
+    _terminated=True
+    if _in_sample:
+        raise SampleInterrupted(f"Received signal {signum}")
+
+def init_worker(config:RunConfig, cores:Optional[multiprocessing.Queue]=None):
+    global _config
+    _config=config
+    if cores is not None:
+        bind_to_core(cores)
+    if config.resume:
+        # SLURM sends SIGTERM before killing a job, which gives the chance to hand the sample over straight away
+        signal.signal(signal.SIGTERM, _on_sigterm)
+    elif multiprocessing.parent_process() is not None:
+        # Forked workers inherit the handler of the pool loop, which only makes sense in the parent
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
 
 def add_matching_files(dir:Path, pattern:str, dst_dir:str, dst_zip:zipfile.ZipFile):
     assert dir.is_dir()
@@ -44,57 +206,179 @@ def compress_and_add_matching_files(dir:Path, pattern:str, dst_dir:str, dst_zip:
         data=bz2.compress(data)
         dst_zip.writestr( f"{dst_dir}/{f.name}.bz2", data, compress_type=zipfile.ZIP_STORED )
 
-def run_one(config:RunConfig):
-    seed=random.randint(1, 2**64-1)
-
+def _children_cpu_time() -> float:
+    r=resource.getrusage(resource.RUSAGE_CHILDREN)
+    return r.ru_utime+r.ru_stime
+
+def run_one(seed:int, attempt:int=0, bindings:Optional[Dict[str,str]]=None) -> SampleResult:
+    """
+    Runs one sample in a worker set up with init_worker. Failures are returned rather than
+    raised, so one bad sample doesn't take down the pool. When resuming, a failed attempt leaves
+    the working directory for the retry to continue from its latest restart. When the last allowed
+    attempt fails the working directory is moved to config.quarantine_dir for inspection.
+    """
+    global _in_sample
+    config=_config
     id=f"sample_{seed:016x}"
-
-    sys.stderr.write(f"Starting {id}\n")
-
-    private_working_dir=config.working_dir / id
-    private_working_dir.mkdir()
-
-    params=config.template.create_parameters(seed)
-    dmpci_text=config.template.substitute_parameters(params)
-
-    with open(private_working_dir / f"dmpci.{id}", "wt" ) as dst:
-        dst.write(dmpci_text)
-
-    with open(private_working_dir / "dpd.log", "wt") as log_dst:
-        res=subprocess.run(
-            [str(config.dpd_path), id],
-            cwd=str(private_working_dir),
+    start_wall=time.time()
+    start_cpu=_children_cpu_time()
+    if _terminated:
+        # The signal arrived while this worker was idle, so leave the sample for someone else
+        if (config.working_dir / id).exists():
+            release_heartbeat(config.working_dir / id)
+        return SampleResult(id, seed, attempt, bindings, 0.0, 0.0, "Not started, as SIGTERM was received", interrupted=True)
+    try:
+        _in_sample=True
+        try:
+            resumed=run_one_inner(config, id, seed, bindings)
+        finally:
+            _in_sample=False
+        return SampleResult(id, seed, attempt, bindings, time.time()-start_wall, _children_cpu_time()-start_cpu, resumed=resumed)
+    except SampleInterrupted as e:
+        release_heartbeat(config.working_dir / id)
+        return SampleResult(id, seed, attempt, bindings, time.time()-start_wall, _children_cpu_time()-start_cpu, str(e), interrupted=True)
+    except Exception as e:
+        error=f"{type(e).__name__}: {e}".strip()
+        private_working_dir=config.working_dir / id
+        quarantined=None
+        if attempt>=config.max_retries and config.quarantine_dir is not None and private_working_dir.exists():
+            config.quarantine_dir.mkdir(parents=True, exist_ok=True)
+            quarantined=config.quarantine_dir / id
+            with open(private_working_dir / "error.txt", "wt") as dst:
+                dst.write(traceback.format_exc())
+            shutil.move(str(private_working_dir), str(quarantined))
+        elif config.resume and attempt<config.max_retries and private_working_dir.exists():
+            # Keep the heartbeat fresh, so it is retried here rather than claimed as abandoned
+            touch_heartbeat(private_working_dir)
+        elif private_working_dir.exists():
+            shutil.rmtree(private_working_dir)
+        (config.working_dir / f"{id}.zip").unlink(missing_ok=True)
+        return SampleResult(id, seed, attempt, bindings, time.time()-start_wall, _children_cpu_time()-start_cpu, error, quarantined)
+
+def run_dpd(config:RunConfig, dir:Path, run_id:str):
+    """
+    Runs dpd in dir, touching the heartbeat while it runs so the sample isn't taken as abandoned.
+    """
+    with open(dir / "dpd.log", "at") as log_dst:
+        proc=subprocess.Popen(
+            [str(config.dpd_path), run_id],
+            cwd=str(dir),
             stderr=subprocess.STDOUT,
             stdout=log_dst
         )
-        assert res.returncode == 0
+        try:
+            while True:
+                try:
+                    returncode=proc.wait(timeout=config.heartbeat_period)
+                    break
+                except subprocess.TimeoutExpired:
+                    touch_heartbeat(dir)
+        except BaseException:
+            proc.terminate()
+            proc.wait()
+            raise
+    if returncode==-signal.SIGTERM and config.resume:
+        raise SampleInterrupted("dpd was terminated")
+    assert returncode == 0, f"dpd exited with code {returncode}, see dpd.log"
+
+def read_segments(dir:Path) -> List[Tuple[str,Optional[int]]]:
+    """
+    Returns the (run_id,restart_time) of each dpd run of a sample. The first run has the sample id and no restart time.
+    """
+    res=[]
+    with open(dir / "segments.txt", "rt") as src:
+        for l in src.read().splitlines():
+            parts=l.split("\t")
+            res.append( (parts[0], int(parts[1]) if len(parts)>1 else None) )
+    return res
+
+def write_segments(dir:Path, segments:List[Tuple[str,Optional[int]]]):
+    with open(dir / "segments.txt", "wt") as dst:
+        for (run_id,restart_time) in segments:
+            dst.write(run_id if restart_time is None else f"{run_id}\t{restart_time}")
+            dst.write("\n")
+
+def run_one_inner(config:RunConfig, id:str, seed:int, bindings:Optional[Dict[str,str]]=None) -> bool:
+    """
+    Runs the sample through to a zip in the output directory. If the working directory already
+    exists then it was abandoned by an earlier run, and dpd continues from the latest restart state.
+    Returns True if the sample was resumed.
+    """
+    private_working_dir=config.working_dir / id
+    resumed=private_working_dir.exists()
+
+    if not resumed:
+        sys.stderr.write(f"Starting {id}\n")
+        private_working_dir.mkdir()
+        touch_heartbeat(private_working_dir)
+
+        params=bindings if bindings is not None else config.template.create_parameters(seed)
+        dmpci_text=config.template.substitute_parameters(params)
+
+        with open(private_working_dir / f"dmpci.{id}", "wt" ) as dst:
+            dst.write(dmpci_text)
+        write_segments(private_working_dir, [(id,None)])
+
+    segments=read_segments(private_working_dir)
+    complete_path=private_working_dir / "dpd.complete"
+    if not complete_path.exists():
+        if resumed:
+            state=find_latest_restart(private_working_dir, [run_id for (run_id,_) in segments])
+            if state is None:
+                sys.stderr.write(f"Resuming {id} from the beginning, as there is no restart state\n")
+                segments=segments[:1]
+            else:
+                run_id=f"{id}-r{len(segments)}"
+                sys.stderr.write(f"Resuming {id} from time {state.time} as {run_id}\n")
+                with open(private_working_dir / f"dmpci.{id}", "rt") as src:
+                    dmpci_text=src.read()
+                with open(private_working_dir / f"dmpci.{run_id}", "wt") as dst:
+                    dst.write(make_restart_dmpci(dmpci_text, state))
+                segments.append( (run_id,state.time) )
+            write_segments(private_working_dir, segments)
+
+        run_dpd(config, private_working_dir, segments[-1][0])
+
+        if len(segments)>1:
+            texts=[]
+            for (run_id,_) in segments:
+                with open(private_working_dir / f"dmpcas.{run_id}", "rt") as src:
+                    texts.append(src.read())
+            joined=join_dmpcas_segments(texts, [t for (_,t) in segments[1:]])
+            with open(private_working_dir / f"dmpcas.{id}.tmp", "wt") as dst:
+                dst.write(joined)
+            os.replace(private_working_dir / f"dmpcas.{id}.tmp", private_working_dir / f"dmpcas.{id}")
+        complete_path.touch()
+
+    touch_heartbeat(private_working_dir)
 
     if config.render_povray:
         for i in private_working_dir.glob("*.pov"):
             sys.stderr.write(f"Rendering {i}\n")
-            with open( i.parent / (i.name+".povray.log"), "wt") as log_dst:
-                subprocess.run(
-                    ["povray", f"{str(i.name)}",
-                        "-W800", "-H600",
-                        "-D"  # Turn of display
-                    ],
-                    cwd=str(private_working_dir),
-                    stdout=log_dst,
-                    stderr=subprocess.STDOUT
-                )
-
-    db=parse_dmpcas(config.template, id,  private_working_dir, config.tags)
+            render_pov(i)
+            touch_heartbeat(private_working_dir)
+
+    db=parse_dmpcas(config.template, id,  private_working_dir, config.tags, config.observable_layout)
     db.save(private_working_dir / f"{id}.hdf5")
     
+    (config.working_dir / f"{id}.zip").unlink(missing_ok=True) # Left over if a resumed sample was interrupted while packaging
     with zipfile.ZipFile(config.working_dir / f"{id}.zip", "x", compression=zipfile.ZIP_DEFLATED) as zip:
         # mkdir only in python 3.11
         #zip.mkdir(id)
         to_add=[f"{prefix}.{id}" for prefix in ["dmpci", "dmpcas", "dmpchs", "dmpcis", "dmpcls"]]
         for filename in to_add:
-            zip.write(private_working_dir/filename, f"{id}/{filename}")
+            # A sample that was interrupted may not have the outputs dpd writes on completion
+            if len(segments)==1 or (private_working_dir/filename).exists():
+                zip.write(private_working_dir/filename, f"{id}/{filename}")
 
         zip.write( private_working_dir / f"{id}.hdf5", f"{id}/{id}.hdf5" )
 
+        # The inputs and logs of any continuation runs, whose dmpcas were joined into the sample's dmpcas
+        for (run_id,_) in segments[1:]:
+            for prefix in ["dmpci", "dmpchs", "dmpcls"]:
+                if (private_working_dir / f"{prefix}.{run_id}").exists():
+                    zip.write(private_working_dir / f"{prefix}.{run_id}", f"{id}/{prefix}.{run_id}")
+
         if config.render_povray:
             add_matching_files(private_working_dir, "*.png", id, zip)
         if config.keep_dat:
@@ -119,8 +403,178 @@ def run_one(config:RunConfig):
 
     if not config.preserve_working:
         shutil.rmtree(private_working_dir)
-
-    sys.stderr.write(f"Finished {id}\n")
+    else:
+        # Without a heartbeat the preserved directory won't be mistaken for an abandoned sample
+        (private_working_dir / heartbeat_name).unlink()
+
+    return resumed
+
+
+def run_samples(config:RunConfig, num_samples:Optional[int], processes:int,
+        deadline:Optional[float]=None, estimator:Optional[RuntimeEstimator]=None,
+        on_finished:Optional[Callable[[SampleResult],None]]=None,
+        source:Optional[SampleSource]=None) -> List[SampleResult]:
+    """
+    Runs up to num_samples new samples from source (or without limit if None), keeping a fixed set of
+    worker processes busy from a queue. Failed seeds are re-queued until they have been tried
+    config.max_retries extra times.
+
+    If config.resume is set, samples abandoned in the working directory by earlier runs are
+    claimed and continued first, in addition to the new samples.
+
+    If a deadline (as time.time()) is given, a new sample is only started if the estimator predicts
+    it will finish before the deadline. Resumed samples are always continued, as they can make
+    progress towards their next restart state. on_finished is called for each successful sample.
+
+    The default source gives random seeds. Seeds from the source that already have a zip or
+    working directory are skipped, so re-running a deterministic source (e.g. a requeued array
+    task with a seed stream) doesn't repeat samples.
+    Returns the results of the samples that finally failed.
+    """
+    source=source or SampleSource()
+    retry=[] # type: List[Tuple[int,int,Optional[Dict[str,str]]]]
+    failed=[] # type: List[SampleResult]
+    issued=0
+    done=0
+    stopped=False
+    interrupted=False
+    cpu_time=0.0
+    start=time.time()
+
+    def next_task() -> Optional[Tuple[int,int,Optional[Dict[str,str]]]]:
+        nonlocal issued, stopped
+        if interrupted or _terminated:
+            return None
+        if config.resume:
+            for p in find_abandoned_samples(config.working_dir, config.stale_after):
+                if claim_sample_dir(p, config.stale_after):
+                    return (int(p.name[len("sample_"):],16), 0, None)
+        if stopped:
+            return None
+        if deadline is not None and estimator is not None:
+            predicted=estimator.estimate()
+            if predicted is not None and time.time()+predicted > deadline:
+                sys.stderr.write(f"Not starting any more samples, as predicted run time of {predicted:.0f} secs would pass the deadline in {deadline-time.time():.0f} secs\n")
+                stopped=True
+                return None
+        if len(retry)>0:
+            return retry.pop()
+        while num_samples is None or issued<num_samples:
+            item=source.next()
+            if item is None:
+                sys.stderr.write("No more samples available from the sampler\n")
+                stopped=True
+                return None
+            issued+=1
+            (seed,bindings)=item
+            id=f"sample_{seed:016x}"
+            if not ( (config.output_dir / f"{id}.zip").exists() or (config.working_dir / id).exists() ):
+                return (seed, 0, bindings)
+        return None
+
+    def handle(r:SampleResult):
+        nonlocal done, cpu_time, interrupted
+        cpu_time+=r.cpu_time
+        if r.interrupted:
+            # Probably the job is being shut down, so don't start anything else
+            interrupted=True
+            sys.stderr.write(f"Interrupted {r.id}, leaving it in the working dir to be resumed\n")
+            return
+        if r.error is None:
+            done+=1
+            sys.stderr.write(f"Finished {r.id} in {r.wall_time:.1f} secs, cpu {r.cpu_time:.1f} secs{' (resumed)' if r.resumed else ''}\n")
+            if on_finished is not None:
+                on_finished(r)
+        elif r.attempt<config.max_retries:
+            sys.stderr.write(f"Failed {r.id} (attempt {r.attempt+1}) : {r.error}. Retrying.\n")
+            retry.append( (r.seed, r.attempt+1, r.bindings) )
+        else:
+            failed.append(r)
+            where=f", quarantined to {r.quarantined}" if r.quarantined else ""
+            sys.stderr.write(f"Failed {r.id} (attempt {r.attempt+1}) : {r.error}. Giving up{where}.\n")
+        if r.error is not None or (done%10)==0:
+            report()
+
+    def report():
+        elapsed=max(1e-9, time.time()-start)
+        of=f" of {num_samples}" if num_samples is not None else ""
+        sys.stderr.write(f"Done {done}{of}, failed {len(failed)}, {done/elapsed*3600:.1f} samples/hour, core utilisation {100*cpu_time/(elapsed*processes):.0f}%\n")
+
+    def core_queue() -> Optional[multiprocessing.Queue]:
+        """
+        A queue holding one core for each worker, which the workers take from as they start.
+        """
+        if not config.bind_cores:
+            return None
+        cores=multiprocessing.Queue()
+        for i in range(processes):
+            cores.put(allowed[i%len(allowed)])
+        return cores
+
+    if config.bind_cores:
+        allowed=sorted(os.sched_getaffinity(0))
+        if processes>len(allowed):
+            sys.stderr.write(f"Warning: {processes} processes but only {len(allowed)} cores available, so some cores are shared\n")
+
+    if processes==1:
+        previous_handler=signal.getsignal(signal.SIGTERM)
+        init_worker(config, core_queue())
+        try:
+            while (task:=next_task()) is not None:
+                handle(run_one(*task))
+        finally:
+            signal.signal(signal.SIGTERM, previous_handler)
+        if interrupted or _terminated:
+            sys.stderr.write("Stopping, as SIGTERM was received\n")
+        report()
+        return failed
+
+    def create_pool() -> concurrent.futures.ProcessPoolExecutor:
+        # Each pool gets a full queue of cores, as the workers of a broken pool have already taken theirs
+        return concurrent.futures.ProcessPoolExecutor(max_workers=processes, initializer=init_worker, initargs=(config,core_queue()))
+
+    # The workers deal with their own samples, so the pool only has to stop submitting new ones
+    def on_sigterm(signum, frame):
+        nonlocal interrupted
+        interrupted=True
+    previous_handler=signal.signal(signal.SIGTERM, on_sigterm)
+    pool=create_pool()
+    try:
+        # Only submit a task when a worker is free, so that the deadline check happens when the sample
+        # actually starts, and retries don't wait behind a backlog
+        running={} # type: Dict[concurrent.futures.Future,Tuple[int,int,Optional[Dict[str,str]]]]
+        while True:
+            while len(running)<processes and (task:=next_task()) is not None:
+                running[pool.submit(run_one, *task)]=task
+            if len(running)==0:
+                break
+            (finished,_)=concurrent.futures.wait(running.keys(), return_when=concurrent.futures.FIRST_COMPLETED)
+            if any( isinstance(f.exception(), concurrent.futures.process.BrokenProcessPool) for f in finished ):
+                # A worker died (e.g. killed by the OOM killer), which fails every sample still in the pool.
+                # Those samples are resumed or treated as failed attempts, and the pool is replaced.
+                sys.stderr.write("A worker process died, restarting the worker pool\n")
+                (finished,_)=concurrent.futures.wait(running.keys())
+                pool.shutdown(wait=True)
+                pool=create_pool()
+            for f in finished:
+                (seed,attempt,bindings)=running.pop(f)
+                id=f"sample_{seed:016x}"
+                if f.exception() is None:
+                    handle(f.result())
+                elif config.resume and (config.working_dir / id).exists():
+                    # Claiming it as an abandoned sample makes sure only one runner continues it
+                    release_heartbeat(config.working_dir / id)
+                    sys.stderr.write(f"Lost {id} when a worker died, it will be resumed\n")
+                else:
+                    error=f"Worker process died : {type(f.exception()).__name__}: {f.exception()}".strip()
+                    handle(SampleResult(id, seed, attempt, bindings, 0.0, 0.0, error))
+    finally:
+        pool.shutdown(wait=True)
+        signal.signal(signal.SIGTERM, previous_handler)
+    if interrupted:
+        sys.stderr.write("Stopping, as SIGTERM was received\n")
+    report()
+    return failed
 
 
 if __name__=="__main__":
@@ -131,18 +585,34 @@ if __name__=="__main__":
     parser.add_argument("dataset_dir_or_dmpci_template")
     parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
     parser.add_argument("--dpd-path", default="dpd", type=str, help="Give the path to the osprey dpd executable, or the name of a comand that is accessible on PATH.")
-    parser.add_argument("--tags", default="random", type=str, help='List of comma separated tags to assigned to samples.')
-    parser.add_argument("--repeats", default=1, type=int, help='Number of random simulation runs to perform.')
+    parser.add_argument("--tags", default=None, type=str, help='List of comma separated tags to assigned to samples. Default is the name of the sampler.')
+    parser.add_argument("--sampler", default="random", choices=["random","adaptive"]+list(samplers.keys()), help="How to choose parameters. 'random' draws each parameter independently from the sample seed. 'adaptive' targets the gaps in the existing samples (see --adaptive-mode). The others take successive points of a design shared by every job on the dataset: 'sobol' and 'halton' are scrambled low-discrepancy sequences, 'lhs' is a latin hypercube and 'maximin' a latin hypercube chosen to spread points apart, both of --design-size points.")
+    parser.add_argument("--adaptive-mode", default="distance", choices=AdaptiveSampler.modes, help="For --sampler=adaptive, 'distance' picks the point furthest from existing and in-progress samples, 'variance' also favours points where a surrogate model is uncertain about --adaptive-observable.")
+    parser.add_argument("--adaptive-observable", default=None, type=str, help="Observable used by --adaptive-mode=variance.")
+    parser.add_argument("--adaptive-time", default=None, type=int, help="Time of the observable used by --adaptive-mode=variance. Default is the last time.")
+    parser.add_argument("--design-size", default=None, type=int, help="Number of points in an 'lhs' or 'maximin' design.")
+    parser.add_argument("--repeats", default=None, type=int, help='Number of random simulation runs to perform. Default is 1, or unlimited if --time-budget is given.')
+    parser.add_argument("--time-budget", default=None, type=str, help="Only start a sample if it is predicted to finish within this time (seconds, or SLURM style dd-HH:MM:SS) of starting the script.")
+    parser.add_argument("--runtime-quantile", default=0.9, type=float, help="Quantile of previous sample run times (from the dataset's sample_runtimes.tsv) used as the predicted run time.")
+    parser.add_argument("--runtime-estimate", default=None, type=float, help="Predicted run time in seconds to use when the dataset has no previous run times. Default is to start samples regardless until one has finished.")
     parser.add_argument("--num-processes", default="1", type=str, help="Either integer number, 'max' for number of CPUs, 'halfmax' for number of CPUs/2.")
+    parser.add_argument("--bind-cores", default=False, action='store_true', help="Pin each worker process and its dpd to one of the cores this process is allowed to use.")
+    parser.add_argument("--seed-stream", default=None, type=str, help="Derive sample seeds deterministically from this string and the sample index, rather than randomly. Samples that already exist are skipped.")
     parser.add_argument("--working-dir", default=None, help="Directory to create temporary directories in. If nothing is specified then python3 tempfile.TemporaryDirectory will be used.")
-    parser.add_argument("--render-povray", default=False, action='store_true', help="Render the pov files using povray and then add into the output zip.")
+    parser.add_argument("--render-povray", default=False, action='store_true', help="Render the pov files using povray and then add into the output zip. This happens after dpd finishes, on the same core, so for long runs prefer --keep-pov and then dataset_render.py.")
     parser.add_argument("--keep-pov", default=False, action='store_true', help='Store compressed pov files into zip')
     parser.add_argument("--keep-rst", default=False, action='store_true', help='Store compressed rst files into zip')
     parser.add_argument("--keep-dat", default=False, action='store_true', help='Store compressed dat files into zip')
     parser.add_argument("--preserve-working", default=False, action='store_true', help='Dont delete the working directory when the run finishes. This only works if a directory is specified using --working-dir')
+    parser.add_argument("--max-retries", default=1, type=int, help="Number of times to retry a sample whose dpd run fails, before giving up on it.")
+    parser.add_argument("--quarantine-dir", default=None, type=str, help="Directory to move the working directories of samples that still fail after retrying. Default is 'quarantine' within --working-dir, or nowhere (they are deleted) if there is no explicit working dir.")
+    parser.add_argument("--no-resume", default=False, action='store_true', help="Don't resume samples left in --working-dir by runs that were killed or interrupted. Resuming requires an explicit --working-dir.")
+    parser.add_argument("--stale-after", default=1800, type=float, help="Seconds without a heartbeat from a sample in the working dir before it is taken as abandoned and resumed.")
+    parser.add_argument("--observable-layout", default=None, choices=["compact","extended"], help="Which observables to keep from dmpcas. 'compact' keeps means of scalars and vector magnitudes, 'extended' also keeps vector components, tensors and standard deviations. Default is to match the samples already in the dataset, or compact for an empty dataset.")
 
 
     args=parser.parse_args()
+    script_start=time.time()
 
     dpd_path=Path(args.dpd_path)
     if dpd_path.exists():
@@ -173,7 +643,26 @@ if __name__=="__main__":
         config.keep_pov=args.keep_pov
         config.keep_rst=args.keep_rst
         config.preserve_working=args.preserve_working
-        config.tags=args.tags.replace(",",";") # Comma seperated on command line, but semi-colon separated internally
+        tags=args.tags if args.tags is not None else args.sampler
+        config.tags=tags.replace(",",";") # Comma seperated on command line, but semi-colon separated internally
+        config.max_retries=max(0, args.max_retries)
+        config.resume=(args.working_dir is not None) and not args.no_resume
+        config.stale_after=args.stale_after
+        config.heartbeat_period=min(config.heartbeat_period, args.stale_after/4)
+        # Failed working directories can be big, so they are kept away from the dataset directory
+        if args.quarantine_dir is not None:
+            config.quarantine_dir=Path(args.quarantine_dir).absolute()
+        elif args.working_dir is not None:
+            config.quarantine_dir=working_dir / "quarantine"
+
+        if args.observable_layout is not None:
+            if dataset.matrix is not None and dataset.matrix.observable_layout!=args.observable_layout:
+                sys.stderr.write(f"Dataset already contains samples with observable layout '{dataset.matrix.observable_layout}', so can't add samples with layout '{args.observable_layout}'\n")
+                sys.exit(1)
+            config.observable_layout=args.observable_layout
+        elif dataset.matrix is not None:
+            config.observable_layout=dataset.matrix.observable_layout
+        sys.stderr.write(f"Observable layout = {config.observable_layout}\n")
 
         dataset.template.print_parameters()
 
@@ -181,7 +670,7 @@ if __name__=="__main__":
         #    print(x)
 
         if args.num_processes=="max":
-            processes=os.cpu_count()
+            processes=len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
         elif args.num_processes=="halfmax":
             processes=int(os.cpu_count()/2)
         else:
@@ -189,16 +678,53 @@ if __name__=="__main__":
         processes=max(1, processes)
         sys.stderr.write(f"Num processes = {processes}\n")
 
-        if processes > 1:
-            sys.stderr.write("Multicore\n")
-            with multiprocessing.Pool(processes=processes) as pool:
-                done=0
-                for _ in pool.imap_unordered(run_one,  [config for i in range(0,args.repeats)]):
-                    sys.stderr.write(f"b\n")
-                    done+=1
-                    if (done%10)==0:
-                        sys.stderr.write(f"Done {done} of {args.repeats}\n")
-        else:
-            sys.stderr.write("Single core\n")
-            for i in range(args.repeats):
-                run_one(config)
+        deadline=None
+        if args.time_budget is not None:
+            budget=float(args.time_budget) if args.time_budget.replace(".","",1).isdigit() else parse_slurm_time(args.time_budget)
+            deadline=script_start+budget
+        repeats=args.repeats
+        if repeats is None and deadline is None:
+            repeats=1
+
+        estimator=RuntimeEstimator(dataset.sample_runtimes(), args.runtime_quantile, default=args.runtime_estimate)
+        predicted=estimator.estimate()
+        sys.stderr.write(f"Predicted sample run time = {'unknown' if predicted is None else f'{predicted:.1f} secs'}, from {len(estimator.times)} previous samples\n")
+
+        def on_finished(r:SampleResult):
+            if r.resumed:
+                return # Only part of the sample's run time is known
+            dataset.record_sample_runtime(r.id, r.wall_time, r.cpu_time)
+            estimator.add(r.wall_time)
+
+        source=SampleSource()
+        if args.sampler=="adaptive":
+            if args.adaptive_mode=="variance":
+                if args.adaptive_observable is None:
+                    sys.stderr.write("--adaptive-mode=variance needs --adaptive-observable\n")
+                    sys.exit(1)
+                if dataset.matrix is not None and args.adaptive_observable not in dataset.matrix.observables_to_index:
+                    sys.stderr.write(f"Unknown observable '{args.adaptive_observable}', expected one of {list(dataset.matrix.observables_to_index.keys())}\n")
+                    sys.exit(1)
+            sampler=AdaptiveSampler(len(dataset.template.parameters), random.randint(0,2**63), args.adaptive_mode)
+            observable=args.adaptive_observable if args.adaptive_mode=="variance" else None
+            source=AdaptiveSource(dataset, working_dir, sampler, observable, args.adaptive_time)
+        elif args.sampler!="random":
+            if args.seed_stream is not None:
+                sys.stderr.write("--seed-stream only applies to the 'random' sampler, as design samplers derive seeds from the design\n")
+                sys.exit(1)
+            # Every job using the same sampler and size on this dataset shares the design, and the counter of used points
+            design_name=args.sampler if args.design_size is None else f"{args.sampler}-{args.design_size}"
+            key=f"{dataset.id}-{design_name}"
+            sampler=create_sampler(args.sampler, len(dataset.template.parameters), derive_seed(f"{key}-design", 0), args.design_size)
+            allocator=IndexAllocator(dataset.dir / f"design-{design_name}.next_index")
+            source=DesignSource(dataset.template, sampler, allocator, key)
+            sys.stderr.write(f"Sampling from design {design_name}\n")
+        elif args.seed_stream is not None:
+            source=SeedStreamSource(args.seed_stream)
+
+        config.bind_cores=args.bind_cores
+        failed=run_samples(config, repeats, processes, deadline, estimator, on_finished, source)
+
+    if len(failed)>0:
+        sys.stderr.write(f"{len(failed)} samples failed\n")
+        sys.exit(1)
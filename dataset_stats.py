@@ -3,44 +3,77 @@ import sys
 import argparse
 from dataset import command_line_dataset_open_helper
 import numpy as np
-import numpy.linalg
-import math
+import scipy.spatial
+import scipy.stats.qmc
+from typing import *
+
+def distance_stats(points:np.ndarray) -> Tuple[float,float,float]:
+    """
+    Returns (min,mean,max) over the points of the distance to the nearest other point, using one batched kd-tree query.
+    """
+    (d,_)=scipy.spatial.cKDTree(points).query(points, k=2)
+    nearest=d[:,1]
+    return (float(nearest.min()), float(nearest.mean()), float(nearest.max()))
+
+def text_histogram(counts:np.ndarray, width:int=40) -> List[str]:
+    scale=width/max(1,counts.max())
+    return [ "#"*int(round(c*scale)) for c in counts ]
 
 if __name__=="__main__":
 
     parser=argparse.ArgumentParser(
-        "dataset_list_tags.py"
+        "dataset_stats.py"
     )
     parser.add_argument("dataset_dir_or_dmpci_template")
     parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
-    
+    parser.add_argument("--read-only", default=False, action='store_true', help="Only use samples already merged by dataset_merge.py, rather than scanning for new sample zips.")
+    parser.add_argument("--tag", default=[], action="append", help="Only include samples with this tag. Can be given multiple times.")
+    parser.add_argument("--bins", default=10, type=int, help="Number of histogram bins per parameter.")
+    parser.add_argument("--discrepancy-samples", default=5000, type=int, help="Estimate the discrepancy from a random subset of this many samples, as it takes time quadratic in the number of samples.")
+
     args=parser.parse_args()
 
-    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root)
+    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, read_only=args.read_only)
 
     if dataset.matrix==None:
         sys.stderr.write("Dataset is empty.\n")
         sys.exit(1)
 
-    n=dataset.matrix.nExperiments
+    m=dataset.matrix
+    n=m.nExperiments
     print(f"Total samples : {n}")
 
-    global_min_min_l2=1e10
-    global_sum_min_l2=0
-    global_max_min_l2=0
+    data=np.asarray(m.configurations[0:n,:])
+    if len(args.tag)>0:
+        selected=set()
+        for tag in args.tag:
+            selected.update(m.tags_to_indices.get(tag, []))
+        data=data[np.array(sorted(selected), dtype=np.int64)]
+        n=data.shape[0]
+        print(f"Samples with tags {args.tag} : {n}")
+    if n<2:
+        sys.stderr.write("Need at least two samples.\n")
+        sys.exit(1)
 
-    data=dataset.matrix.configurations[0:n,:]
-    for i in range(0,n):
-        deltas = data - data[i,:]
-        l2 = numpy.linalg.norm(deltas, axis=1)
-        assert l2.shape==(n,), f"n={n}, Shape = {l2.shape}"
-        l2[i] = np.nan
+    unit=dataset.template.normalise(data)
 
-        min_l2 = np.nanmin(l2)
+    (dmin,dmean,dmax)=distance_stats(data)
+    print(f"Param distance : min={dmin}, avg={dmean}, max={dmax} ")
+    (dmin,dmean,dmax)=distance_stats(unit)
+    print(f"Normalised param distance : min={dmin}, avg={dmean}, max={dmax} ")
 
-        global_min_min_l2 = min( global_min_min_l2, min_l2 )
-        global_sum_min_l2 += min_l2
-        global_max_min_l2 = max( global_max_min_l2, min_l2 )
-        
+    if args.discrepancy_samples>0:
+        subset=unit
+        if n>args.discrepancy_samples:
+            subset=unit[np.random.default_rng(1).choice(n, args.discrepancy_samples, replace=False)]
+        # The discrepancy is only defined on the unit cube, and samples can fall outside it if the template ranges were changed
+        d=scipy.stats.qmc.discrepancy(np.clip(subset, 0, 1), method="CD")
+        print(f"Centred L2 discrepancy : {d:.6g} (from {subset.shape[0]} samples, lower is more uniform)")
 
-    print(f"Param distance : min={global_min_min_l2}, avg={global_sum_min_l2/n}, max={global_max_min_l2} ")
\ No newline at end of file
+    for (i,p) in enumerate(dataset.template.parameters.values()):
+        u=unit[:,i]
+        (counts,_)=np.histogram(u, bins=args.bins, range=(0,1))
+        print(f"{p.name} : range=[{p.minval},{p.maxval}], observed=[{data[:,i].min()},{data[:,i].max()}], empty bins={np.sum(counts==0)} of {args.bins}")
+        for (b,(c,bar)) in enumerate(zip(counts,text_histogram(counts))):
+            lo=p.minval+(p.maxval-p.minval)*b/args.bins
+            print(f"  {lo:12.6g} : {c:8d} {bar}")
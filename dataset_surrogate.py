@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+import sys
+import argparse
+from pathlib import Path
+import numpy as np
+
+from dataset import command_line_dataset_open_helper
+from dataset.surrogate import Surrogate
+
+def parse_query(surrogate:Surrogate, text:str) -> np.ndarray:
+    """
+    Parses "NAME=VALUE,NAME=VALUE,..." into a configuration in the surrogate's parameter order.
+    """
+    values={}
+    for part in text.split(","):
+        (name,_,value)=part.partition("=")
+        assert name.strip() in surrogate.parameters, f"Unknown parameter '{name.strip()}' in query, expected one of {surrogate.parameters}"
+        values[name.strip()]=float(value)
+    missing=[ p for p in surrogate.parameters if p not in values ]
+    assert len(missing)==0, f"Query '{text}' doesn't give a value for {missing}"
+    return np.array([ values[p] for p in surrogate.parameters ])
+
+if __name__=="__main__":
+
+    parser=argparse.ArgumentParser(
+        "dataset_surrogate.py",
+        description=
+"""
+Trains a surrogate model that predicts observables from parameters using the samples
+in a dataset, saves it, and/or uses it to answer queries. Predictions come with a
+standard deviation, which gets large in regions with few samples.
+"""
+    )
+    parser.add_argument("dataset_dir_or_dmpci_template", nargs="?", default=None, help="Dataset to train on. Not needed with --load.")
+    parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
+    parser.add_argument("--read-only", default=False, action='store_true', help="Only use samples already merged by dataset_merge.py, rather than scanning for new sample zips.")
+    parser.add_argument("--model", default="knn", choices=Surrogate.models, help="knn is an inverse distance weighted average of nearby samples, rbf a radial basis function interpolant.")
+    parser.add_argument("--neighbours", default=8, type=int, help="Number of nearby samples used for each prediction.")
+    parser.add_argument("--smoothing", default=0.0, type=float, help="Smoothing for the rbf model, to allow for noise in the observables.")
+    parser.add_argument("--observable", default=[], action="append", help="Observable to model (can be repeated). Default is all of them.")
+    parser.add_argument("--time", default=[], action="append", type=int, help="Time to model (can be repeated). Default is all of them.")
+    parser.add_argument("--validate", default=None, type=float, help="Hold out this fraction of samples, and report the prediction error on them.")
+    parser.add_argument("--output", default=None, help="Save the trained model to this file (.npz).")
+    parser.add_argument("--load", default=None, help="Load a model saved with --output rather than training one.")
+    parser.add_argument("--query", default=[], action="append", help="Print predictions for NAME=VALUE,NAME=VALUE,... (can be repeated).")
+
+    args=parser.parse_args()
+
+    if args.load is not None:
+        surrogate=Surrogate.load(Path(args.load))
+        sys.stderr.write(f"Loaded {surrogate.model} model trained on {surrogate.x.shape[0]} distinct configurations\n")
+    else:
+        if args.dataset_dir_or_dmpci_template is None:
+            sys.stderr.write("Need either a dataset or --load\n")
+            sys.exit(1)
+        (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, read_only=args.read_only)
+        if dataset.matrix==None:
+            sys.stderr.write("Dataset is empty.\n")
+            sys.exit(1)
+        m=dataset.matrix
+        observables=args.observable or None
+        times=args.time or None
+        for o in args.observable:
+            if o not in m.observables_to_index:
+                sys.stderr.write(f"Unknown observable '{o}', expected one of {list(m.observables_to_index.keys())}\n")
+                sys.exit(1)
+        for t in args.time:
+            if t not in m.times_to_index:
+                sys.stderr.write(f"Unknown time {t}, expected one of {list(m.times)}\n")
+                sys.exit(1)
+
+        rows=np.arange(m.nExperiments)
+        if args.validate is not None:
+            assert 0 < args.validate < 1
+            rng=np.random.default_rng(1)
+            rng.shuffle(rows)
+            nHeld=max(1, int(round(len(rows)*args.validate)))
+            (held,rows)=(np.sort(rows[:nHeld]), np.sort(rows[nHeld:]))
+
+        surrogate=Surrogate.train(m, dataset.template, observables, times, rows, args.model, args.neighbours, args.smoothing)
+        sys.stderr.write(f"Trained {surrogate.model} model on {surrogate.x.shape[0]} distinct configurations, {len(surrogate.times)} times x {len(surrogate.observables)} observables\n")
+
+        if args.validate is not None:
+            (x,y)=Surrogate.training_data(m, dataset.template, surrogate.observables, surrogate.times, held)
+            (mean,std)=surrogate.predict_unit(x)
+            err=mean-y
+            within=np.abs(err) <= 2*std
+            print(f"Validation on {x.shape[0]} held out samples:")
+            for (i,o) in enumerate(surrogate.observables):
+                rmse=np.sqrt(np.mean(err[:,:,i]**2))
+                spread=np.std(y[:,:,i])
+                print(f"  {o} : rmse={rmse:.6g}, rmse/std={rmse/spread if spread>0 else float('nan'):.3g}, within 2 sd={np.mean(within[:,:,i]):.1%}")
+
+        if args.output is not None:
+            surrogate.save(Path(args.output))
+            sys.stderr.write(f"Saved model to {args.output}\n")
+
+    if len(args.query)>0:
+        queries=np.array([ parse_query(surrogate, q) for q in args.query ])
+        (mean,std)=surrogate.predict(queries)
+        for (qi,q) in enumerate(args.query):
+            print(q)
+            for (oi,o) in enumerate(surrogate.observables):
+                for (ti,t) in enumerate(surrogate.times):
+                    print(f"  {o} @ {t} : {mean[qi,ti,oi]:.6g} +- {std[qi,ti,oi]:.3g}")
@@ -10,6 +10,7 @@ from dataclasses import dataclass
 import multiprocessing
 import os
 import bz2
+import gzip
 import zipfile
 import tempfile
 from contextlib import ExitStack
@@ -23,9 +24,34 @@ if __name__=="__main__":
     )
     parser.add_argument("dataset_dir_or_dmpci_template")
     parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
+    parser.add_argument("--read-only", default=False, action='store_true', help="Only use samples already merged by dataset_merge.py, rather than scanning for new sample zips.")
+    parser.add_argument("--output", default=None, help="File to write to. Default is stdout. If the name ends in .gz it is gzip compressed.")
+    parser.add_argument("--tag", default=[], action="append", help="Only export samples with this tag. Can be given multiple times.")
+    parser.add_argument("--observable", default=[], action="append", help="Only export this observable. Can be given multiple times.")
+    parser.add_argument("--time-min", default=None, type=int, help="Only export times >= this.")
+    parser.add_argument("--time-max", default=None, type=int, help="Only export times <= this.")
+    parser.add_argument("--float-format", default="%r", help="printf style format for values. Default of %%r gives exact values, but e.g. %%.8g is much faster.")
     
     args=parser.parse_args()
 
-    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root)
+    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, read_only=args.read_only)
 
-    dataset.export_pivot_csv(sys.stdout)
\ No newline at end of file
+    if dataset.matrix==None:
+        sys.stderr.write("Dataset is empty.\n")
+        sys.exit(1)
+
+    with ExitStack() as stack:
+        if args.output is None:
+            dst=sys.stdout
+        elif args.output.endswith(".gz"):
+            dst=stack.enter_context(gzip.open(args.output, "wt", compresslevel=6))
+        else:
+            dst=stack.enter_context(open(args.output, "wt"))
+
+        dataset.export_pivot_csv(dst,
+            tags=args.tag or None,
+            observables=args.observable or None,
+            time_min=args.time_min,
+            time_max=args.time_max,
+            float_format=args.float_format
+        )
\ No newline at end of file
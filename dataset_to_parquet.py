@@ -0,0 +1,48 @@
+#!/usr/bin/env python3
+import sys
+import argparse
+from pathlib import Path
+
+from dataset import command_line_dataset_open_helper
+
+if __name__=="__main__":
+
+    parser=argparse.ArgumentParser(
+        "dataset_to_parquet.py",
+        description="Export the results of a dataset as a parquet file. Requires pyarrow."
+    )
+    parser.add_argument("dataset_dir_or_dmpci_template")
+    parser.add_argument("output_file", help="Name of the parquet file to create")
+    parser.add_argument("--default_dataset_root", nargs="?", default="dpd_datasets", help="Default directory to put datasets in.")
+    parser.add_argument("--read-only", default=False, action='store_true', help="Only use samples already merged by dataset_merge.py, rather than scanning for new sample zips.")
+    parser.add_argument("--layout", default="long", choices=["long","wide"], help="long: one row per (sample,time,observable). wide: one row per (sample,time) with one column per observable.")
+    parser.add_argument("--compression", default="zstd", help="Parquet compression codec, e.g. zstd, snappy, gzip, none.")
+    parser.add_argument("--block-size", default=256, type=int, help="Number of samples per row group.")
+    parser.add_argument("--tag", default=[], action="append", help="Only export samples with this tag. Can be given multiple times.")
+    parser.add_argument("--observable", default=[], action="append", help="Only export this observable. Can be given multiple times.")
+    parser.add_argument("--time-min", default=None, type=int, help="Only export times >= this.")
+    parser.add_argument("--time-max", default=None, type=int, help="Only export times <= this.")
+    
+    args=parser.parse_args()
+
+    try:
+        import pyarrow
+    except ImportError:
+        sys.stderr.write("dataset_to_parquet.py needs pyarrow, which is not installed (try 'pip install pyarrow').\n")
+        sys.exit(1)
+
+    (dataset,dataset_dir)=command_line_dataset_open_helper(args.dataset_dir_or_dmpci_template, args.default_dataset_root, read_only=args.read_only)
+
+    if dataset.matrix==None:
+        sys.stderr.write("Dataset is empty.\n")
+        sys.exit(1)
+
+    dataset.export_parquet(Path(args.output_file),
+        layout=args.layout,
+        tags=args.tag or None,
+        observables=args.observable or None,
+        time_min=args.time_min,
+        time_max=args.time_max,
+        compression=args.compression,
+        block_size=args.block_size
+    )
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+import sys
+import argparse
+import os
+import re
+import signal
+import subprocess
+import time
+from pathlib import Path
+from typing import *
+
+from dataset.scheduling import parse_slurm_time
+
+def parse_array(spec:str) -> Tuple[List[int],Optional[int]]:
+    """
+    Parses a SLURM array spec such as "0-15%4" or "1,3,5-7" into (task ids, throttle).
+    """
+    throttle=None
+    if "%" in spec:
+        (spec,t)=spec.split("%")
+        throttle=int(t)
+    ids=[]
+    for part in spec.split(","):
+        m=re.fullmatch(r"(\d+)(?:-(\d+))?(?::(\d+))?", part)
+        assert m, f"Can't parse array spec '{part}'"
+        (begin,end,step)=(int(m.group(1)), int(m.group(2) or m.group(1)), int(m.group(3) or 1))
+        ids.extend(range(begin,end+1,step))
+    return (ids,throttle)
+
+def read_directives(script:Path) -> Dict[str,str]:
+    res={}
+    with open(script, "rt") as src:
+        for l in src:
+            m=re.match(r"#SBATCH\s+--([a-z-]+)(?:=(\S+))?", l)
+            if m:
+                res[m.group(1)]=m.group(2) or ""
+    return res
+
+
+if __name__=="__main__":
+
+    parser=argparse.ArgumentParser(
+        "fake_sbatch.py",
+        description=
+"""
+Stand-in for sbatch, for testing job scripts on a single machine. Runs the script (or every
+task of an array job) locally and waits for them to finish, with the SLURM environment
+variables the scripts use. Array throttles are honoured, and a task that reaches its
+time limit gets SIGTERM and then SIGKILL, like a real job.
+"""
+    )
+    parser.add_argument("script")
+    parser.add_argument("--time-scale", default=1.0, type=float, help="Multiply job time limits by this, to test time limits quickly.")
+    parser.add_argument("--kill-wait", default=30, type=float, help="Seconds between SIGTERM and SIGKILL at the time limit.")
+    parser.add_argument("--node-cpus", default=os.cpu_count(), type=int, help="Cores on the pretend node, used for --exclusive jobs.")
+    args=parser.parse_args()
+
+    script=Path(args.script)
+    directives=read_directives(script)
+    sys.stderr.write(f"Directives : {directives}\n")
+
+    job_id=os.getpid()
+    (task_ids,throttle)=parse_array(directives["array"]) if "array" in directives else ([None],None)
+    throttle=throttle or len(task_ids)
+    time_limit=parse_slurm_time(directives["time"])*args.time_scale if "time" in directives else None
+    cpus=int(directives.get("cpus-per-task", args.node_cpus if "exclusive" in directives else 1))
+
+    print(f"Submitted batch job {job_id}")
+    sys.stdout.flush()
+
+    def start(task_id:Optional[int]) -> Tuple[subprocess.Popen,float]:
+        env=dict(os.environ)
+        env["SLURM_JOB_ID"]=str(job_id if task_id is None else job_id*1000+task_id)
+        env["SLURM_CPUS_ON_NODE"]=str(cpus)
+        if "cpus-per-task" in directives:
+            env["SLURM_CPUS_PER_TASK"]=str(cpus)
+        if task_id is not None:
+            env["SLURM_ARRAY_JOB_ID"]=str(job_id)
+            env["SLURM_ARRAY_TASK_ID"]=str(task_id)
+        out=f"slurm-{job_id}.out" if task_id is None else f"slurm-{job_id}_{task_id}.out"
+        with open(out, "wt") as dst:
+            # Own process group, so the time limit signals reach every process of the task
+            proc=subprocess.Popen(["bash", str(script)], env=env, stdout=dst, stderr=subprocess.STDOUT, start_new_session=True)
+        return (proc,time.time())
+
+    todo=list(task_ids)
+    running=[] # type: List[Tuple[Optional[int],subprocess.Popen,float,bool]]
+    failed=0
+    while len(todo)>0 or len(running)>0:
+        while len(todo)>0 and len(running)<throttle:
+            task_id=todo.pop(0)
+            (proc,started)=start(task_id)
+            running.append( (task_id,proc,started,False) )
+        time.sleep(0.1)
+        still=[]
+        for (task_id,proc,started,termed) in running:
+            code=proc.poll()
+            if code is not None:
+                sys.stderr.write(f"Task {task_id} finished with code {code}\n")
+                failed += (code!=0)
+                continue
+            elapsed=time.time()-started
+            if time_limit is not None and elapsed>time_limit and not termed:
+                sys.stderr.write(f"Task {task_id} reached time limit, sending SIGTERM\n")
+                os.killpg(proc.pid, signal.SIGTERM)
+                termed=True
+            elif time_limit is not None and elapsed>time_limit+args.kill_wait:
+                os.killpg(proc.pid, signal.SIGKILL)
+            still.append( (task_id,proc,started,termed) )
+        running=still
+
+    sys.exit(1 if failed else 0)